@@ -3,7 +3,7 @@ title: CD ProJect
 author: Zed Unknown
 author_url: https://github.com/ZedUnknown
 description: Create Documents from Python + Jupyter
-requirements:
+requirements: aiohttp
 version: 1.0.0
 licence: MIT
 """
@@ -14,186 +14,701 @@ Critical Error codes:
 """
 
 from pydantic import BaseModel, Field
+from collections import OrderedDict
+from contextlib import aclosing, contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime
-import websocket
-import requests
+from urllib.parse import urlencode
 import textwrap
+import ast
+import aiohttp
+import sqlite3
+import tempfile
+import hashlib
+import hmac
+import secrets
+import shutil
 import asyncio
 import logging
+import weakref
+import signal
 import uuid
 import json
 import time
 import sys
+import os
 
+try:
+    import fcntl
+except ImportError:
+    # Windows, pools do not keep a kernel ledger there
+    fcntl = None
 
-class Tools:
-    def __init__(self):
-        """
-        initialize the document generator tool
-        """
-        self.valves = self.Valves()
 
-    class Valves(BaseModel):
-        """
-        configurable settings
-        """
-        JUPYTER_URL: str = Field(
-            default="http://localhost:8888",
-            description="URL of the Jupyter backend",
-        )
-        JUPYTER_TOKEN: str = Field(
-            default="JUPYTER_TOKEN",
-            description="Token for Jupyter authentication",
-        )
-        BASE_DOWNLOAD_URL: str = Field(
-            default="https://your.domain.com/backend-api/files/download",
-            description="Base URL for file downloads",
-        )
-        ENABLE_DEBUG: bool = Field(
-            default=False,
-            description="Enable debug mode",
+# ================== KERNEL BOOTSTRAP ==================
+
+# MIME type of the display_data message that carries the execution result
+RESULT_MIME_TYPE = "application/vnd.cdproject.result+json"
+
+# installed once per kernel as the `cdproject_bootstrap` module: imports the
+# heavy document libraries and patches their save functions to write to the
+# path held in `target_path` (or, for a batch, the matching entry of
+# `batch_targets`), which each execution sets through begin()/begin_batch()
+KERNEL_BOOTSTRAP_MODULE = '''
+from IPython import get_ipython
+import contextvars
+import builtins
+import hashlib
+import io
+import secrets
+import signal
+import errno
+import time
+import sys
+import os
+
+# the local backend keeps documents under its DATA_DIR instead of the Jupyter volume
+USER_FILES_DIR = os.environ.get("CDPROJECT_USER_FILES_DIR", "/mnt/data/user_files")
+
+# must match RESULT_MIME_TYPE in the tool
+RESULT_MIME_TYPE = "application/vnd.cdproject.result+json"
+
+# formats a plain open() can write, must match TEXT_EXTENSIONS in the tool
+TEXT_EXTENSIONS = {
+    "txt", "md", "csv", "json", "log", "html", "xml", "ipynb", "py", "js", "css", "ts",
+    "c", "cpp", "java", "go", "sh", "yml", "ini", "cfg", "conf", "sql", "ps1", "bat",
+}
+
+# target of the current execution, None outside a tool execution
+target_path = contextvars.ContextVar("cdproject_target_path", default=None)
+# {name: (extension, path)} of the current batch execution
+batch_targets = contextvars.ContextVar("cdproject_batch_targets", default=None)
+# archive format the current batch is packaged into, None for separate files
+batch_archive = contextvars.ContextVar("cdproject_batch_archive", default=None)
+started_at = contextvars.ContextVar("cdproject_started_at", default=None)
+reset_seconds = contextvars.ContextVar("cdproject_reset_seconds", default=None)
+# (cProfile.Profile, number of top functions) while a profiled execution runs
+profiler = contextvars.ContextVar("cdproject_profiler", default=None)
+# bytes the model code may still print, None when unlimited
+stdout_budget = contextvars.ContextVar("cdproject_stdout_budget", default=None)
+# rlimits are per process: {resource: (soft, hard)} to put back after the execution
+saved_limits = {}
+# configured quotas of the current execution, for the error message
+active_quotas = {}
+
+
+class ResourceLimitExceeded(Exception):
+    """
+    raised into the model code when it uses up its CPU time or stdout quota
+    """
+
+    def __init__(self, limit, message):
+        super().__init__(message)
+        self.limit = limit
+
+
+def _batch_target(targets, path):
+    """
+    pick the batch output a save belongs to: by file name ("sales.xlsx" or
+    "sales"), else by extension when only one output has it
+    """
+    if path is None or not isinstance(path, (str, os.PathLike)):
+        # buffers and "return as string" calls are left alone
+        return path
+    name = os.path.basename(os.fspath(path))
+    stem, extension = os.path.splitext(name)
+    for key in (name, stem):
+        if key in targets:
+            return targets[key][1]
+    matches = [target for target in targets.values() if "." + target[0] == extension.lower()]
+    if len(matches) == 1:
+        return matches[0][1]
+    raise ValueError(f"Cannot tell which document {name!r} is, save to one of: {', '.join(targets)}")
+
+
+def _target(path):
+    targets = batch_targets.get()
+    if targets is not None:
+        return _batch_target(targets, path)
+    target = target_path.get()
+    return path if target is None else target
+
+
+def _in_execution():
+    return target_path.get() is not None or batch_targets.get() is not None
+
+
+def _text_target(path):
+    """
+    document a plain open() of a text file writes to: the one document of its
+    extension, or in a batch the one it is named after; anything else (other
+    extensions, the tool's own files next to the documents) is left alone
+    """
+    name = os.path.basename(path)
+    stem, extension = os.path.splitext(name)
+    extension = extension.lower().lstrip(".")
+    if extension not in TEXT_EXTENSIONS:
+        return path
+    targets = batch_targets.get()
+    if targets is None:
+        target = target_path.get()
+        targets = {"": (os.path.splitext(target)[1].lstrip("."), target)}
+    if any(os.path.dirname(os.path.abspath(path)) == os.path.dirname(target) for _, target in targets.values()):
+        return path
+    for key in (name, stem):
+        if key in targets and targets[key][0] == extension:
+            return targets[key][1]
+    documents = [target for target_extension, target in targets.values() if target_extension == extension]
+    return documents[0] if len(documents) == 1 else path
+
+
+def reset_namespace():
+    """
+    drop everything a previous execution left in the user namespace; much
+    cheaper than %reset, which also clears history and runs a full gc
+    """
+    started = time.perf_counter()
+    shell = get_ipython()
+    for name in [name for name in shell.user_ns if name not in shell.user_ns_hidden]:
+        del shell.user_ns[name]
+    reset_seconds.set(time.perf_counter() - started)
+
+
+def _start_profiling(top_functions):
+    """
+    profile the model code with cProfile and trace its allocations, both are
+    stopped by finish()
+    """
+    # an execution that raised never reached finish(), stop its profiler now
+    _stop_profiling()
+    if not top_functions:
+        return
+    import cProfile
+    import tracemalloc
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    profile = cProfile.Profile()
+    profiler.set((profile, top_functions))
+    profile.enable()
+
+
+def _package(filename):
+    """
+    who to blame for a profiled function: the model code, a library or the stdlib
+    """
+    if filename == "~":
+        return "builtins"
+    if "ipykernel_" in filename or filename.startswith("<ipython-input"):
+        return "model code"
+    parts = filename.replace("\\\\", "/").split("/")
+    for packages_dir in ("site-packages", "dist-packages"):
+        if packages_dir in parts[:-1]:
+            return parts[parts.index(packages_dir) + 1].split(".")[0]
+    return "stdlib"
+
+
+def _stop_profiling():
+    state = profiler.get()
+    if state is None:
+        return None
+    import pstats
+    import tracemalloc
+
+    profile, top_functions = state
+    profile.disable()
+    profiler.set(None)
+    peak_traced = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # {(file, line, function): (primitive calls, calls, own time, cumulative time, callers)}
+    stats = {
+        function: timings
+        for function, timings in pstats.Stats(profile).stats.items()
+        if "_lsprof" not in function[2]
+    }
+    by_package = {}
+    for (filename, line, name), (_, calls, own, cumulative, _) in stats.items():
+        package = _package(filename)
+        by_package[package] = by_package.get(package, 0.0) + own
+    top = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top_functions]
+
+    return {
+        "peak_traced_mb": peak_traced / 1024 / 1024,
+        "by_package": dict(sorted(by_package.items(), key=lambda item: item[1], reverse=True)),
+        "top_functions": [
+            {
+                "function": f"{os.path.basename(filename)}:{line}({name})",
+                "package": _package(filename),
+                "calls": calls,
+                "own_seconds": own,
+                "cumulative_seconds": cumulative,
+            }
+            for (filename, line, name), (_, calls, own, cumulative, _) in top
+        ],
+    }
+
+
+def _lower_limit(kind, soft):
+    import resource
+
+    current_soft, hard = resource.getrlimit(kind)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    if current_soft != resource.RLIM_INFINITY and current_soft <= soft:
+        return
+    saved_limits.setdefault(kind, (current_soft, hard))
+    resource.setrlimit(kind, (soft, hard))
+
+
+def apply_limits(memory_mb=0, cpu_seconds=0, file_mb=0, stdout_kb=0):
+    """
+    quotas for this execution only (0 disables one): address space on top of
+    what the kernel already maps, CPU seconds, size of any written file and
+    printed output; restore_limits() lifts them after the cell
+    """
+    import resource
+
+    restore_limits()
+    if memory_mb and os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as f:
+            address_space = int(f.read().split()[0]) * resource.getpagesize()
+        _lower_limit(resource.RLIMIT_AS, address_space + memory_mb * 1024 * 1024)
+        active_quotas["memory"] = f"{memory_mb} MB"
+    if cpu_seconds:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _lower_limit(resource.RLIMIT_CPU, int(usage.ru_utime + usage.ru_stime) + cpu_seconds)
+        active_quotas["cpu"] = f"{cpu_seconds} CPU seconds"
+    if file_mb:
+        _lower_limit(resource.RLIMIT_FSIZE, file_mb * 1024 * 1024)
+        active_quotas["output_file_size"] = f"{file_mb} MB per file"
+    if stdout_kb:
+        stdout_budget.set(stdout_kb * 1024)
+        active_quotas["stdout"] = f"{stdout_kb} KB of output"
+
+
+def restore_limits(*args):
+    """
+    put the kernel limits back, registered as a post_run_cell hook so it also
+    runs after an execution that raised
+    """
+    import resource
+
+    for kind, limits in saved_limits.items():
+        resource.setrlimit(kind, limits)
+    saved_limits.clear()
+    active_quotas.clear()
+    stdout_budget.set(None)
+
+
+def _cpu_time_exceeded(signum, frame):
+    # the kernel keeps getting SIGXCPU while over the soft limit, lift it first
+    import resource
+
+    if resource.RLIMIT_CPU in saved_limits:
+        resource.setrlimit(resource.RLIMIT_CPU, saved_limits.pop(resource.RLIMIT_CPU))
+    raise ResourceLimitExceeded("cpu", "CPU time limit exceeded")
+
+
+def _limit_stream(stream):
+    write = stream.write
+
+    def limited_write(text):
+        budget = stdout_budget.get()
+        if budget is not None:
+            budget -= len(text)
+            stdout_budget.set(None if budget < 0 else budget)
+            if budget < 0:
+                raise ResourceLimitExceeded("stdout", "Printed output limit exceeded")
+        return write(text)
+
+    stream.write = limited_write
+
+
+def _limit_exceeded(shell, etype, value, tb, tb_offset=None):
+    """
+    custom exception handler: report an exceeded quota as a structured result
+    (the pool recycles the kernel), then show the usual traceback
+    """
+    from IPython.display import publish_display_data
+
+    # subclasses land here too (e.g. numpy's _ArrayMemoryError, FileNotFoundError)
+    if issubclass(etype, ResourceLimitExceeded):
+        limit = value.limit
+    elif issubclass(etype, MemoryError):
+        limit = "memory"
+    elif issubclass(etype, OSError) and value.errno == errno.EFBIG:
+        limit = "output_file_size"
+    else:
+        limit = None
+
+    if limit is not None:
+        quota = active_quotas.get(limit)
+        restore_limits()
+        error_class, description = {
+            "memory": ("MemoryLimitExceeded", "Memory limit exceeded"),
+            "cpu": ("CPUTimeLimitExceeded", "CPU time limit exceeded"),
+            "output_file_size": ("OutputFileTooLarge", "Output file size limit exceeded"),
+            "stdout": ("StdoutLimitExceeded", "Printed output limit exceeded"),
+        }[limit]
+        message = description + (f" ({quota})" if quota else "")
+        publish_display_data(
+            {
+                RESULT_MIME_TYPE: {
+                    "status": "error",
+                    "message": message,
+                    "error_class": error_class,
+                    "limit": limit,
+                    "recycle": True,
+                }
+            }
         )
+    # IPython leaves showing the traceback of a custom exception to the handler
+    shell.showtraceback((etype, value, tb), tb_offset=tb_offset)
 
-    async def create_document(
-        self,
-        document_extension: str,
-        document_name: str,
-        code: str = """""",
-        # contains chat context metadata (critical: includes chat_id, message_id)
-        __metadata__: dict = None,
-        # open WebUI injects a callback function to send real-time updates to the UI
-        # when available, use this to emit status, message, or citation events
-        # when None, the tool should work without UI updates (safe fallback)
-        __event_emitter__=None,
-    ) -> str:
-        """
-        :param code: The Python code to execute for document generation.
-        :param document_extension: Type of document being generated (e.g., "docx", "pdf", "excel", etc.)
-        :param document_name: Meaningful name for the document
-        """
-        
-        logging.basicConfig(level=logging.INFO)
-        logger = logging.getLogger(__name__)
-        # emit status that when starting document generation
-        if __event_emitter__:
-            await __event_emitter__(
+
+def begin(user_id, chat_id, extension, profile_top_functions=0):
+    """
+    allocate the output file of this execution and point every save at it
+    """
+    folder = os.path.join(USER_FILES_DIR, user_id, chat_id)
+    os.makedirs(folder, exist_ok=True)
+    final_path = os.path.join(folder, secrets.token_urlsafe(16) + "." + extension)
+    target_path.set(final_path)
+    # a batch that raised before finish() must not capture these saves
+    batch_targets.set(None)
+    started_at.set(time.perf_counter())
+    _start_profiling(profile_top_functions)
+    return final_path
+
+
+def begin_batch(user_id, chat_id, outputs, archive_format=None, profile_top_functions=0):
+    """
+    allocate one output file per {name: extension} entry, each save is routed
+    to the file of the document it writes
+    """
+    folder = os.path.join(USER_FILES_DIR, user_id, chat_id)
+    os.makedirs(folder, exist_ok=True)
+    targets = {
+        name: (extension, os.path.join(folder, secrets.token_urlsafe(16) + "." + extension))
+        for name, extension in outputs.items()
+    }
+    batch_targets.set(targets)
+    batch_archive.set(archive_format)
+    target_path.set(None)
+    started_at.set(time.perf_counter())
+    _start_profiling(profile_top_functions)
+    return targets
+
+
+# formats that are zip containers already, deflating them again only costs CPU
+STORED_EXTENSIONS = {".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp", ".zip", ".png", ".jpg", ".jpeg"}
+
+
+def archive(folder, members, archive_format):
+    """
+    stream {arcname: path} into one zip or tar.zst file in folder, a member
+    at a time in chunks, so memory stays flat whatever the file sizes
+    """
+    if archive_format == "zip":
+        import zipfile
+
+        final_path = os.path.join(folder, secrets.token_urlsafe(16) + ".zip")
+        with zipfile.ZipFile(final_path + ".tmp", "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for arcname, path in members.items():
+                stored = os.path.splitext(path)[1].lower() in STORED_EXTENSIONS
+                zf.write(path, arcname, compress_type=zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)
+    elif archive_format == "tar.zst":
+        import tarfile
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("tar.zst archives need the zstandard package in the Jupyter image")
+
+        final_path = os.path.join(folder, secrets.token_urlsafe(16) + ".tar.zst")
+        with open(final_path + ".tmp", "wb") as raw:
+            with zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False) as compressed:
+                # "w|" writes a non-seekable stream, nothing is buffered whole
+                with tarfile.open(fileobj=compressed, mode="w|") as tar:
+                    for arcname, path in members.items():
+                        tar.add(path, arcname)
+    else:
+        raise ValueError(f"Unknown archive format {archive_format!r}")
+
+    os.replace(final_path + ".tmp", final_path)
+    return final_path
+
+
+def publish_archive(user_id, chat_id, file_names, archive_format):
+    """
+    package documents generated earlier in this chat into one archive
+    """
+    from IPython.display import publish_display_data
+
+    started = time.perf_counter()
+    folder = os.path.join(USER_FILES_DIR, user_id, chat_id)
+    members = {}
+    for file_name in file_names:
+        path = os.path.join(folder, file_name)
+        # only plain file names of this chat, nothing outside its folder
+        if os.path.basename(file_name) != file_name or not os.path.isfile(path):
+            publish_display_data(
                 {
-                    "type": "status",
-                    "data": {
-                        "description": f"Generating {document_extension} document...",
-                        "done": False,
-                    },
+                    RESULT_MIME_TYPE: {
+                        "status": "error",
+                        "message": f"no document {file_name!r} in this chat",
+                        "error_class": "DocumentNotFound",
+                    }
                 }
-            ) 
-            await asyncio.sleep(1)
+            )
+            return
+        members[file_name] = path
 
-        # UUIDs from metadata
-        chat_id = None
-        user_id = None
-        
+    result = _file_result(archive(folder, members, archive_format))
+    result["elapsed_seconds"] = time.perf_counter() - started
+    publish_display_data({RESULT_MIME_TYPE: result})
+
+
+def file_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _file_result(final_path):
+    if final_path and os.path.exists(final_path):
+        return {
+            "status": "ok",
+            "file_name": os.path.basename(final_path),
+            "size": os.path.getsize(final_path),
+            "sha256": file_digest(final_path),
+        }
+    return {"status": "error", "message": "file not created", "error_class": "FileNotCreated"}
+
+
+def _trace_id():
+    """
+    trace id of the W3C traceparent the tool put in the execute_request header
+    """
+    traceparent = get_ipython().parent_header.get("header", {}).get("traceparent")
+    return traceparent.split("-")[1] if traceparent else None
+
+
+def finish():
+    """
+    publish the result of this execution on its own display_data channel,
+    so nothing the model code prints can be mistaken for it
+    """
+    import resource
+    from IPython.display import publish_display_data
+
+    # stop the profiler first, so the bookkeeping below is not part of it
+    profile = _stop_profiling()
+    finished_at = time.perf_counter()
+    final_path = target_path.get()
+    targets = batch_targets.get()
+    archive_format = batch_archive.get()
+    target_path.set(None)
+    batch_targets.set(None)
+    batch_archive.set(None)
+
+    result = {
+        # peak RSS of the kernel process, used by the pool to recycle bloated kernels
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "trace_id": _trace_id(),
+    }
+    if targets is None:
+        result.update(_file_result(final_path))
+    else:
+        outputs = {name: _file_result(path) for name, (extension, path) in targets.items()}
+        missing = [name for name, output in outputs.items() if output["status"] != "ok"]
+        result["outputs"] = outputs
+        if missing:
+            result.update(
+                status="error", message=f"file not created: {', '.join(missing)}", error_class="FileNotCreated"
+            )
+        elif archive_format:
+            # the documents are only reachable through the archive, drop the loose files
+            members = {name + "." + extension: path for name, (extension, path) in targets.items()}
+            folder = os.path.dirname(next(iter(members.values())))
+            result.update(_file_result(archive(folder, members, archive_format)))
+            result["archive"] = archive_format
+            for path in members.values():
+                os.remove(path)
+        else:
+            result["status"] = "ok"
+
+    if profile is not None:
+        outputs = result.get("outputs", {}).values() if targets is not None else [result]
+        profile["output_bytes"] = sum(output.get("size", 0) for output in outputs)
+        profile["max_rss_mb"] = result["max_rss_mb"]
+        result["profile"] = profile
+
+    # kernel side spans: namespace reset, model code (incl. its imports and saves), result checks
+    now = time.perf_counter()
+    started = started_at.get() or finished_at
+    result["elapsed_seconds"] = now - started
+    result["stages"] = {
+        "reset": reset_seconds.get() or 0.0,
+        "user_code": finished_at - started,
+        "finalize": now - finished_at,
+    }
+    started_at.set(None)
+    reset_seconds.set(None)
+    publish_display_data({RESULT_MIME_TYPE: result})
+
+
+def publish_library_versions():
+    from importlib import metadata
+    from IPython.display import publish_display_data
+
+    versions = {}
+    for distribution in ("python-docx", "odfpy", "python-pptx", "openpyxl", "reportlab", "pandas", "pypandoc"):
         try:
-            if (
-                __metadata__
-                and ("user_id" in __metadata__)
-                and ("chat_id" in __metadata__)
-            ):
-                user_id = __metadata__["user_id"]
-                chat_id = __metadata__["chat_id"]
+            versions[distribution] = metadata.version(distribution)
+        except metadata.PackageNotFoundError:
+            versions[distribution] = None
+    try:
+        import pypandoc
+        versions["pandoc"] = pypandoc.get_pandoc_version()
+    except Exception:
+        versions["pandoc"] = None
 
-            else:
-                if __event_emitter__:
-                    await __event_emitter__(
-                        {
-                            "type": "status",
-                            "data": {
-                                "description": "Something went wrong! Please contact the administrator and provide them with the error code 18854",
-                                "done": True,
-                                "hidden": False if self.valves.ENABLE_DEBUG else True,
-                            },
-                        }
-                    )
-                    await asyncio.sleep(1)
-                raise ValueError("User ID or Chat ID is not available.")
+    publish_display_data({RESULT_MIME_TYPE: {"status": "ok", "versions": versions}})
 
-            # map document types to file extensions
-            # sometimes ai generates wrong file extensions
-            extension_map = {
-                "word": "docx",
-                "doc": "docx",
-                "docx": "docx",
-                "pdf": "pdf",
-                "excel": "xlsx",
-                "xlsx": "xlsx",
-                "powerpoint": "pptx",
-                "pptx": "pptx",
-                "csv": "csv",
-                "text": "txt",
-                "txt": "txt",
-                "rtf": "rtf",
-                "odt": "odt",
-                "ods": "ods",
-                "odp": "odp",
-                "html": "html",
-                "htm": "html",
-                "xml": "xml",
-                "json": "json",
-                "md": "md",
-                "markdown": "md",
-                "log": "log",
-                "ipynb": "ipynb",
-                "py": "py",
-                "js": "js",
-                "css": "css",
-                "ts": "ts",
-                "c": "c",
-                "cpp": "cpp",
-                "java": "java",
-                "go": "go",
-                "sh": "sh",
-                "bash": "sh",
-                "yml": "yml",
-                "yaml": "yml",
-                "ini": "ini",
-                "cfg": "cfg",
-                "conf": "conf",
-                "sql": "sql",
-                "ps1": "ps1",
-                "bat": "bat"
-            }
 
-            # get the appropriate extension
-            extension = extension_map.get(document_extension.lower(), "txt")
-            
-            # ========================================================
-            # ================== 🙉 MONKEY WRAPPERS 🐒 ==============
-            # ========================================================
-            
-            # de-indent the model-generated code
-            normalized_code = textwrap.dedent(code)
+# ---- templates ----
+# house-style base documents, parsed once per kernel and handed out as copies
+TEMPLATES_DIR = os.environ.get("CDPROJECT_TEMPLATES_DIR", "/mnt/data/templates")
+# must match TEMPLATE_EXTENSIONS in the tool
+TEMPLATE_EXTENSIONS = (".docx", ".pptx", ".xlsx", ".py")
+# name -> ((path, mtime_ns), make_copy, description)
+_templates = {}
 
-            WRAPPER_CODE = f"""
-import os
-import sys
-import time
-import json
-import secrets
 
-# ================== WRAPPER ==================
+def _load_template(name, path):
+    """
+    (make_copy, description) of a template file: a parsed document is kept and
+    copied with deepcopy (docx/pptx) or unpickled from a snapshot (xlsx), a .py
+    style module is compiled once and re-run for every copy
+    """
+    extension = os.path.splitext(path)[1]
+    if extension == ".py":
+        import ast
+        import types
+        with open(path) as f:
+            source = f.read()
+        code = compile(source, path, "exec")
+
+        def make_copy():
+            namespace = {"__name__": "cdproject_template_" + name}
+            exec(code, namespace)
+            return types.SimpleNamespace(**{k: v for k, v in namespace.items() if not k.startswith("_")})
+
+        return make_copy, ast.get_docstring(ast.parse(source)) or ""
+
+    if extension == ".xlsx":
+        import openpyxl
+        import pickle
+        workbook = openpyxl.load_workbook(path)
+        snapshot = pickle.dumps(workbook)
+        return (lambda: pickle.loads(snapshot)), workbook.properties.title or workbook.properties.description or ""
+
+    import copy
+    if extension == ".docx":
+        import docx
+        document = docx.Document(path)
+    else:
+        import pptx
+        document = pptx.Presentation(path)
+    properties = document.core_properties
+    return (lambda: copy.deepcopy(document)), properties.title or properties.subject or ""
+
+
+def _template(name):
+    if not name.replace("_", "").replace("-", "").isalnum():
+        raise ValueError(f"Invalid template name {name!r}")
+    for extension in TEMPLATE_EXTENSIONS:
+        path = os.path.join(TEMPLATES_DIR, name + extension)
+        if os.path.isfile(path):
+            break
+    else:
+        raise FileNotFoundError(f"No template named {name!r}, see list_templates")
+
+    # an edited template is picked up on its next use
+    key = (path, os.stat(path).st_mtime_ns)
+    entry = _templates.get(name)
+    if entry is None or entry[0] != key:
+        entry = _templates[name] = (key, *_load_template(name, path))
+    return entry
+
+
+def template(name):
+    """
+    fresh copy of the named template, free to modify and save
+    """
+    return _template(name)[1]()
 
-folder = f"/mnt/data/user_files/{user_id}/{chat_id}"
-os.makedirs(folder, exist_ok=True)
-file_name = secrets.token_urlsafe(16) + "." + "{extension}"
-final_path = os.path.join(folder, file_name)
 
-time.sleep(3)
+def _template_names():
+    if not os.path.isdir(TEMPLATES_DIR):
+        return []
+    names = []
+    for entry in sorted(os.listdir(TEMPLATES_DIR)):
+        name, extension = os.path.splitext(entry)
+        if extension in TEMPLATE_EXTENSIONS and name not in names:
+            names.append(name)
+    return names
+
+
+def preload_templates():
+    """
+    parse every template while the kernel starts, a broken one only fails the
+    documents that use it
+    """
+    for name in _template_names():
+        try:
+            _template(name)
+        except Exception:
+            pass
+
+
+def publish_templates():
+    from IPython.display import publish_display_data
+
+    templates = []
+    for name in _template_names():
+        try:
+            (path, _), _, description = _template(name)
+            kind = os.path.splitext(path)[1].lstrip(".")
+        except Exception as e:
+            kind, description = "broken", f"{type(e).__name__}: {e}"
+        templates.append({"name": name, "type": kind, "description": (description.strip().splitlines() or [""])[0]})
+    publish_display_data({RESULT_MIME_TYPE: {"status": "ok", "templates": templates}})
+
+
+# ---- execution quotas ----
+_shell = get_ipython()
+_shell.events.register("post_run_cell", restore_limits)
+_shell.set_custom_exc((ResourceLimitExceeded, MemoryError, OSError), _limit_exceeded)
+signal.signal(signal.SIGXCPU, _cpu_time_exceeded)
+# writes past RLIMIT_FSIZE fail with EFBIG instead of killing the kernel
+signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+_limit_stream(sys.stdout)
+_limit_stream(sys.stderr)
 
 # ---- DOCX (python-docx) ----
 try:
     import docx
     original_docx_save = docx.document.Document.save
-    def new_docx_save(self, path):
-        return original_docx_save(self, final_path)
+    def new_docx_save(self, path, *args, **kwargs):
+        return original_docx_save(self, _target(path), *args, **kwargs)
     docx.document.Document.save = new_docx_save
+except ImportError:
+    pass
 except Exception as e:
     raise RuntimeError("An error occurred in DOCX patch") from e
 
@@ -201,9 +716,11 @@ except Exception as e:
 try:
     from odf.opendocument import OpenDocument
     original_odf_save = OpenDocument.save
-    def new_odf_save(self, path):
-        return original_odf_save(self, final_path)
+    def new_odf_save(self, path, *args, **kwargs):
+        return original_odf_save(self, _target(path), *args, **kwargs)
     OpenDocument.save = new_odf_save
+except ImportError:
+    pass
 except Exception as e:
     raise RuntimeError("An error occurred in ODF patch") from e
 
@@ -211,9 +728,11 @@ except Exception as e:
 try:
     import pptx
     original_pptx_save = pptx.presentation.Presentation.save
-    def new_pptx_save(self, path):
-        return original_pptx_save(self, final_path)
+    def new_pptx_save(self, path, *args, **kwargs):
+        return original_pptx_save(self, _target(path), *args, **kwargs)
     pptx.presentation.Presentation.save = new_pptx_save
+except ImportError:
+    pass
 except Exception as e:
     raise RuntimeError("An error occurred in PPTX patch") from e
 
@@ -221,9 +740,11 @@ except Exception as e:
 try:
     import openpyxl
     original_xlsx_save = openpyxl.workbook.workbook.Workbook.save
-    def new_xlsx_save(self, path):
-        return original_xlsx_save(self, final_path)
+    def new_xlsx_save(self, path, *args, **kwargs):
+        return original_xlsx_save(self, _target(path), *args, **kwargs)
     openpyxl.workbook.workbook.Workbook.save = new_xlsx_save
+except ImportError:
+    pass
 except Exception as e:
     raise RuntimeError("An error occurred in XLSX patch") from e
 
@@ -234,13 +755,15 @@ try:
 
     original_pdf_save = SimpleDocTemplate.__init__
     def new_pdf_save(self, path, *args, **kwargs):
-        return original_pdf_save(self, final_path, *args, **kwargs)
+        return original_pdf_save(self, _target(path), *args, **kwargs)
     SimpleDocTemplate.__init__ = new_pdf_save
 
     original_canvas_save = canvas.Canvas.__init__
     def new_canvas_save(self, path, *args, **kwargs):
-        return original_canvas_save(self, final_path, *args, **kwargs)
+        return original_canvas_save(self, _target(path), *args, **kwargs)
     canvas.Canvas.__init__ = new_canvas_save
+except ImportError:
+    pass
 except Exception as e:
     raise RuntimeError("An error occurred in PDF patch") from e
 
@@ -249,242 +772,2950 @@ try:
     import pandas as pd
     original_to_csv_save = pd.DataFrame.to_csv
     def new_to_csv_save(self, path_or_buf=None, *args, **kwargs):
-        return original_to_csv_save(self, final_path, *args, **kwargs)
+        return original_to_csv_save(self, _target(path_or_buf), *args, **kwargs)
     pd.DataFrame.to_csv = new_to_csv_save
+except ImportError:
+    pass
 except Exception as e:
     raise RuntimeError("An error occurred in CSV patch") from e
 
+# ---- XLSX (pandas) ----
+# DataFrame.to_excel with a file name goes through ExcelWriter too
+try:
+    import pandas as pd
+    original_excel_writer_init = pd.ExcelWriter.__init__
+    def new_excel_writer_init(self, path, *args, **kwargs):
+        if isinstance(path, (str, os.PathLike)):
+            path = _target(path)
+        return original_excel_writer_init(self, path, *args, **kwargs)
+    pd.ExcelWriter.__init__ = new_excel_writer_init
+except ImportError:
+    pass
+except Exception as e:
+    raise RuntimeError("An error occurred in XLSX (pandas) patch") from e
+
+# ---- TEXT (built-in open) ----
+# txt, md, csv, json, ... documents are often written with a plain open() or
+# Path.write_text(); only writes of the model code and of pandas (to_json,
+# to_markdown, ...) count, not e.g. a library updating its cache
+def _opened_by_model(frame):
+    while frame is not None and _package(frame.f_code.co_filename) == "stdlib":
+        frame = frame.f_back
+    return frame is not None and _package(frame.f_code.co_filename) in ("model code", "pandas")
+
+
+def _route_open(original_open):
+    def new_open(file, mode="r", *args, **kwargs):
+        if (
+            _in_execution()
+            and isinstance(file, (str, os.PathLike))
+            and set(mode) & set("wax")
+            and _opened_by_model(sys._getframe(1))
+        ):
+            file = _text_target(os.fspath(file))
+        return original_open(file, mode, *args, **kwargs)
+    return new_open
+
+
+try:
+    builtins.open = io.open = _route_open(io.open)
+    # IPython gives the user namespace its own open(), bound to the original io.open
+    _shell.user_ns["open"] = _route_open(_shell.user_ns.get("open", io.open))
+except Exception as e:
+    raise RuntimeError("An error occurred in TEXT patch") from e
+
 # ---- RTF / TXT / MD (pypandoc) ----
 # PAIN IN THE EYES, WHO MADE THIS MODULE??
+# patched exactly once per kernel, so no reload / double-patch guards are needed
 try:
-    import importlib, os, sys
-
-    # Reload module to get a clean original implementation
-    if "pypandoc" in sys.modules:
-        importlib.reload(sys.modules["pypandoc"])
     import pypandoc
+    original_convert_text = pypandoc.convert_text
+    original_convert_file = pypandoc.convert_file
 
-    # Ensure folder for final_path exists (defensive)
-    os.makedirs(os.path.dirname(final_path), exist_ok=True)
-
-    # Store the real original once (avoid capturing an already-patched function)
-    if not hasattr(pypandoc, "_original_convert_text"):
-        pypandoc._original_convert_text = pypandoc.convert_text
-    original_convert_text = pypandoc._original_convert_text
-
-    # Avoid double-patching
-    if not getattr(pypandoc, "_is_patched_by_wrapper", False):
-
-        def patched_convert_text(text, to, format="md", outputfile=None, extra_args=None):
-            # Normalize extra_args to a list and ensure --standalone present
-            args = list(extra_args) if extra_args else []
-            if "--standalone" not in args:
-                args.append("--standalone")
-
-            # Ask the original to return the converted content (do NOT pass outputfile)
-            # This avoids depending on Pandoc writing to disk itself.
-            result = original_convert_text(
-                text,
-                to,
-                format=format,
-                outputfile=None,   # request returned string/bytes
-                extra_args=args,
-            )
-
-            # If result is bytes/str, write it to final_path
-            if isinstance(result, bytes):
-                data = result
-            elif isinstance(result, str):
-                data = result.encode("utf-8")
-            else:
-                # fallback: coerce to string
-                data = str(result).encode("utf-8")
+    def _pandoc_to_target(convert, source, to, final_path, extra_args, kwargs):
+        """
+        let pandoc write the document itself (--output), the converted output
+        never passes through the kernel's memory or a pipe
+        """
+        args = list(extra_args) if extra_args else []
+        if "--standalone" not in args and "-s" not in args:
+            args.append("--standalone")
 
-            # Atomically write to disk (write to temp then rename) to be safer
-            tmp_path = final_path + ".tmp"
-            with open(tmp_path, "wb") as f:
-                f.write(data)
+        # keep the extension last, pypandoc insists on ".pdf" for pdf output
+        root, extension = os.path.splitext(final_path)
+        tmp_path = root + ".tmp" + extension
+        try:
+            result = convert(source, to, outputfile=tmp_path, extra_args=args, **kwargs)
             os.replace(tmp_path, final_path)  # atomic on most OSes
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return result
 
-            # Verify file exists
-            if not os.path.exists(final_path):
-                raise RuntimeError(f"Failed to write pypandoc output to {{final_path}}")
+    def patched_convert_text(source, to, format="md", extra_args=(), outputfile=None, **kwargs):
+        final_path = _target(outputfile) if _in_execution() else None
+        if final_path is None:
+            return original_convert_text(
+                source, to, format, extra_args=extra_args, outputfile=outputfile, **kwargs
+            )
+        return _pandoc_to_target(
+            original_convert_text, source, to, final_path, extra_args, {"format": format, **kwargs}
+        )
 
-            return result
+    def patched_convert_file(source_file, to, format=None, extra_args=(), outputfile=None, **kwargs):
+        final_path = _target(outputfile) if _in_execution() else None
+        if final_path is None:
+            return original_convert_file(
+                source_file, to, format, extra_args=extra_args, outputfile=outputfile, **kwargs
+            )
+        return _pandoc_to_target(
+            original_convert_file, source_file, to, final_path, extra_args, {"format": format, **kwargs}
+        )
 
-        pypandoc.convert_text = patched_convert_text
-        pypandoc._is_patched_by_wrapper = True
+    pypandoc.convert_text = patched_convert_text
+    pypandoc.convert_file = patched_convert_file
 
 except ImportError:
     # pypandoc not available - skip patching
     pass
 except Exception as e:
-    raise RuntimeError(f"Pandoc patching failed: {{str(e)}}") from e
-
-# ================== MODEL GENERATED CODE ==================
-{normalized_code}
-# ================== END MODEL GENERATED CODE ==================
+    raise RuntimeError(f"Pandoc patching failed: {str(e)}") from e
+'''
 
-if os.path.exists(final_path):
-    print(json.dumps({{"status": "ok", "file_name": file_name}}))
-else:
-    print(json.dumps({{"status": "error", "message": "file not created"}}))
-# ================== END WRAPPER ==================
+# executed once when a kernel joins the pool, reports the library versions
+# the kernel renders with (part of the result cache key)
+KERNEL_BOOTSTRAP_CODE = f"""
+import sys, types
+_module = types.ModuleType("cdproject_bootstrap")
+exec(compile({KERNEL_BOOTSTRAP_MODULE!r}, "<cdproject_bootstrap>", "exec"), _module.__dict__)
+sys.modules["cdproject_bootstrap"] = _module
+_module.publish_library_versions()
+_module.preload_templates()
+del sys, types, _module
 """
 
-            # emit status when sending code to Jupyter
-            if __event_emitter__:
-                await __event_emitter__(
-                    {
-                        "type": "status",
-                        "data": {
-                            "description": "Sending code to Jupyter backend...",
-                            "done": False,
-                        },
-                    }
-                )
-                await asyncio.sleep(1)
 
-            # ===================
-            #  Configure Jupyter
-            # ===================
-            kernel_id = None
+# ================== METRICS ==================
 
-            headers = {
-                "Authorization": f"token {self.valves.JUPYTER_TOKEN}",
-                "Content-Type": "application/json",
-            }
+# every metric the tool exports: name -> (type, help)
+METRIC_FAMILIES = {
+    "cdproject_documents_total": ("counter", "Documents requested, by extension and status"),
+    "cdproject_errors_total": ("counter", "Failed documents, by extension and error class"),
+    "cdproject_cache_requests_total": ("counter", "Result cache lookups, by result"),
+    "cdproject_request_seconds": ("histogram", "Wall-clock time of a tool call"),
+    "cdproject_stage_seconds": ("histogram", "Time spent per stage, on the tool, pool and kernel side"),
+    "cdproject_pool_kernels": ("gauge", "Kernels owned by the pool, by state"),
+    "cdproject_pool_running": ("gauge", "Checkouts holding or starting a kernel"),
+    "cdproject_backend_up": ("gauge", "Whether a Jupyter server of a sharded pool passed its last health check"),
+    "cdproject_queue_jobs": ("gauge", "Jobs in the admission queue, by state"),
+    "cdproject_shed_total": ("counter", "Requests turned away because the admission queue was full"),
+}
 
-            kernel_url = f"{self.valves.JUPYTER_URL}/api/kernels"
-            kernels_response = requests.get(kernel_url, headers=headers)
-            kernels = kernels_response.json()
 
-            if kernels_response.status_code == 200:
-                logger.info("kernels_response.status_code == 200")
+class MetricsRegistry:
+    """
+    in-process counters, histograms and pool gauges, rendered in the
+    Prometheus text exposition format
+    """
 
-                if kernels == []:
-                    logger.info("Kernels list is empty, creating a new kernel...")
-                    kernels_response = requests.post(
-                        kernel_url, headers=headers, json={"name": "python3"}
-                    )
-                    if kernels_response.status_code == 201:
-                        kernel_id = kernels_response.json()["id"]
-                        logger.info(f"Created kernel with id {kernel_id}")
-                    else:
-                        logger.info(f"Failed to create kernel: {kernels_response.text}")
-                        raise Exception("Failed to create kernel")
-                else:
-                    kernel_id = kernels[0]["id"]
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
 
-            else:
-                logger.info(f"Failed to get kernels: {kernels_response.text}")
-                raise Exception("Failed to get kernels")
-
-            # =================================================
-            #  Configure WebSocket to Communicate with Jupyter
-            # =================================================
-
-            # webSocket URL for the kernel channel
-            ws_url = f"ws://{(self.valves.JUPYTER_URL).replace('https://', '').replace('http://', '')}/api/kernels/{kernel_id}/channels?token={self.valves.JUPYTER_TOKEN}"
-
-            # create a WebSocket connection
-            ws = websocket.create_connection(ws_url)
-
-            # unique ID for the request (required by Jupyter)
-            msg_id = uuid.uuid4().hex
-
-            # jupyter payload
-            msg = {
-                "header": {
-                    "msg_id": msg_id,
-                    "msg_type": "execute_request",
-                    "version": "5.2",
-                    "session": uuid.uuid4().hex,
-                    "username": user_id,
-                    "date": time.strftime("%Y-%m-%d-%H:%M:%S"),
-                },
-                "metadata": {},
-                "content": {
-                    "code": WRAPPER_CODE,
-                    "silent": False,  # fixed: was using undefined 'silent' variable
-                    "store_history": False,
-                    "user_expressions": {},
-                    "allow_stdin": False,
+    def __init__(self):
+        self.counters: dict[tuple, float] = {}
+        # (name, labels) -> bucket counts followed by sum and count
+        self.histograms: dict[tuple, list] = {}
+        # (weak reference to an owner, function returning its [(name, labels, value)]
+        # gauge samples, labels added to every sample); a collected owner drops out
+        self.collectors = []
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    @contextmanager
+    def timer(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("cdproject_stage_seconds", time.perf_counter() - started, stage=stage)
+
+    def add_collector(self, owner, collect, **labels):
+        """
+        report collect(owner) for as long as owner lives, e.g. a Tools instance
+        Open WebUI replaced without telling it
+        """
+        self.collectors.append((weakref.ref(owner), collect, tuple(sorted(labels.items()))))
+
+    @staticmethod
+    def _labels(labels) -> str:
+        if not labels:
+            return ""
+        pairs = []
+        for name, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            pairs.append(f'{name}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+
+    def render(self) -> str:
+        samples = {name: [] for name in METRIC_FAMILIES}
+        for (name, labels), value in self.counters.items():
+            samples[name].append(f"{name}{self._labels(labels)} {value:g}")
+        for (name, labels), histogram in self.histograms.items():
+            for bound, count in zip(self.BUCKETS + ("+Inf",), histogram[:-2] + [histogram[-1]]):
+                bucket_labels = labels + (("le", bound if isinstance(bound, str) else f"{bound:g}"),)
+                samples[name].append(f"{name}_bucket{self._labels(bucket_labels)} {count}")
+            samples[name].append(f"{name}_sum{self._labels(labels)} {histogram[-2]:.6f}")
+            samples[name].append(f"{name}_count{self._labels(labels)} {histogram[-1]}")
+        for reference, collect, owner_labels in list(self.collectors):
+            owner = reference()
+            if owner is None:
+                self.collectors.remove((reference, collect, owner_labels))
+                continue
+            for name, labels, value in collect(owner):
+                labels = tuple(sorted({**labels, **dict(owner_labels)}.items()))
+                samples[name].append(f"{name}{self._labels(labels)} {value:g}")
+
+        lines = []
+        for name, (kind, description) in METRIC_FAMILIES.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples[name])
+        return "\n".join(lines) + "\n"
+
+    def _write(self, path: str, text: str):
+        # written aside and renamed, a scraper never reads half a file
+        with open(path + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+    async def write(self, path: str):
+        await asyncio.to_thread(self._write, path, self.render())
+
+
+# process wide registry, shared by every Tools instance
+METRICS = MetricsRegistry()
+
+
+# ================== KERNEL POOL ==================
+
+
+def spawn(tasks: set, coroutine) -> asyncio.Task:
+    """
+    run a coroutine in the background; asyncio only keeps weak references to
+    tasks, so the set holds it until it finishes and its error is logged
+    """
+    task = asyncio.create_task(coroutine)
+    tasks.add(task)
+
+    def done(task: asyncio.Task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.getLogger(__name__).info(f"Background task failed: {task.exception()!r}")
+
+    task.add_done_callback(done)
+    return task
+
+
+class ExecutionTimeout(Exception):
+    """
+    raised when an execution runs past its wall-clock or idle timeout
+    """
+
+
+class BackendUnavailable(Exception):
+    """
+    raised when a kernel cannot be checked out because its server is unreachable,
+    before any code was sent, so the request can safely go to another server
+    """
+
+
+class KernelChannel:
+    """
+    long-lived channels websocket to one kernel, shared by every execution on it;
+    a reader task routes each message to the caller waiting on its parent msg_id
+    """
+
+    def __init__(self, ws: aiohttp.ClientWebSocketResponse):
+        self.ws = ws
+        self.waiters: dict[str, asyncio.Queue] = {}
+        self.reader = asyncio.create_task(self._read())
+
+    @property
+    def closed(self) -> bool:
+        return self.ws.closed or self.reader.done()
+
+    async def _read(self):
+        error = Exception("Kernel channel closed unexpectedly")
+        try:
+            async for raw_msg in self.ws:
+                if raw_msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                response_msg = json.loads(raw_msg.data)
+                queue = self.waiters.get(response_msg.get("parent_header", {}).get("msg_id"))
+                # messages of abandoned (e.g. timed out) requests are dropped
+                if queue is not None:
+                    queue.put_nowait(response_msg)
+        except Exception as e:
+            error = e
+        finally:
+            # wake every waiting caller, the channel is gone
+            for queue in self.waiters.values():
+                queue.put_nowait(error)
+
+    def subscribe(self, msg_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self.waiters[msg_id] = queue
+        return queue
+
+    def unsubscribe(self, msg_id: str):
+        self.waiters.pop(msg_id, None)
+
+    async def close(self):
+        self.reader.cancel()
+        await self.ws.close()
+
+
+class JupyterClient:
+    """
+    asyncio client for the Jupyter kernel REST API and channels websocket,
+    keeping one keep-alive HTTP session and one channels connection per kernel
+    """
+
+    def __init__(self, jupyter_url: str, jupyter_token: str):
+        self.jupyter_url = jupyter_url.rstrip("/")
+        self.jupyter_token = jupyter_token
+        self.name = self.jupyter_url
+        self.headers = {
+            "Authorization": f"token {jupyter_token}",
+            "Content-Type": "application/json",
+        }
+        self.kernel_url = f"{self.jupyter_url}/api/kernels"
+        self.session: aiohttp.ClientSession = None
+        self.channels: dict[str, KernelChannel] = {}
+        self.channels_lock = asyncio.Lock()
+
+    def matches(self, valves) -> bool:
+        return valves.EXECUTION_BACKEND.lower() != "local" and jupyter_backends(valves) == [
+            (self.jupyter_url, self.jupyter_token)
+        ]
+
+    def ws_url(self, kernel_id: str) -> str:
+        host = self.jupyter_url.replace("https://", "").replace("http://", "")
+        scheme = "wss" if self.jupyter_url.startswith("https://") else "ws"
+        return f"{scheme}://{host}/api/kernels/{kernel_id}/channels?token={self.jupyter_token}"
+
+    def _session(self) -> aiohttp.ClientSession:
+        # created lazily, a session has to be made inside the running loop
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=60),
+            )
+        return self.session
+
+    async def _channel(self, kernel_id: str) -> KernelChannel:
+        async with self.channels_lock:
+            channel = self.channels.get(kernel_id)
+            if channel is None or channel.closed:
+                with METRICS.timer("channel_connect"):
+                    ws = await self._session().ws_connect(
+                        self.ws_url(kernel_id), max_msg_size=0, heartbeat=30
+                    )
+                channel = self.channels[kernel_id] = KernelChannel(ws)
+            return channel
+
+    async def _close_channel(self, kernel_id: str):
+        channel = self.channels.pop(kernel_id, None)
+        if channel is not None:
+            await channel.close()
+
+    async def close(self):
+        for kernel_id in list(self.channels):
+            await self._close_channel(kernel_id)
+        if self.session is not None:
+            await self.session.close()
+
+    async def is_up(self) -> bool:
+        """
+        whether the server answers its status endpoint
+        """
+        try:
+            async with self._session().get(
+                f"{self.jupyter_url}/api/status", timeout=aiohttp.ClientTimeout(total=5)
+            ) as response:
+                return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def start_kernel(self) -> str:
+        async with self._session().post(self.kernel_url, json={"name": "python3"}) as response:
+            if response.status != 201:
+                raise Exception(f"Failed to create kernel: {await response.text()}")
+            return (await response.json())["id"]
+
+    async def get_kernel(self, kernel_id: str) -> dict:
+        """
+        kernel model, or None when the server does not know the kernel
+        """
+        async with self._session().get(f"{self.kernel_url}/{kernel_id}") as response:
+            if response.status != 200:
+                return None
+            return await response.json()
+
+    async def shutdown_kernel(self, kernel_id: str):
+        await self._close_channel(kernel_id)
+        async with self._session().delete(f"{self.kernel_url}/{kernel_id}") as response:
+            response.raise_for_status()
+
+    async def interrupt_kernel(self, kernel_id: str):
+        async with self._session().post(f"{self.kernel_url}/{kernel_id}/interrupt") as response:
+            response.raise_for_status()
+
+    async def restart_kernel(self, kernel_id: str):
+        await self._close_channel(kernel_id)
+        async with self._session().post(f"{self.kernel_url}/{kernel_id}/restart") as response:
+            response.raise_for_status()
+
+    async def execute(
+        self,
+        kernel_id: str,
+        code: str,
+        username: str,
+        timeout: float = 0,
+        idle_timeout: float = 0,
+        traceparent: str = None,
+    ):
+        """
+        send an execute_request and yield every message that belongs to it,
+        ending once the kernel has replied and reports idle again
+
+        raises ExecutionTimeout after `timeout` seconds in total or `idle_timeout`
+        seconds without any message from the kernel (0 disables either limit)
+        """
+        msg_id = uuid.uuid4().hex
+        channel = await self._channel(kernel_id)
+        queue = channel.subscribe(msg_id)
+        try:
+            await channel.ws.send_str(json.dumps(build_execute_request(msg_id, code, username, traceparent)))
+            async for response_msg in receive_execution(queue, timeout, idle_timeout):
+                yield response_msg
+        finally:
+            channel.unsubscribe(msg_id)
+
+
+async def receive_execution(queue: asyncio.Queue, timeout: float, idle_timeout: float):
+    """
+    yield the messages of one execution from its queue, ending once the kernel
+    has replied and reports idle again; raises ExecutionTimeout after `timeout`
+    seconds in total or `idle_timeout` seconds without any message
+    """
+    replied = idle = False
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        wait = idle_timeout or None
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0.0)
+            wait = remaining if wait is None else min(wait, remaining)
+
+        try:
+            response_msg = await asyncio.wait_for(queue.get(), wait)
+        except asyncio.TimeoutError:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise ExecutionTimeout(f"Execution exceeded the {timeout:g}s time limit")
+            raise ExecutionTimeout(f"Kernel produced no output for {idle_timeout:g}s")
+
+        # the reader hands over its exception when the channel dies
+        if isinstance(response_msg, Exception):
+            raise response_msg
+
+        yield response_msg
+
+        # iopub idle and the shell execute_reply may arrive in either order
+        msg_type = response_msg.get("msg_type")
+        if msg_type == "execute_reply":
+            replied = True
+        elif (
+            msg_type == "status"
+            and response_msg.get("content", {}).get("execution_state") == "idle"
+        ):
+            idle = True
+        if replied and idle:
+            return
+
+
+# ================== LOCAL BACKEND ==================
+
+# all of Open WebUI's environment the local workers get
+LOCAL_WORKER_ENV = ("PATH", "HOME", "LANG")
+
+# fork server of the local backend: imports IPython and the document libraries
+# once, then forks a worker per kernel; each worker runs an InteractiveShell
+# that speaks the Jupyter message shapes over a unix socket, so the wrapper,
+# the bootstrap module and KernelPool work unchanged
+LOCAL_FORK_SERVER_CODE = r'''
+import threading
+import socket
+import signal
+import json
+import sys
+import io
+import os
+
+socket_path, preload, scratch_dir = sys.argv[1], sys.argv[2], sys.argv[3]
+
+from IPython.core.interactiveshell import InteractiveShell
+from IPython.core.displaypub import DisplayPublisher
+from traitlets.config import Config
+
+# shared copy-on-write by every worker
+for name in filter(None, (name.strip() for name in preload.split(","))):
+    try:
+        __import__(name)
+    except Exception:
+        pass
+
+connection = None
+send_lock = threading.Lock()
+current = {"msg_id": None}
+
+
+def send(msg_type, content):
+    message = {"msg_type": msg_type, "parent_header": {"msg_id": current["msg_id"]}, "content": content}
+    data = (json.dumps(message, default=str) + "\n").encode("utf-8")
+    with send_lock:
+        connection.sendall(data)
+
+
+class WorkerDisplayPublisher(DisplayPublisher):
+    def publish(self, data, metadata=None, source=None, *, transient=None, update=False, **kwargs):
+        send("display_data", {"data": data, "metadata": metadata or {}, "transient": transient or {}})
+
+    def clear_output(self, wait=False):
+        pass
+
+
+class WorkerShell(InteractiveShell):
+    def _showtraceback(self, etype, evalue, stb):
+        send("error", {"ename": getattr(etype, "__name__", str(etype)), "evalue": str(evalue), "traceback": stb})
+
+
+class WorkerStream(io.TextIOBase):
+    def __init__(self, name):
+        self.name = name
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if text:
+            send("stream", {"name": self.name, "text": text})
+        return len(text)
+
+
+# no history thread, the fork server has to stay single threaded
+config = Config()
+config.HistoryManager.enabled = False
+shell = WorkerShell.instance(config=config)
+shell.display_pub = WorkerDisplayPublisher(shell=shell, parent=shell)
+
+
+def run_worker(kernel_id):
+    global connection
+    try:
+        sys.stdin = open(os.devnull)
+        # relative paths (e.g. files the code saves besides the document) stay in the worker's own folder
+        os.makedirs(os.path.join(scratch_dir, kernel_id), exist_ok=True)
+        os.chdir(os.path.join(scratch_dir, kernel_id))
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socket_path)
+        connection.sendall((json.dumps({"kernel_id": kernel_id, "pid": os.getpid()}) + "\n").encode("utf-8"))
+        sys.stdout = WorkerStream("stdout")
+        sys.stderr = WorkerStream("stderr")
+        requests = connection.makefile("rb")
+        while True:
+            try:
+                line = requests.readline()
+            except KeyboardInterrupt:
+                # an interrupt that arrived after the cell finished
+                continue
+            if not line:
+                return
+            request = json.loads(line)
+            current["msg_id"] = request["msg_id"]
+            shell.parent_header = {"header": request["header"]}
+            send("status", {"execution_state": "busy"})
+            try:
+                status = "ok" if shell.run_cell(request["code"], store_history=False).success else "error"
+            except KeyboardInterrupt:
+                status = "error"
+            send("execute_reply", {"status": status})
+            send("status", {"execution_state": "idle"})
+    finally:
+        os._exit(0)
+
+
+# workers are reaped by the kernel, they reset this before running any code
+signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+for line in sys.stdin:
+    kernel_id = line.strip()
+    if kernel_id and os.fork() == 0:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        run_worker(kernel_id)
+'''
+
+
+class LocalKernel:
+    """
+    connection to one forked worker; a reader task routes each message to the
+    caller waiting on its parent msg_id and tracks the execution state
+    """
+
+    def __init__(self, pid: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.pid = pid
+        self.writer = writer
+        self.state = "idle"
+        # the worker closed its end, so it exited and its pid may already be reused
+        self.exited = False
+        self.waiters: dict[str, asyncio.Queue] = {}
+        self.reader = asyncio.create_task(self._read(reader))
+
+    async def _read(self, reader: asyncio.StreamReader):
+        error = Exception("Local kernel exited unexpectedly")
+        try:
+            while line := await reader.readline():
+                response_msg = json.loads(line)
+                if response_msg["msg_type"] == "status":
+                    self.state = response_msg["content"]["execution_state"]
+                queue = self.waiters.get(response_msg["parent_header"]["msg_id"])
+                # messages of abandoned (e.g. timed out) requests are dropped
+                if queue is not None:
+                    queue.put_nowait(response_msg)
+            self.exited = True
+        except Exception as e:
+            error = e
+        finally:
+            self.state = "dead"
+            for queue in self.waiters.values():
+                queue.put_nowait(error)
+
+    def subscribe(self, msg_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self.waiters[msg_id] = queue
+        return queue
+
+    def unsubscribe(self, msg_id: str):
+        self.waiters.pop(msg_id, None)
+
+    def kill(self):
+        self.reader.cancel()
+        self.writer.close()
+        if self.exited:
+            return
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+class LocalKernelClient:
+    """
+    kernels as processes forked from a local fork server that already imported
+    the document libraries, with the same interface as JupyterClient; skips the
+    REST/websocket hop, for trusted single-tenant deployments (the workers run
+    as the Open WebUI user, only the execution quotas contain them)
+    """
+
+    def __init__(self, data_dir: str, preload: str):
+        if not data_dir:
+            # the workers would write documents and scratch files into Open WebUI's own folders
+            raise ValueError("EXECUTION_BACKEND 'local' needs DATA_DIR")
+        self.name = "local"
+        self.data_dir = data_dir
+        self.preload = preload
+        self.kernels: dict[str, LocalKernel] = {}
+        self.pending: dict[str, asyncio.Future] = {}
+        self.fork_server: asyncio.subprocess.Process = None
+        self.listener: asyncio.AbstractServer = None
+        self.socket_dir: str = None
+        # working directory of each worker, removed with the kernel
+        self.scratch_dir = os.path.join(data_dir, "scratch")
+        self.lock = asyncio.Lock()
+
+    def matches(self, valves) -> bool:
+        return valves.EXECUTION_BACKEND.lower() == "local" and (valves.DATA_DIR, valves.LOCAL_PRELOAD_MODULES) == (
+            self.data_dir,
+            self.preload,
+        )
+
+    async def _ensure_fork_server(self):
+        async with self.lock:
+            if self.fork_server is not None and self.fork_server.returncode is None:
+                return
+            await self._stop_fork_server()
+            self.socket_dir = tempfile.mkdtemp(prefix="cdproject-")
+            socket_path = os.path.join(self.socket_dir, "kernels.sock")
+            # display data (e.g. profiles) can make long lines
+            self.listener = await asyncio.start_unix_server(self._accept, socket_path, limit=64 * 1024 * 1024)
+            # the workers get none of Open WebUI's settings and secrets
+            env = {name: os.environ[name] for name in LOCAL_WORKER_ENV if name in os.environ}
+            env["CDPROJECT_USER_FILES_DIR"] = os.path.join(self.data_dir, "user_files")
+            env["CDPROJECT_TEMPLATES_DIR"] = os.path.join(self.data_dir, "templates")
+            self.fork_server = await asyncio.create_subprocess_exec(
+                sys.executable,
+                "-c",
+                LOCAL_FORK_SERVER_CODE,
+                socket_path,
+                self.preload,
+                self.scratch_dir,
+                stdin=asyncio.subprocess.PIPE,
+                env=env,
+                # keep Ctrl+C of Open WebUI away from the workers
+                start_new_session=True,
+            )
+
+    async def _stop_fork_server(self):
+        if self.fork_server is not None:
+            if self.fork_server.returncode is None:
+                self.fork_server.stdin.close()
+                self.fork_server.kill()
+                await self.fork_server.wait()
+            self.fork_server = None
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        if self.socket_dir is not None:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+            self.socket_dir = None
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        hello = json.loads(await reader.readline())
+        future = self.pending.get(hello["kernel_id"])
+        if future is None or future.done():
+            writer.close()
+            return
+        future.set_result(LocalKernel(hello["pid"], reader, writer))
+
+    async def _fork(self, kernel_id: str):
+        await self._ensure_fork_server()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[kernel_id] = future
+        try:
+            self.fork_server.stdin.write(f"{kernel_id}\n".encode("utf-8"))
+            await self.fork_server.stdin.drain()
+            # the first fork waits for the fork server to import the libraries
+            self.kernels[kernel_id] = await asyncio.wait_for(future, 120)
+        finally:
+            self.pending.pop(kernel_id, None)
+
+    async def close(self):
+        for kernel in self.kernels.values():
+            kernel.kill()
+        await asyncio.gather(*(self._remove_scratch(kernel_id) for kernel_id in self.kernels))
+        self.kernels.clear()
+        async with self.lock:
+            await self._stop_fork_server()
+
+    async def _remove_scratch(self, kernel_id: str):
+        await asyncio.to_thread(shutil.rmtree, os.path.join(self.scratch_dir, kernel_id), True)
+
+    async def start_kernel(self) -> str:
+        kernel_id = str(uuid.uuid4())
+        await self._fork(kernel_id)
+        return kernel_id
+
+    async def get_kernel(self, kernel_id: str) -> dict:
+        """
+        kernel model, or None when the worker is gone
+        """
+        kernel = self.kernels.get(kernel_id)
+        if kernel is None or kernel.state == "dead":
+            return None
+        return {"id": kernel_id, "execution_state": kernel.state}
+
+    async def shutdown_kernel(self, kernel_id: str):
+        kernel = self.kernels.pop(kernel_id, None)
+        if kernel is not None:
+            kernel.kill()
+            await self._remove_scratch(kernel_id)
+
+    async def interrupt_kernel(self, kernel_id: str):
+        kernel = self.kernels.get(kernel_id)
+        if kernel is None or kernel.state == "dead":
+            raise Exception(f"Local kernel {kernel_id} is not running")
+        os.kill(kernel.pid, signal.SIGINT)
+
+    async def restart_kernel(self, kernel_id: str):
+        # a fresh fork under the same id, the pool bootstraps it again
+        await self.shutdown_kernel(kernel_id)
+        await self._fork(kernel_id)
+
+    async def execute(
+        self,
+        kernel_id: str,
+        code: str,
+        username: str,
+        timeout: float = 0,
+        idle_timeout: float = 0,
+        traceparent: str = None,
+    ):
+        """
+        same contract as JupyterClient.execute
+        """
+        kernel = self.kernels.get(kernel_id)
+        if kernel is None or kernel.state == "dead":
+            raise Exception(f"Local kernel {kernel_id} is not running")
+
+        msg_id = uuid.uuid4().hex
+        queue = kernel.subscribe(msg_id)
+        try:
+            request = build_execute_request(msg_id, code, username, traceparent)
+            kernel.writer.write(
+                (json.dumps({"msg_id": msg_id, "header": request["header"], "code": code}) + "\n").encode("utf-8")
+            )
+            await kernel.writer.drain()
+            async for response_msg in receive_execution(queue, timeout, idle_timeout):
+                yield response_msg
+        finally:
+            kernel.unsubscribe(msg_id)
+
+
+def jupyter_backends(valves) -> list:
+    """
+    (url, token) of every server in JUPYTER_URL, a comma separated list;
+    JUPYTER_TOKEN holds one token for all of them or one per server
+    """
+    urls = [url.strip().rstrip("/") for url in valves.JUPYTER_URL.split(",") if url.strip()]
+    tokens = [token.strip() for token in valves.JUPYTER_TOKEN.split(",")]
+    if not urls:
+        raise ValueError("JUPYTER_URL is empty")
+    if len(tokens) == 1:
+        tokens = tokens * len(urls)
+    elif len(tokens) != len(urls):
+        raise ValueError("JUPYTER_TOKEN needs one token, or one per JUPYTER_URL server")
+    return list(zip(urls, tokens))
+
+
+@dataclass
+class PooledKernel:
+    """
+    bookkeeping for a single kernel owned by the pool
+    """
+    id: str
+    created_at: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+    executions: int = 0
+    max_rss_mb: float = 0.0
+    # user/chat key the kernel is bound to, None while it is unbound
+    affinity: str = None
+    # executions currently running on the kernel, it is never shut down while > 0
+    in_flight: int = 0
+    # shut the kernel down as soon as its in-flight executions finish
+    retired: bool = False
+
+
+class KernelLedger:
+    """
+    ids of the kernels a pool started on one Jupyter server, kept in
+    DATA_DIR/kernel_pools under a lock that lives as long as the pool; Open
+    WebUI drops the tool without closing it on a restart or reload, so the next
+    pool shuts down the kernels of records nobody holds the lock of anymore
+    """
+
+    def __init__(self, data_dir: str, backend: str):
+        self.folder = os.path.join(data_dir, "kernel_pools")
+        self.path = os.path.join(self.folder, f"{uuid.uuid4().hex}.json")
+        self.backend = backend
+        self.kernels: list[str] = []
+        # created with the first kernel, locked until the pool closes or is garbage collected
+        self.file = None
+        self.lock = asyncio.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    # ---------------- blocking helpers, run in a worker thread ----------------
+
+    def _open(self):
+        os.makedirs(self.folder, exist_ok=True)
+        # locked before it gets its name, so no other pool ever sees it unlocked
+        file = open(f"{self.path}.tmp", "w")
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.replace(f"{self.path}.tmp", self.path)
+        self.file = file
+        weakref.finalize(self, file.close)
+
+    def _save(self):
+        if self.file is None:
+            self._open()
+        if self.file.closed:
+            return
+        self.file.seek(0)
+        self.file.truncate()
+        json.dump({"backend": self.backend, "kernels": self.kernels}, self.file)
+        self.file.flush()
+
+    def _close(self):
+        if self.file is None or self.file.closed:
+            return
+        # kernels that could not be shut down are left to the next pool
+        if not self.kernels:
+            os.remove(self.path)
+        self.file.close()
+
+    def _abandoned(self) -> list:
+        try:
+            names = os.listdir(self.folder)
+        except FileNotFoundError:
+            return []
+        kernel_ids = []
+        for name in names:
+            path = os.path.join(self.folder, name)
+            if not name.endswith(".json") or path == self.path:
+                continue
+            try:
+                with open(path) as file:
+                    fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    if os.fstat(file.fileno()).st_nlink == 0:
+                        # another pool cleaned it up while this one waited for the lock
+                        continue
+                    try:
+                        record = json.load(file)
+                    except ValueError:
+                        record = None
+                    if record is not None and record.get("backend") != self.backend:
+                        continue
+                    if record is not None:
+                        kernel_ids += record.get("kernels", [])
+                    os.remove(path)
+            except (BlockingIOError, FileNotFoundError):
+                # the pool that owns it is alive, or it was closed in the meantime
+                continue
+        return kernel_ids
+
+    # ---------------- recording ----------------
+
+    async def add(self, kernel_id: str):
+        async with self.lock:
+            self.kernels.append(kernel_id)
+            try:
+                await asyncio.to_thread(self._save)
+            except OSError as e:
+                self.logger.info(f"Failed to record kernel {kernel_id}: {e}")
+
+    async def remove(self, kernel_id: str):
+        async with self.lock:
+            if kernel_id not in self.kernels:
+                return
+            self.kernels.remove(kernel_id)
+            try:
+                await asyncio.to_thread(self._save)
+            except OSError as e:
+                self.logger.info(f"Failed to record the shutdown of kernel {kernel_id}: {e}")
+
+    async def close(self):
+        async with self.lock:
+            try:
+                await asyncio.to_thread(self._close)
+            except OSError as e:
+                self.logger.info(f"Failed to remove kernel record {self.path}: {e}")
+
+    async def abandoned(self) -> list:
+        """
+        ids of kernels on this server recorded by pools that are gone, their records are removed
+        """
+        try:
+            return await asyncio.to_thread(self._abandoned)
+        except OSError as e:
+            self.logger.info(f"Failed to read the kernel records in {self.folder}: {e}")
+            return []
+
+
+class KernelPool:
+    """
+    pre-started, pre-warmed kernels that requests check out and return, on
+    the backend of its client (JupyterClient or LocalKernelClient)
+
+    every checkout gets a kernel to itself; with an affinity key a kernel is
+    bound to the first user/chat it serves and never handed to anybody else
+    """
+
+    def __init__(self, client, ledger: KernelLedger = None):
+        self.client = client
+        # records the kernels for the pool that follows a restart, None when DATA_DIR is unset
+        self.ledger = ledger
+        self.idle: list[PooledKernel] = []
+        self.busy: dict[str, PooledKernel] = {}
+        self.starting = 0
+        # checkouts that hold (or are starting) a kernel, bounded by MAX_CONCURRENT_EXECUTIONS
+        self.running = 0
+        self.closed = False
+        # reclaims of kernels whose request was cancelled
+        self.tasks: set[asyncio.Task] = set()
+        # versions of the document libraries, as reported by the last bootstrap
+        self.library_versions: dict = None
+        self.condition = asyncio.Condition()
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def size(self) -> int:
+        return len(self.idle) + len(self.busy) + self.starting
+
+    def collect(self) -> list:
+        """
+        gauge samples for the metrics registry
+        """
+        backend = self.client.name
+        return [
+            ("cdproject_pool_kernels", {"backend": backend, "state": "idle"}, len(self.idle)),
+            ("cdproject_pool_kernels", {"backend": backend, "state": "busy"}, len(self.busy)),
+            ("cdproject_pool_kernels", {"backend": backend, "state": "starting"}, self.starting),
+            ("cdproject_pool_running", {"backend": backend}, self.running),
+        ]
+
+    def matches(self, valves) -> bool:
+        return self.client.matches(valves)
+
+    # ---------------- kernel lifecycle ----------------
+
+    async def _start_kernel(self) -> PooledKernel:
+        with METRICS.timer("kernel_start"):
+            kernel = PooledKernel(id=await self.client.start_kernel())
+        self.logger.info(f"Created kernel with id {kernel.id}")
+
+        # install the bootstrap module before anybody can check the kernel out
+        try:
+            if self.ledger is not None:
+                await self.ledger.add(kernel.id)
+            with METRICS.timer("bootstrap"):
+                await self._bootstrap(kernel)
+        except BaseException:
+            await self._shutdown_kernel(kernel)
+            raise
+        return kernel
+
+    async def _bootstrap(self, kernel: PooledKernel):
+        async with aclosing(
+            self.client.execute(kernel.id, KERNEL_BOOTSTRAP_CODE, "kernel-pool", idle_timeout=120)
+        ) as messages:
+            async for response_msg in messages:
+                if response_msg.get("msg_type") == "error":
+                    content = response_msg.get("content", {})
+                    raise Exception(f"Kernel bootstrap failed: {content.get('ename')} - {content.get('evalue')}")
+                if response_msg.get("msg_type") == "display_data":
+                    result = response_msg.get("content", {}).get("data", {}).get(RESULT_MIME_TYPE, {})
+                    if "versions" in result:
+                        self.library_versions = result["versions"]
+
+    async def _wait_until_idle(self, kernel: PooledKernel, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            model = await self.client.get_kernel(kernel.id)
+            if model is None or model.get("execution_state") == "dead":
+                return False
+            if model.get("execution_state") == "idle":
+                return True
+            await asyncio.sleep(0.2)
+        return False
+
+    async def _shutdown_kernel(self, kernel: PooledKernel):
+        if kernel.in_flight:
+            # somebody is still executing on it, the last checkin shuts it down
+            kernel.retired = True
+            return
+
+        self.logger.info(f"Shutting down kernel with ID: {kernel.id}")
+        try:
+            with METRICS.timer("kernel_shutdown"):
+                await self.client.shutdown_kernel(kernel.id)
+            self.logger.info("Kernel shut down successfully.")
+        except aiohttp.ClientError as e:
+            self.logger.info(f"Failed to shut down kernel: {e}")
+            return
+        if self.ledger is not None:
+            await self.ledger.remove(kernel.id)
+
+    async def shut_down_abandoned(self):
+        """
+        shut down the kernels that pools before a restart or reload left running on the server
+        """
+        if self.ledger is None:
+            return
+        for kernel_id in await self.ledger.abandoned():
+            self.logger.info(f"Shutting down abandoned kernel with ID: {kernel_id}")
+            try:
+                await self.client.shutdown_kernel(kernel_id)
+            except aiohttp.ClientError as e:
+                # usually the server was restarted as well and the kernel is gone
+                self.logger.info(f"Failed to shut down abandoned kernel: {e}")
+
+    async def _is_healthy(self, kernel: PooledKernel) -> bool:
+        try:
+            model = await self.client.get_kernel(kernel.id)
+        except aiohttp.ClientError:
+            return False
+        return bool(model) and model.get("execution_state") not in ("dead", "restarting")
+
+    def _should_recycle(self, kernel: PooledKernel, valves) -> bool:
+        if kernel.retired or self.closed:
+            return True
+        if kernel.executions >= valves.KERNEL_MAX_EXECUTIONS:
+            return True
+        if valves.KERNEL_MAX_MEMORY_MB and kernel.max_rss_mb >= valves.KERNEL_MAX_MEMORY_MB:
+            return True
+        return False
+
+    # ---------------- scheduling ----------------
+
+    def _take_idle(self, affinity: str) -> PooledKernel:
+        """
+        most recently used idle kernel bound to the affinity key, else a fresh unbound one
+        """
+        for i in range(len(self.idle) - 1, -1, -1):
+            if self.idle[i].affinity == affinity:
+                return self.idle.pop(i)
+
+        if affinity is not None:
+            for i in range(len(self.idle) - 1, -1, -1):
+                if self.idle[i].affinity is None and self.idle[i].executions == 0:
+                    kernel = self.idle.pop(i)
+                    kernel.affinity = affinity
+                    return kernel
+        return None
+
+    def _take_evictable(self, affinity: str) -> PooledKernel:
+        """
+        least recently used idle kernel that can never serve the affinity key
+        """
+        candidates = [kernel for kernel in self.idle if kernel.affinity != affinity]
+        if not candidates:
+            return None
+        kernel = min(candidates, key=lambda k: k.last_used)
+        self.idle.remove(kernel)
+        return kernel
+
+    # ---------------- checkout / checkin ----------------
+
+    async def checkout(self, valves, affinity: str = None) -> PooledKernel:
+        """
+        take an idle kernel, start a new one, or wait until one is returned
+        """
+        while True:
+            kernel = None
+            evicted = None
+            async with self.condition:
+                if self.closed:
+                    raise Exception("Kernel pool is closed")
+
+                if self.running >= valves.MAX_CONCURRENT_EXECUTIONS:
+                    # concurrency limit reached, queue until a checkin
+                    await self.condition.wait()
+                    continue
+
+                kernel = self._take_idle(affinity)
+                if kernel is None:
+                    if self.size >= valves.KERNEL_POOL_MAX_SIZE:
+                        # make room by evicting a kernel bound to somebody else
+                        evicted = self._take_evictable(affinity)
+                        if evicted is None:
+                            # pool is exhausted, wait for a checkin
+                            await self.condition.wait()
+                            continue
+                    self.starting += 1
+                else:
+                    kernel.in_flight += 1
+                    self.busy[kernel.id] = kernel
+                self.running += 1
+
+            if evicted is not None:
+                await self._shutdown_kernel(evicted)
+
+            if kernel is not None:
+                idle_for = time.monotonic() - kernel.last_used
+                if idle_for < valves.KERNEL_HEALTH_CHECK_INTERVAL or await self._is_healthy(kernel):
+                    return kernel
+                self.logger.info(f"Kernel {kernel.id} failed health check, discarding")
+                await self.discard(kernel)
+                continue
+
+            try:
+                kernel = await self._start_kernel()
+            except BaseException:
+                async with self.condition:
+                    self.starting -= 1
+                    self.running -= 1
+                    self.condition.notify_all()
+                raise
+
+            async with self.condition:
+                self.starting -= 1
+                self.condition.notify_all()
+                kernel.affinity = affinity
+                kernel.in_flight += 1
+                self.busy[kernel.id] = kernel
+            return kernel
+
+    async def checkin(self, kernel: PooledKernel, valves, max_rss_mb: float = None):
+        """
+        hand a kernel back, recycling it when it is worn out
+        """
+        kernel.executions += 1
+        kernel.last_used = time.monotonic()
+        if max_rss_mb:
+            kernel.max_rss_mb = max(kernel.max_rss_mb, max_rss_mb)
+
+        async with self.condition:
+            kernel.in_flight -= 1
+            self.busy.pop(kernel.id, None)
+            self.running -= 1
+            recycle = self._should_recycle(kernel, valves)
+            if not recycle:
+                self.idle.append(kernel)
+            self.condition.notify_all()
+
+        if recycle:
+            self.logger.info(
+                f"Recycling kernel {kernel.id} after {kernel.executions} executions "
+                f"({kernel.max_rss_mb:.0f} MB peak RSS)"
+            )
+            await self._shutdown_kernel(kernel)
+        await self._close_client_if_drained()
+
+    async def discard(self, kernel: PooledKernel):
+        """
+        drop a checked out kernel that is in an unknown state (e.g. the websocket broke)
+        """
+        async with self.condition:
+            kernel.in_flight -= 1
+            self.busy.pop(kernel.id, None)
+            self.running -= 1
+            self.condition.notify_all()
+        await self._shutdown_kernel(kernel)
+        await self._close_client_if_drained()
+
+    async def _close_client_if_drained(self):
+        # a closed pool releases its connections once the last busy kernel is back
+        if self.closed and not self.busy and not self.starting:
+            await self.client.close()
+            if self.ledger is not None:
+                await self.ledger.close()
+
+    async def reclaim(self, kernel: PooledKernel, valves):
+        """
+        get a checked out kernel back from a runaway or abandoned execution:
+        interrupt it, restart it when the interrupt does not land, and only
+        drop it when neither works
+        """
+        try:
+            self.logger.info(f"Interrupting kernel {kernel.id}")
+            await self.client.interrupt_kernel(kernel.id)
+            if await self._wait_until_idle(kernel, valves.INTERRUPT_GRACE_PERIOD):
+                await self.checkin(kernel, valves)
+                return
+
+            self.logger.info(f"Kernel {kernel.id} ignored the interrupt, restarting it")
+            await self.client.restart_kernel(kernel.id)
+            # a restart wipes sys.modules, so the bootstrap has to be installed again
+            await self._bootstrap(kernel)
+            kernel.max_rss_mb = 0.0
+            await self.checkin(kernel, valves)
+        except Exception as e:
+            self.logger.info(f"Failed to reclaim kernel {kernel.id}: {e}")
+            await self.discard(kernel)
+
+    async def fill(self, valves):
+        """
+        top the pool up to its minimum number of unbound warm kernels
+        """
+        while True:
+            async with self.condition:
+                # with affinity every used kernel is bound, so unbound ones are fresh
+                unbound = sum(1 for k in self.idle if k.affinity is None)
+                if (
+                    self.closed
+                    or unbound + self.starting >= valves.KERNEL_POOL_MIN_SIZE
+                    or self.size >= valves.KERNEL_POOL_MAX_SIZE
+                ):
+                    return
+                self.starting += 1
+
+            try:
+                kernel = await self._start_kernel()
+            except Exception as e:
+                self.logger.info(f"Failed to pre-start kernel: {e}")
+                async with self.condition:
+                    self.starting -= 1
+                    self.condition.notify_all()
+                await self._close_client_if_drained()
+                return
+
+            async with self.condition:
+                if not self.closed:
+                    self.starting -= 1
+                    self.idle.append(kernel)
+                    self.condition.notify_all()
+                    continue
+
+            # the pool was closed while the kernel was starting
+            await self._shutdown_kernel(kernel)
+            async with self.condition:
+                self.starting -= 1
+                self.condition.notify_all()
+            await self._close_client_if_drained()
+            return
+
+    # ---------------- execution ----------------
+
+    async def run(self, valves, code: str, username: str, affinity: str, relay, trace) -> tuple:
+        """
+        run wrapper code on a pooled kernel and return (result, error),
+        relaying the kernel output while it runs
+        """
+        with trace.stage("checkout"):
+            try:
+                kernel = await self.checkout(valves, affinity)
+            except (aiohttp.ClientError, OSError) as e:
+                raise BackendUnavailable(f"{self.client.name} is unreachable: {e}") from e
+        self.logger.info(f"Checked out kernel {kernel.id} ({kernel.executions} previous executions)")
+
+        # initialize result variable to capture Jupyter response
+        jupyter_result = None
+        kernel_error = None
+
+        try:
+            self.logger.info("Execution started. Waiting for output...")
+            with trace.stage("execute"):
+                async with aclosing(
+                    self.client.execute(
+                        kernel.id,
+                        code,
+                        username,
+                        timeout=valves.EXECUTION_TIMEOUT,
+                        idle_timeout=valves.EXECUTION_IDLE_TIMEOUT,
+                        traceparent=trace.traceparent if valves.TRACE_CONTEXT else None,
+                    )
+                ) as messages:
+                    async for response_msg in messages:
+                        msg_type = response_msg.get("msg_type")
+
+                        # the kernel picked the code up, report it instead of guessing with sleeps
+                        if (
+                            msg_type == "status"
+                            and response_msg.get("content", {}).get("execution_state") == "busy"
+                        ):
+                            await relay.status(f"Running code on the {self.client.name} backend...")
+
+                        # relay stream output (stdout/stderr from print, etc.) as progress
+                        elif msg_type == "stream":
+                            await relay.push(response_msg.get("content", {}).get("text", ""))
+
+                        # the wrapper result arrives on its own MIME type, other rich output
+                        # (e.g. a displayed DataFrame) is relayed as its plain text form
+                        elif msg_type in ("display_data", "execute_result"):
+                            data = response_msg.get("content", {}).get("data", {})
+                            if RESULT_MIME_TYPE in data:
+                                jupyter_result = data[RESULT_MIME_TYPE]
+                                trace.kernel_stages.update(jupyter_result.get("stages", {}))
+                                self.logger.info(f"RESULT: {jupyter_result}")
+                            else:
+                                await relay.push(data.get("text/plain", ""))
+
+                        # capture errors, the kernel still sends execute_reply and idle afterwards
+                        elif msg_type == "error":
+                            content = response_msg.get("content", {})
+                            kernel_error = f"{content.get('ename')}: {content.get('evalue')}"
+                            trace.error_class = content.get("ename")
+                            self.logger.info(f"ERROR: {kernel_error}")
+                            traceback = content.get("traceback", [])
+                            for line in traceback:
+                                self.logger.info(f"TRACEBACK: {line}")
+
+            # the last lines may still be held back by the throttle
+            await relay.flush()
+            self.logger.info("Execution completed.")
+
+        except ExecutionTimeout as e:
+            # runaway code, interrupt (or restart) the kernel to get it back
+            kernel_error = str(e)
+            trace.error_class = type(e).__name__
+            self.logger.info(f"ERROR: {kernel_error}")
+            with trace.stage("reclaim"):
+                await self.reclaim(kernel, valves)
+            return jupyter_result, kernel_error
+
+        except asyncio.CancelledError:
+            # the Open WebUI request was cancelled, stop the job in the background
+            self.logger.info(f"Request cancelled, reclaiming kernel {kernel.id}")
+            spawn(self.tasks, self.reclaim(kernel, valves))
+            raise
+
+        except Exception as e:
+            # the kernel channel broke, so the kernel state is unknown
+            trace.error_class = type(e).__name__
+            self.logger.info(f"Error while receiving from WebSocket: {e}")
+            await self.discard(kernel)
+            if isinstance(e, aiohttp.ClientConnectorError):
+                # the channel never connected, so the code was not sent
+                raise BackendUnavailable(f"{self.client.name} is unreachable: {e}") from e
+            raise
+
+        # an execution that hit its quota leaves the kernel in doubt, replace it
+        if jupyter_result and jupyter_result.get("recycle"):
+            kernel_error = jupyter_result["message"]
+            trace.error_class = jupyter_result["error_class"]
+            kernel.retired = True
+
+        # return the kernel to the pool
+        max_rss_mb = jupyter_result.get("max_rss_mb") if jupyter_result else None
+        with trace.stage("checkin"):
+            await self.checkin(kernel, valves, max_rss_mb)
+        return jupyter_result, kernel_error
+
+    async def close(self):
+        """
+        shut down idle kernels now and busy ones when they are checked in
+        """
+        async with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            for kernel in self.busy.values():
+                kernel.retired = True
+            self.condition.notify_all()
+
+        for kernel in idle:
+            await self._shutdown_kernel(kernel)
+
+        # kernels that are still starting are shut down by their starter
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.starting)
+
+        # busy kernels still need the connections for their checkin
+        await self._close_client_if_drained()
+
+
+@dataclass
+class JupyterBackend:
+    """
+    one server of a sharded pool and its last known health
+    """
+    pool: KernelPool
+    healthy: bool = True
+    checked_at: float = 0.0
+
+    @property
+    def name(self) -> str:
+        return self.pool.client.name
+
+
+class ShardedKernelPool:
+    """
+    one KernelPool per Jupyter server, with every request routed to a healthy
+    server: the least loaded one, or with JUPYTER_ROUTING "user_hash" the one
+    the user id hashes to (rendezvous hashing, so a server going down only
+    moves its own users); a request fails over to the next server when the
+    chosen one cannot be reached
+    """
+
+    def __init__(self, backends: list, data_dir: str = ""):
+        self.backends = [JupyterBackend(jupyter_pool(url, token, data_dir)) for url, token in backends]
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def idle(self) -> list:
+        return [kernel for backend in self.backends for kernel in backend.pool.idle]
+
+    @property
+    def busy(self) -> dict:
+        return {kernel_id: kernel for backend in self.backends for kernel_id, kernel in backend.pool.busy.items()}
+
+    @property
+    def library_versions(self) -> dict:
+        # the servers are expected to run the same image
+        return next((b.pool.library_versions for b in self.backends if b.pool.library_versions), None)
+
+    def collect(self) -> list:
+        """
+        gauge samples for the metrics registry
+        """
+        samples = [("cdproject_backend_up", {"backend": b.name}, int(b.healthy)) for b in self.backends]
+        return samples + [sample for b in self.backends for sample in b.pool.collect()]
+
+    def matches(self, valves) -> bool:
+        return valves.EXECUTION_BACKEND.lower() != "local" and jupyter_backends(valves) == [
+            (b.pool.client.jupyter_url, b.pool.client.jupyter_token) for b in self.backends
+        ]
+
+    # ---------------- health ----------------
+
+    async def _check(self, backend: JupyterBackend):
+        backend.checked_at = time.monotonic()
+        healthy = await backend.pool.client.is_up()
+        if healthy != backend.healthy:
+            self.logger.info(f"Jupyter backend {backend.name} is {'up' if healthy else 'down'}")
+        backend.healthy = healthy
+
+    async def _refresh(self, valves):
+        """
+        probe the servers whose health is older than JUPYTER_HEALTH_CHECK_INTERVAL
+        """
+        now = time.monotonic()
+        stale = [b for b in self.backends if now - b.checked_at >= valves.JUPYTER_HEALTH_CHECK_INTERVAL]
+        if stale:
+            await asyncio.gather(*(self._check(backend) for backend in stale))
+
+    # ---------------- routing ----------------
+
+    def _route(self, valves, username: str, affinity: str) -> list:
+        """
+        backends in the order a request should try them, healthy ones only
+        unless every server is down
+        """
+        candidates = [b for b in self.backends if b.healthy] or self.backends
+        if valves.JUPYTER_ROUTING.lower() == "user_hash":
+            return sorted(
+                candidates,
+                key=lambda b: hashlib.sha256(f"{b.name}\n{username}".encode()).digest(),
+                reverse=True,
+            )
+        # least loaded first, preferring a server with an idle kernel for the affinity key
+        return sorted(
+            candidates,
+            key=lambda b: (
+                b.pool.running >= valves.MAX_CONCURRENT_EXECUTIONS,
+                not any(kernel.affinity == affinity for kernel in b.pool.idle),
+                b.pool.running,
+            ),
+        )
+
+    async def run(self, valves, code: str, username: str, affinity: str, relay, trace) -> tuple:
+        """
+        run wrapper code on the routed server's pool and return (result, error)
+        """
+        await self._refresh(valves)
+        errors = []
+        for backend in self._route(valves, username, affinity):
+            try:
+                return await backend.pool.run(valves, code, username, affinity, relay, trace)
+            except BackendUnavailable as e:
+                self.logger.info(f"{e}, failing over")
+                errors.append(str(e))
+                backend.healthy = False
+                backend.checked_at = time.monotonic()
+        raise BackendUnavailable(f"No Jupyter backend is reachable ({'; '.join(errors)})")
+
+    async def fill(self, valves):
+        """
+        top up the pool of every healthy server
+        """
+        await self._refresh(valves)
+        await asyncio.gather(*(b.pool.fill(valves) for b in self.backends if b.healthy))
+
+    async def shut_down_abandoned(self):
+        await asyncio.gather(*(backend.pool.shut_down_abandoned() for backend in self.backends))
+
+    async def close(self):
+        await asyncio.gather(*(backend.pool.close() for backend in self.backends))
+
+
+def jupyter_pool(jupyter_url: str, jupyter_token: str, data_dir: str) -> KernelPool:
+    """
+    kernel pool on one Jupyter server, with a kernel ledger when DATA_DIR is set
+    """
+    client = JupyterClient(jupyter_url, jupyter_token)
+    ledger = KernelLedger(data_dir, client.jupyter_url) if data_dir and fcntl is not None else None
+    return KernelPool(client, ledger)
+
+
+def create_pool(valves):
+    """
+    kernel pool of the configured execution backend, sharded when JUPYTER_URL
+    lists several servers
+    """
+    if valves.EXECUTION_BACKEND.lower() == "local":
+        return KernelPool(LocalKernelClient(valves.DATA_DIR, valves.LOCAL_PRELOAD_MODULES))
+    backends = jupyter_backends(valves)
+    if len(backends) == 1:
+        return jupyter_pool(*backends[0], valves.DATA_DIR)
+    return ShardedKernelPool(backends, valves.DATA_DIR)
+
+
+def build_execute_request(msg_id: str, code: str, username: str, traceparent: str = None) -> dict:
+    """
+    jupyter execute_request payload
+    """
+    header = {
+        "msg_id": msg_id,
+        "msg_type": "execute_request",
+        "version": "5.2",
+        "session": uuid.uuid4().hex,
+        "username": username,
+        "date": time.strftime("%Y-%m-%d-%H:%M:%S"),
+    }
+    # W3C trace context, the kernel reports the trace id back with its result
+    if traceparent:
+        header["traceparent"] = traceparent
+    return {
+        "header": header,
+        "metadata": {},
+        "content": {
+            "code": code,
+            "silent": False,
+            "store_history": False,
+            "user_expressions": {},
+            "allow_stdin": False,
+        },
+        "parent_header": {},
+        "buffers": {},
+    }
+
+
+@dataclass
+class CacheEntry:
+    """
+    a document stored in the result cache
+    """
+    path: str
+    size: int
+    created: float
+    last_used: float
+
+
+class ResultCache:
+    """
+    content-addressed store of generated documents inside DATA_DIR; an identical
+    request gets the stored document linked into its chat folder instead of
+    running the code again
+    """
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self.cache_dir = os.path.join(data_dir, "cache", "results")
+        # key -> entry in least recently used order, loaded on first use
+        self.entries: OrderedDict[str, CacheEntry] = None
+        self.size = 0
+        self.lock = asyncio.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def key(code: str, extension: str, library_versions: dict, template: str = "") -> str:
+        # whitespace-only differences between generations do not change the document
+        normalized = "\n".join(line.rstrip() for line in code.strip().splitlines())
+        payload = json.dumps([normalized, extension, library_versions, template], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _load(self) -> OrderedDict:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                key = entry.name.split(".", 1)[0]
+                entries.append((key, CacheEntry(entry.path, stat.st_size, stat.st_mtime, stat.st_mtime)))
+        entries.sort(key=lambda item: item[1].last_used)
+        self.size = sum(entry.size for _, entry in entries)
+        return OrderedDict(entries)
+
+    @staticmethod
+    def _link(source: str, destination: str):
+        # a hard link is free when both live on the same volume, copy otherwise
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copyfile(source, destination)
+
+    def _evict(self, valves) -> list:
+        """
+        drop expired entries and then the least recently used ones until the cache fits,
+        returns the paths to delete
+        """
+        now = time.time()
+        expired = [key for key, entry in self.entries.items() if now - entry.created > valves.RESULT_CACHE_TTL]
+        removed = [self.entries.pop(key) for key in expired]
+        self.size -= sum(entry.size for entry in removed)
+
+        while self.entries and self.size > valves.RESULT_CACHE_MAX_MB * 1024 * 1024:
+            entry = self.entries.popitem(last=False)[1]
+            self.size -= entry.size
+            removed.append(entry)
+        return [entry.path for entry in removed]
+
+    @staticmethod
+    def _remove(paths: list):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def fetch(self, key: str, user_id: str, chat_id: str, extension: str, valves) -> dict:
+        """
+        link the cached document into the chat folder, None on a miss
+        """
+        async with self.lock:
+            if self.entries is None:
+                self.entries = await asyncio.to_thread(self._load)
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry.created > valves.RESULT_CACHE_TTL:
+                await asyncio.to_thread(self._remove, self._evict(valves))
+                return None
+            entry.last_used = time.time()
+            self.entries.move_to_end(key)
+
+        file_name = secrets.token_urlsafe(16) + "." + extension
+        destination = os.path.join(self.data_dir, "user_files", user_id, chat_id, file_name)
+        try:
+            await asyncio.to_thread(self._link, entry.path, destination)
+        except OSError as e:
+            # the stored file disappeared underneath us, forget it
+            self.logger.info(f"Dropping broken cache entry {key}: {e}")
+            async with self.lock:
+                if self.entries.pop(key, None) is not None:
+                    self.size -= entry.size
+            return None
+
+        return {"status": "ok", "file_name": file_name, "size": entry.size, "cached": True}
+
+    async def store(self, key: str, user_id: str, chat_id: str, file_name: str, valves):
+        """
+        keep a generated document for identical requests
+        """
+        source = os.path.join(self.data_dir, "user_files", user_id, chat_id, file_name)
+        destination = os.path.join(self.cache_dir, key + os.path.splitext(file_name)[1])
+        async with self.lock:
+            if self.entries is None:
+                self.entries = await asyncio.to_thread(self._load)
+            if key in self.entries:
+                return
+            try:
+                await asyncio.to_thread(self._link, source, destination)
+                size = (await asyncio.to_thread(os.stat, destination)).st_size
+            except OSError as e:
+                # DATA_DIR does not show the Jupyter volume, nothing to cache
+                self.logger.info(f"Could not cache {file_name}: {e}")
+                return
+            now = time.time()
+            self.entries[key] = CacheEntry(destination, size, now, now)
+            self.size += size
+            evicted = self._evict(valves)
+        await asyncio.to_thread(self._remove, evicted)
+
+
+class ArtifactIndex:
+    """
+    sqlite index of the documents in DATA_DIR/user_files (owner, size, created
+    time, extension), so retention and quotas never walk the directory tree;
+    expired documents are removed by a background sweeper in batches
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS artifacts (
+        path TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        chat_id TEXT NOT NULL,
+        file_name TEXT NOT NULL,
+        extension TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS artifacts_created ON artifacts (created);
+    CREATE INDEX IF NOT EXISTS artifacts_user ON artifacts (user_id, created);
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self.user_files_dir = os.path.join(data_dir, "user_files")
+        self.db_path = os.path.join(data_dir, "artifacts.sqlite3")
+        self.db: sqlite3.Connection = None
+        # the connection is used from worker threads, one statement batch at a time
+        self.lock = asyncio.Lock()
+        self.sweeper: asyncio.Task = None
+        self.valves = None
+        self.logger = logging.getLogger(__name__)
+
+    # ---------------- blocking helpers, run in a worker thread ----------------
+
+    def _connect(self):
+        if self.db is not None:
+            return
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.SCHEMA)
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone() is None:
+            self._import_existing()
+
+    def _import_existing(self):
+        """
+        index the documents created before the index existed, the only full walk
+        """
+        rows = []
+        if os.path.isdir(self.user_files_dir):
+            for user in os.scandir(self.user_files_dir):
+                if not user.is_dir():
+                    continue
+                for chat in os.scandir(user.path):
+                    if not chat.is_dir():
+                        continue
+                    for document in os.scandir(chat.path):
+                        if document.is_file():
+                            stat = document.stat()
+                            rows.append(self._row(user.name, chat.name, document.name, stat.st_size, stat.st_mtime))
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR IGNORE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('imported', ?)", (str(time.time()),))
+        self.logger.info(f"Indexed {len(rows)} existing documents")
+
+    @staticmethod
+    def _row(user_id: str, chat_id: str, file_name: str, size: int, created: float) -> tuple:
+        extension = file_name.split(".", 1)[1] if "." in file_name else ""
+        return (f"{user_id}/{chat_id}/{file_name}", user_id, chat_id, file_name, extension, size, created)
+
+    def _delete(self, paths: list):
+        """
+        remove documents from disk and index, and chat folders left empty
+        """
+        for path in paths:
+            full_path = os.path.join(self.user_files_dir, path)
+            try:
+                os.remove(full_path)
+            except FileNotFoundError:
+                pass
+            try:
+                os.rmdir(os.path.dirname(full_path))
+            except OSError:
+                pass
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("DELETE FROM artifacts WHERE path = ?", [(path,) for path in paths])
+
+    def _record(self, rows: list, quota_bytes: int) -> list:
+        """
+        index new documents and return the owner's oldest ones that no longer fit the quota
+        """
+        self._connect()
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        if not quota_bytes:
+            return []
+
+        user_id = rows[0][1]
+        new_paths = {row[0] for row in rows}
+        (used,) = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts WHERE user_id = ?", (user_id,)).fetchone()
+        evicted = []
+        if used > quota_bytes:
+            for path, size in self.db.execute(
+                "SELECT path, size FROM artifacts WHERE user_id = ? ORDER BY created", (user_id,)
+            ):
+                if used <= quota_bytes:
+                    break
+                if path in new_paths:
+                    continue
+                evicted.append(path)
+                used -= size
+        return evicted
+
+    def _expired(self, before: float, limit: int) -> list:
+        self._connect()
+        rows = self.db.execute(
+            "SELECT path FROM artifacts WHERE created < ? ORDER BY created LIMIT ?", (before, limit)
+        )
+        return [path for (path,) in rows]
+
+    # ---------------- async API ----------------
+
+    async def record(self, user_id: str, chat_id: str, documents: list, valves):
+        """
+        index [(file_name, size)] just written to a chat folder, enforcing the owner's quota
+        """
+        self.valves = valves
+        now = time.time()
+        rows = [self._row(user_id, chat_id, file_name, size, now) for file_name, size in documents]
+        async with self.lock:
+            evicted = await asyncio.to_thread(self._record, rows, valves.USER_QUOTA_MB * 1024 * 1024)
+            if evicted:
+                self.logger.info(f"User {user_id} is over quota, removing {len(evicted)} old documents")
+                await asyncio.to_thread(self._delete, evicted)
+
+        if valves.ARTIFACT_TTL and (self.sweeper is None or self.sweeper.done()):
+            self.sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def sweep(self, valves) -> int:
+        """
+        remove every document older than ARTIFACT_TTL, a batch at a time
+        """
+        removed = 0
+        before = time.time() - valves.ARTIFACT_TTL
+        while True:
+            async with self.lock:
+                expired = await asyncio.to_thread(self._expired, before, valves.ARTIFACT_SWEEP_BATCH)
+                if expired:
+                    await asyncio.to_thread(self._delete, expired)
+            removed += len(expired)
+            # the lock is released between batches, so recording never waits for a whole sweep
+            if len(expired) < valves.ARTIFACT_SWEEP_BATCH:
+                return removed
+
+    async def _sweep_forever(self):
+        while self.valves is not None and self.valves.ARTIFACT_TTL:
+            try:
+                removed = await self.sweep(self.valves)
+                if removed:
+                    self.logger.info(f"Removed {removed} expired documents")
+            except Exception as e:
+                self.logger.info(f"Document sweep failed: {e}")
+            await asyncio.sleep(self.valves.ARTIFACT_SWEEP_INTERVAL)
+
+    async def close(self):
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+        async with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+async def record_artifacts(tools, user_id: str, chat_id: str, documents: list):
+    """
+    hand documents that were just delivered to the lifecycle manager, when enabled
+    """
+    valves = tools.valves
+    if not (valves.ARTIFACT_LIFECYCLE_ENABLED and valves.DATA_DIR):
+        return
+    if tools.artifact_index is None or tools.artifact_index.data_dir != valves.DATA_DIR:
+        if tools.artifact_index is not None:
+            spawn(tools.background_tasks, tools.artifact_index.close())
+        tools.artifact_index = ArtifactIndex(valves.DATA_DIR)
+    try:
+        await tools.artifact_index.record(user_id, chat_id, documents, valves)
+    except Exception as e:
+        # bookkeeping must never fail a delivered document
+        logging.getLogger(__name__).info(f"Failed to index documents: {e}")
+
+
+class OutputRelay:
+    """
+    forwards kernel output to __event_emitter__ as status updates,
+    coalesced so that at most one update is sent per interval
+    """
+
+    def __init__(self, event_emitter, interval: float):
+        self.event_emitter = event_emitter
+        self.interval = interval
+        self.last_emit = 0.0
+        self.pending = None
+
+    async def push(self, text: str):
+        lines = [line for line in text.strip().splitlines() if line.strip()]
+        if not self.event_emitter or not lines:
+            return
+
+        # only the most recent line is interesting to the user
+        self.pending = lines[-1][:200]
+        if time.monotonic() - self.last_emit >= self.interval:
+            await self.flush()
+
+    async def status(self, description: str):
+        """
+        emit a status update right away, bypassing the throttle
+        """
+        if self.event_emitter:
+            await self.event_emitter(
+                {
+                    "type": "status",
+                    "data": {
+                        "description": description,
+                        "done": False,
+                    },
+                }
+            )
+
+    async def flush(self):
+        if not self.pending:
+            return
+        description, self.pending = self.pending, None
+        self.last_emit = time.monotonic()
+        await self.event_emitter(
+            {
+                "type": "status",
+                "data": {
+                    "description": description,
+                    "done": False,
+                },
+            }
+        )
+
+
+class RequestTrace:
+    """
+    wall-clock time spent in each stage of a request, and the W3C trace
+    context that follows it into the kernel
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        # spans measured inside the kernel, they are part of "execute"
+        self.kernel_stages: dict[str, float] = {}
+        self.trace_id = secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        # class of the error that failed the request (e.g. ValueError, ExecutionTimeout)
+        self.error_class: str = None
+        self.succeeded = False
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started
+
+    @property
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def summary(self) -> str:
+        parts = [f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.stages.items()]
+        accounted = sum(self.stages.values())
+        parts.append(f"other {max(self.total - accounted, 0.0) * 1000:.0f}ms")
+        parts.append(f"total {self.total * 1000:.0f}ms")
+        summary = " | ".join(parts)
+        if self.kernel_stages:
+            kernel_parts = [f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.kernel_stages.items()]
+            summary += f" (kernel: {', '.join(kernel_parts)})"
+        return summary
+
+
+async def record_request(trace: RequestTrace, extensions: list, valves):
+    """
+    count a finished tool call and export the registry when a metrics file is configured
+    """
+    status = "ok" if trace.succeeded else "error"
+    for extension in extensions:
+        METRICS.inc("cdproject_documents_total", extension=extension, status=status)
+        if not trace.succeeded:
+            # nothing recorded an error class when the call was cancelled
+            error_class = trace.error_class or "CancelledError"
+            METRICS.inc("cdproject_errors_total", extension=extension, error_class=error_class)
+
+    METRICS.observe("cdproject_request_seconds", trace.total)
+    for stage, seconds in trace.stages.items():
+        METRICS.observe("cdproject_stage_seconds", seconds, stage=stage)
+    for stage, seconds in trace.kernel_stages.items():
+        METRICS.observe("cdproject_stage_seconds", seconds, stage=f"kernel_{stage}")
+
+    if valves.METRICS_FILE:
+        try:
+            await METRICS.write(valves.METRICS_FILE)
+        except OSError as e:
+            logging.getLogger(__name__).info(f"Failed to write metrics to {valves.METRICS_FILE}: {e}")
+
+
+# map document types to file extensions
+# sometimes ai generates wrong file extensions
+EXTENSION_MAP = {
+    "word": "docx",
+    "doc": "docx",
+    "docx": "docx",
+    "pdf": "pdf",
+    "excel": "xlsx",
+    "xlsx": "xlsx",
+    "powerpoint": "pptx",
+    "pptx": "pptx",
+    "csv": "csv",
+    "text": "txt",
+    "txt": "txt",
+    "rtf": "rtf",
+    "odt": "odt",
+    "ods": "ods",
+    "odp": "odp",
+    "html": "html",
+    "htm": "html",
+    "xml": "xml",
+    "json": "json",
+    "md": "md",
+    "markdown": "md",
+    "log": "log",
+    "ipynb": "ipynb",
+    "py": "py",
+    "js": "js",
+    "css": "css",
+    "ts": "ts",
+    "c": "c",
+    "cpp": "cpp",
+    "java": "java",
+    "go": "go",
+    "sh": "sh",
+    "bash": "sh",
+    "yml": "yml",
+    "yaml": "yml",
+    "ini": "ini",
+    "cfg": "cfg",
+    "conf": "conf",
+    "sql": "sql",
+    "ps1": "ps1",
+    "bat": "bat",
+}
+
+# archive formats the documents of a chat can be packaged into
+ARCHIVE_FORMATS = {
+    "zip": "zip",
+    "tar.zst": "tar.zst",
+    "tzst": "tar.zst",
+    "zst": "tar.zst",
+}
+
+
+# ================== PRE-FLIGHT ==================
+
+# libraries whose save APIs the kernel routes to the document, per format;
+# formats missing here can only be written through pypandoc, or a plain
+# open() for TEXT_EXTENSIONS
+DOCUMENT_WRITERS = {
+    "docx": {"docx": "python-docx (Document.save)", "pypandoc": "pypandoc (outputfile=...)"},
+    "xlsx": {"openpyxl": "openpyxl (Workbook.save)", "pandas": "pandas (DataFrame.to_excel / ExcelWriter)"},
+    "pptx": {"pptx": "python-pptx (Presentation.save)"},
+    "pdf": {"reportlab": "reportlab (Canvas / SimpleDocTemplate)", "pypandoc": "pypandoc (outputfile=...)"},
+    "odt": {"odf": "odfpy (OpenDocument.save)", "pypandoc": "pypandoc (outputfile=...)"},
+    "ods": {"odf": "odfpy (OpenDocument.save)"},
+    "odp": {"odf": "odfpy (OpenDocument.save)"},
+    "csv": {"pandas": "pandas (DataFrame.to_csv)"},
+}
+PANDOC_WRITER = {"pypandoc": "pypandoc (outputfile=...)"}
+
+# formats the kernel also routes built-in open() writes for, so they need no
+# library; must match TEXT_EXTENSIONS in KERNEL_BOOTSTRAP_MODULE
+TEXT_EXTENSIONS = {
+    "txt", "md", "csv", "json", "log", "html", "xml", "ipynb", "py", "js", "css", "ts",
+    "c", "cpp", "java", "go", "sh", "yml", "ini", "cfg", "conf", "sql", "ps1", "bat",
+}
+
+# calls that name the file a document is saved to, and where the path goes
+SAVE_CALLS = {
+    "save": ("filename", "path"),
+    "to_csv": ("path_or_buf",),
+    "Canvas": ("filename",),
+    "SimpleDocTemplate": ("filename",),
+    "convert_text": ("outputfile",),
+    "convert_file": ("outputfile",),
+}
+
+# calls that would take the pooled kernel down or lift the execution quotas
+FORBIDDEN_CALLS = {
+    "exit": "stops the kernel",
+    "quit": "stops the kernel",
+    "sys.exit": "stops the kernel",
+    "os._exit": "kills the kernel",
+    "os.abort": "kills the kernel",
+    "os.kill": "signals processes",
+    "os.killpg": "signals processes",
+    "os.fork": "forks the kernel",
+    "resource.setrlimit": "changes the execution quotas",
+    "signal.signal": "replaces the kernel's signal handlers",
+    "get_ipython": "reaches into the kernel",
+}
+
+
+def _python_source(code: str) -> str:
+    """
+    the plain Python the kernel runs for an IPython cell (!shell, %magics,
+    x? help become get_ipython() calls, top-level await stays as it is); None
+    when the cell uses IPython syntax and IPython is not installed here
+    """
+    try:
+        from IPython.core.inputtransformer2 import TransformerManager
+    except ImportError:
+        for line in code.splitlines():
+            if line.lstrip().startswith(("!", "%")) or line.rstrip().endswith("?"):
+                return None
+        return code
+    return TransformerManager().transform_cell(code)
+
+
+class PreflightError(Exception):
+    """
+    model code rejected before it is sent to a kernel, the message says how to fix it
+    """
+
+    def __init__(self, error_class: str, message: str):
+        super().__init__(message)
+        self.error_class = error_class
+
+
+def _dotted_name(node, aliases: dict) -> str:
+    """
+    "os._exit" for os._exit / from os import _exit / import os as o; o._exit
+    """
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(aliases.get(node.id, node.id))
+    return ".".join(reversed(parts))
+
+
+def _saved_path(call: ast.Call, method: str) -> str:
+    """
+    the literal file name a save call writes, None when it is computed
+    """
+    arguments = [keyword.value for keyword in call.keywords if keyword.arg in SAVE_CALLS[method]]
+    if not method.startswith("convert_") and call.args:
+        arguments.append(call.args[0])
+    for argument in arguments:
+        if isinstance(argument, ast.Constant) and isinstance(argument.value, str):
+            return argument.value
+    return None
+
+
+def preflight(code: str, outputs: dict, template: bool = False):
+    """
+    fast local checks of the model code before it costs a kernel round-trip:
+    it compiles, imports a library that can write every requested format
+    (unless it starts from a template), saves to matching file names and calls
+    nothing that breaks the kernel.
+    outputs maps document names to extensions ({"": extension} for one document).
+    not a sandbox, code that hides its calls still runs in the kernel.
+    """
+    source = _python_source(code)
+    if source is None:
+        # nothing to check without a parse, the kernel reports its own errors
+        return
+    try:
+        tree = ast.parse(source)
+        compile(tree, "<generated code>", "exec", flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+    except SyntaxError as e:
+        line = f": {e.text.strip()}" if e.text else ""
+        raise PreflightError("SyntaxError", f"SyntaxError on line {e.lineno}: {e.msg}{line}")
+
+    aliases = {}
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for name in node.names:
+                package = name.name.split(".")[0]
+                modules.add(package)
+                aliases[name.asname or package] = name.name if name.asname else package
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules.add(node.module.split(".")[0])
+            for name in node.names:
+                aliases[name.asname or name.name] = f"{node.module}.{name.name}"
+
+    if "cdproject_bootstrap" in modules:
+        raise PreflightError("ForbiddenCall", "The code imports cdproject_bootstrap, the tool's kernel module; remove it.")
+
+    for extension in set(outputs.values()):
+        writers = DOCUMENT_WRITERS.get(extension, PANDOC_WRITER)
+        if not template and extension not in TEXT_EXTENSIONS and not modules & set(writers):
+            raise PreflightError(
+                "MissingWriter",
+                f"A .{extension} document has to be written with {' or '.join(writers.values())}, "
+                f"but the code imports none of them.",
+            )
+
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        name = _dotted_name(node.func, aliases)
+        # magics are translated to get_ipython() calls, only the model's own ones count
+        if name == "get_ipython" and "get_ipython" not in code:
+            continue
+        if name in FORBIDDEN_CALLS:
+            raise PreflightError("ForbiddenCall", f"The code calls {name}(), which {FORBIDDEN_CALLS[name]}; remove it.")
+
+        method = name.rsplit(".", 1)[-1] if name else getattr(node.func, "attr", None)
+        if method not in SAVE_CALLS:
+            continue
+        path = _saved_path(node, method)
+        if path is None:
+            continue
+        file_name = os.path.basename(path)
+        stem, suffix = os.path.splitext(file_name)
+        saved_extension = EXTENSION_MAP.get(suffix.lower().lstrip("."))
+        # other files (e.g. a chart image saved for embedding) are left alone
+        if saved_extension not in DOCUMENT_WRITERS or file_name in outputs or stem in outputs:
+            continue
+        if list(outputs.values()).count(saved_extension) == 1:
+            continue
+        if "" in outputs:
+            hint = f"the requested document is a .{outputs['']} file, save it with that extension"
+        else:
+            hint = f"save each document under its requested name ({', '.join(f'{k}.{v}' for k, v in outputs.items())})"
+        raise PreflightError(
+            "ExtensionMismatch",
+            f"The code saves {file_name!r} on line {node.lineno}, but {hint}.",
+        )
+
+
+# ================== ADMISSION ==================
+
+# scheduling class per extension, lower is admitted first; the rest are class 1
+JOB_PRIORITIES = {"txt": 0, "md": 0, "csv": 0, "json": 0, "log": 0, "pptx": 2, "pdf": 2}
+# a waiting job moves up one class per this many seconds, so heavy formats never starve
+PRIORITY_AGING_SECONDS = 10
+
+
+def job_priority(extensions: list) -> int:
+    """
+    scheduling class of a job, set by the heaviest format it renders
+    """
+    return max((JOB_PRIORITIES.get(extension, 1) for extension in extensions), default=1)
+
+
+class QueueFull(Exception):
+    """
+    raised when a request is shed because the admission queue is full
+    """
+
+
+@dataclass
+class QueuedJob:
+    """
+    a request waiting for an execution slot
+    """
+    user_id: str
+    priority: int
+    seq: int
+    future: asyncio.Future
+    queued_at: float = field(default_factory=time.monotonic)
+
+
+class AdmissionQueue:
+    """
+    in-process queue in front of the kernel pools: at most `limit` jobs run
+    at once and the others wait, admitted by (running jobs of their user,
+    aged priority class, arrival) so one user cannot crowd out the rest and
+    quick formats overtake heavy ones
+
+    a freed slot is handed straight to the chosen waiter, so a new arrival
+    can never take it first
+    """
+
+    def __init__(self):
+        self.waiting: list[QueuedJob] = []
+        self.active = 0
+        self.active_by_user: dict[str, int] = {}
+        self.seq = 0
+
+    def collect(self) -> list:
+        """
+        gauge samples for the metrics registry
+        """
+        return [
+            ("cdproject_queue_jobs", {"state": "waiting"}, len(self.waiting)),
+            ("cdproject_queue_jobs", {"state": "active"}, self.active),
+        ]
+
+    def _rank(self, job: QueuedJob, now: float) -> tuple:
+        aged = job.priority - int((now - job.queued_at) // PRIORITY_AGING_SECONDS)
+        return (self.active_by_user.get(job.user_id, 0), aged, job.seq)
+
+    def _admit(self, user_id: str):
+        self.active += 1
+        self.active_by_user[user_id] = self.active_by_user.get(user_id, 0) + 1
+
+    def _dispatch(self, limit: int):
+        while self.waiting and self.active < limit:
+            now = time.monotonic()
+            job = min(self.waiting, key=lambda waiting: self._rank(waiting, now))
+            self.waiting.remove(job)
+            self._admit(job.user_id)
+            job.future.set_result(None)
+
+    def position(self, job: QueuedJob) -> int:
+        now = time.monotonic()
+        rank = self._rank(job, now)
+        return 1 + sum(1 for other in self.waiting if self._rank(other, now) < rank)
+
+    async def acquire(self, user_id: str, priority: int, limit: int, valves, relay):
+        """
+        wait for an execution slot, reporting the queue position through the relay
+
+        raises QueueFull when MAX_QUEUED_DOCUMENTS requests (or MAX_QUEUED_PER_USER
+        of this user) are already waiting
+        """
+        if not self.waiting and self.active < limit:
+            self._admit(user_id)
+            return
+
+        queued_by_user = sum(1 for job in self.waiting if job.user_id == user_id)
+        if valves.MAX_QUEUED_PER_USER and queued_by_user >= valves.MAX_QUEUED_PER_USER:
+            METRICS.inc("cdproject_shed_total", reason="user")
+            raise QueueFull(
+                f"You already have {queued_by_user} documents waiting to be generated, "
+                "please try again once they are done."
+            )
+        if valves.MAX_QUEUED_DOCUMENTS and len(self.waiting) >= valves.MAX_QUEUED_DOCUMENTS:
+            METRICS.inc("cdproject_shed_total", reason="full")
+            raise QueueFull(
+                f"The document queue is full ({len(self.waiting)} requests waiting), "
+                "please try again in a minute."
+            )
+
+        self.seq += 1
+        job = QueuedJob(user_id, priority, self.seq, asyncio.get_running_loop().create_future())
+        self.waiting.append(job)
+        # the limit may have been raised since the last release
+        self._dispatch(limit)
+        try:
+            reported = None
+            while not job.future.done():
+                position = self.position(job)
+                if position != reported:
+                    reported = position
+                    await relay.status(
+                        f"Waiting in the document queue: {position} of {len(self.waiting)}, "
+                        f"{self.active} being generated..."
+                    )
+                await asyncio.wait({job.future}, timeout=max(valves.PROGRESS_UPDATE_INTERVAL, 0.5))
+        except BaseException:
+            if job in self.waiting:
+                self.waiting.remove(job)
+            else:
+                # the slot was handed over but is never going to be used
+                self.release(user_id, limit)
+            raise
+
+    def release(self, user_id: str, limit: int):
+        """
+        free a slot and hand it to the next waiter
+        """
+        self.active -= 1
+        remaining = self.active_by_user.get(user_id, 1) - 1
+        if remaining:
+            self.active_by_user[user_id] = remaining
+        else:
+            self.active_by_user.pop(user_id, None)
+        self._dispatch(limit)
+
+
+def admission_limit(valves, kernel_pool) -> int:
+    """
+    jobs allowed to execute at once, MAX_CONCURRENT_EXECUTIONS per server
+    unless MAX_ACTIVE_DOCUMENTS is set
+    """
+    if valves.MAX_ACTIVE_DOCUMENTS:
+        return valves.MAX_ACTIVE_DOCUMENTS
+    return valves.MAX_CONCURRENT_EXECUTIONS * len(getattr(kernel_pool, "backends", [kernel_pool]))
+
+
+# must match TEMPLATE_EXTENSIONS in the kernel bootstrap
+TEMPLATE_EXTENSIONS = (".docx", ".pptx", ".xlsx", ".py")
+
+
+def template_call(name: str) -> str:
+    """
+    wrapper line that binds `template` to a fresh copy of the named template
+    """
+    if not name:
+        return ""
+    return f"template = cdproject_bootstrap.template({name!r})"
+
+
+def template_fingerprint(data_dir: str, name: str) -> str:
+    """
+    identity of a template file as seen in DATA_DIR, part of the result cache
+    key; None when the template is not visible from here
+    """
+    if not name.replace("_", "").replace("-", "").isalnum():
+        return None
+    for extension in TEMPLATE_EXTENSIONS:
+        try:
+            stat = os.stat(os.path.join(data_dir, "templates", name + extension))
+        except OSError:
+            continue
+        return f"{name}{extension}:{stat.st_size}:{stat.st_mtime_ns}"
+    return None
+
+
+def limits_call(valves) -> str:
+    """
+    wrapper line that applies the per-execution quotas of the valves
+    """
+    return (
+        f"cdproject_bootstrap.apply_limits(memory_mb={valves.EXECUTION_MAX_MEMORY_MB}, "
+        f"cpu_seconds={valves.EXECUTION_MAX_CPU_SECONDS}, file_mb={valves.MAX_OUTPUT_FILE_MB}, "
+        f"stdout_kb={valves.MAX_STDOUT_KB})"
+    )
+
+
+def sign_download(secret: str, user_id: str, chat_id: str, file_name: str, expires: str) -> str:
+    """
+    HMAC of a download link, must match sign_download in user_files_webserver.py
+    """
+    message = f"{user_id}\n{chat_id}\n{file_name}\n{expires}".encode("utf-8")
+    return hmac.new(secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+def build_download_url(valves, user_id: str, chat_id: str, file_name: str) -> str:
+    """
+    link to a document, signed and expiring when DOWNLOAD_URL_SECRET is set
+    """
+    params = {"user_id": user_id, "chat_id": chat_id, "file_name": file_name}
+    if valves.DOWNLOAD_URL_SECRET:
+        params["expires"] = str(int(time.time()) + valves.DOWNLOAD_URL_TTL)
+        params["signature"] = sign_download(valves.DOWNLOAD_URL_SECRET, user_id, chat_id, file_name, params["expires"])
+    return f"{valves.BASE_DOWNLOAD_URL}?{urlencode(params)}"
+
+
+def format_profile(profile: dict) -> str:
+    """
+    one-line summary of the profile a profiled execution returns
+    """
+    by_package = ", ".join(f"{package} {seconds:.2f}s" for package, seconds in list(profile["by_package"].items())[:5])
+    top = ", ".join(f"{entry['function']} {entry['own_seconds']:.2f}s" for entry in profile["top_functions"][:3])
+    return (
+        f"peak {profile['peak_traced_mb']:.1f} MB allocated, {profile['max_rss_mb']:.0f} MB kernel RSS,"
+        f" output {profile['output_bytes'] / 1024:.0f} KB"
+        f" | time by package: {by_package} | top functions: {top}"
+    )
+
+
+def collect_tools(tools) -> list:
+    """
+    gauge samples of a Tools instance: its admission queue and current pool
+    (a retired pool still closing in the background is no longer reported)
+    """
+    samples = tools.admission.collect()
+    if tools.kernel_pool is not None:
+        samples += tools.kernel_pool.collect()
+    return samples
+
+
+async def execute_on_pool(
+    tools, code: str, user_id: str, chat_id: str, extensions: list, event_emitter, trace
+) -> tuple:
+    """
+    run wrapper code on the tool's kernel pool and return (result, error),
+    after waiting for a slot in the admission queue
+    """
+    # emit status when sending code to the backend
+    if event_emitter:
+        await event_emitter(
+            {
+                "type": "status",
+                "data": {
+                    "description": "Sending code to the execution backend...",
+                    "done": False,
                 },
-                "parent_header": {},
-                "buffers": {},
             }
+        )
+
+    if tools.kernel_pool is None or not tools.kernel_pool.matches(tools.valves):
+        # the backend changed, retire the old pool without killing running jobs
+        if tools.kernel_pool is not None:
+            spawn(tools.background_tasks, tools.kernel_pool.close())
+        tools.kernel_pool = create_pool(tools.valves)
+        # kernels of pools that Open WebUI dropped without closing them
+        spawn(tools.background_tasks, tools.kernel_pool.shut_down_abandoned())
+    kernel_pool = tools.kernel_pool
+
+    # kernels are only shared between requests of the same user/chat
+    affinity = {
+        "user": f"user:{user_id}",
+        "chat": f"chat:{user_id}:{chat_id}",
+    }.get(tools.valves.KERNEL_AFFINITY.lower())
+
+    relay = OutputRelay(event_emitter, tools.valves.PROGRESS_UPDATE_INTERVAL)
+    limit = admission_limit(tools.valves, kernel_pool)
+    with trace.stage("queue"):
+        await tools.admission.acquire(user_id, job_priority(extensions), limit, tools.valves, relay)
+    try:
+        result = await kernel_pool.run(tools.valves, code, user_id, affinity, relay, trace)
+    finally:
+        tools.admission.release(user_id, limit)
+
+    # keep warm kernels ready for the next document
+    spawn(tools.background_tasks, kernel_pool.fill(tools.valves))
+
+    # profiled executions report where the time and memory went
+    jupyter_result = result[0]
+    if jupyter_result and jupyter_result.get("profile"):
+        summary = format_profile(jupyter_result["profile"])
+        logging.getLogger(__name__).info(f"Profile [{trace.trace_id}]: {summary}")
+        await relay.status(f"Profile: {summary}")
+    return result
+
+
+class Tools:
+    def __init__(self):
+        """
+        initialize the document generator tool
+        """
+        self.valves = self.Valves()
+        # kernel pool, result cache and artifact index are created lazily so that they pick up the saved valves
+        self.kernel_pool = None
+        self.result_cache = None
+        self.artifact_index = None
+        # jobs waiting for (or holding) an execution slot
+        self.admission = AdmissionQueue()
+        # pool top-ups and retired pools/indexes closing in the background
+        self.background_tasks: set[asyncio.Task] = set()
+        # Open WebUI replaces the instance on a reload without closing it, so
+        # every instance reports under its own label until it is garbage collected
+        METRICS.add_collector(self, collect_tools, tool_instance=uuid.uuid4().hex[:8])
+
+    class Valves(BaseModel):
+        """
+        configurable settings
+        """
+        EXECUTION_BACKEND: str = Field(
+            default="jupyter",
+            description="Where the generated code runs: 'jupyter' (kernels on JUPYTER_URL) or 'local' (worker processes forked on this host with the document libraries preloaded, for trusted single-tenant setups)",
+        )
+        JUPYTER_URL: str = Field(
+            default="http://localhost:8888",
+            description="URL of the Jupyter backend, or a comma separated list of servers to spread documents across",
+        )
+        JUPYTER_TOKEN: str = Field(
+            default="JUPYTER_TOKEN",
+            description="Token for Jupyter authentication (one for all servers, or a comma separated list matching JUPYTER_URL)",
+        )
+        JUPYTER_ROUTING: str = Field(
+            default="least_loaded",
+            description="How requests pick a server when JUPYTER_URL lists several: 'least_loaded' or 'user_hash' (a user always lands on the same server while it is up)",
+        )
+        JUPYTER_HEALTH_CHECK_INTERVAL: int = Field(
+            default=10,
+            description="Seconds between health checks of each Jupyter server when JUPYTER_URL lists several",
+        )
+        BASE_DOWNLOAD_URL: str = Field(
+            default="https://your.domain.com/backend-api/files/download",
+            description="Base URL for file downloads",
+        )
+        DOWNLOAD_URL_SECRET: str = Field(
+            default="",
+            description="Secret shared with the download server to sign download URLs (HMAC-SHA256), empty for unsigned URLs",
+        )
+        DOWNLOAD_URL_TTL: int = Field(
+            default=604800,
+            description="Seconds a signed download URL stays valid",
+        )
+        ENABLE_DEBUG: bool = Field(
+            default=False,
+            description="Enable debug mode",
+        )
+        PROGRESS_UPDATE_INTERVAL: float = Field(
+            default=1.0,
+            description="Minimum seconds between progress updates relayed from the kernel output",
+        )
+        METRICS_FILE: str = Field(
+            default="",
+            description="Write Prometheus metrics to this file after every call, e.g. for the node_exporter textfile collector",
+        )
+        TRACE_CONTEXT: bool = Field(
+            default=False,
+            description="Send a W3C traceparent in the kernel message header and log the trace id",
+        )
+        PROFILE_EXECUTIONS: bool = Field(
+            default=False,
+            description="Profile the generated code (cProfile + tracemalloc) and report time by package and peak memory; slows executions down",
+        )
+        PROFILE_TOP_FUNCTIONS: int = Field(
+            default=10,
+            description="Number of most expensive functions kept in a profile",
+        )
+        DATA_DIR: str = Field(
+            default="",
+            description="Path where Open WebUI sees the Jupyter /mnt/data volume (needed by the result cache and to shut down kernels left behind by a restart, the local backend writes documents here)",
+        )
+        LOCAL_PRELOAD_MODULES: str = Field(
+            default="docx,openpyxl,pptx,reportlab.pdfgen.canvas,reportlab.platypus,pandas,odf.opendocument,pypandoc",
+            description="Modules the local backend's fork server imports once for every worker",
+        )
+        RESULT_CACHE_ENABLED: bool = Field(
+            default=False,
+            description="Serve identical code/extension requests from previously generated documents",
+        )
+        RESULT_CACHE_MAX_MB: int = Field(
+            default=512,
+            description="Size of the result cache, least recently used documents are evicted first",
+        )
+        RESULT_CACHE_TTL: int = Field(
+            default=86400,
+            description="Seconds a cached document may be reused",
+        )
+        ARTIFACT_LIFECYCLE_ENABLED: bool = Field(
+            default=False,
+            description="Index generated documents in DATA_DIR and delete them by age and per-user quota",
+        )
+        ARTIFACT_TTL: int = Field(
+            default=604800,
+            description="Seconds a generated document is kept before the sweeper deletes it (0 keeps them)",
+        )
+        USER_QUOTA_MB: int = Field(
+            default=1024,
+            description="Disk space per user, the oldest documents are deleted beyond it (0 disables)",
+        )
+        ARTIFACT_SWEEP_INTERVAL: int = Field(
+            default=600,
+            description="Seconds between runs of the background sweeper",
+        )
+        ARTIFACT_SWEEP_BATCH: int = Field(
+            default=500,
+            description="Documents deleted per sweeper batch",
+        )
+        PREFLIGHT_CHECKS: bool = Field(
+            default=True,
+            description="Check the generated code locally (syntax, save calls, kernel-breaking calls) before it is sent to a kernel",
+        )
+        KERNEL_POOL_MIN_SIZE: int = Field(
+            default=1,
+            description="Number of warm kernels kept ready for new documents (per Jupyter server)",
+        )
+        KERNEL_POOL_MAX_SIZE: int = Field(
+            default=4,
+            description="Maximum number of kernels the tool may run at once (per Jupyter server)",
+        )
+        KERNEL_MAX_EXECUTIONS: int = Field(
+            default=50,
+            description="Recycle a kernel after this many documents",
+        )
+        KERNEL_MAX_MEMORY_MB: int = Field(
+            default=1024,
+            description="Recycle a kernel once its peak memory exceeds this many MB (0 disables)",
+        )
+        MAX_CONCURRENT_EXECUTIONS: int = Field(
+            default=4,
+            description="Maximum number of documents rendered at once (per Jupyter server), further requests are queued",
+        )
+        MAX_ACTIVE_DOCUMENTS: int = Field(
+            default=0,
+            description="Documents generated at once across all servers, further requests wait in the admission queue (0 = MAX_CONCURRENT_EXECUTIONS per server)",
+        )
+        MAX_QUEUED_DOCUMENTS: int = Field(
+            default=50,
+            description="Requests that may wait in the admission queue before new ones are turned away (0 = no limit)",
+        )
+        MAX_QUEUED_PER_USER: int = Field(
+            default=5,
+            description="Requests a single user may have waiting in the admission queue (0 = no limit)",
+        )
+        KERNEL_AFFINITY: str = Field(
+            default="none",
+            description="Bind kernels to a 'user' or 'chat' so they are never shared across them ('none' shares kernels)",
+        )
+        EXECUTION_TIMEOUT: int = Field(
+            default=120,
+            description="Wall-clock seconds a document may take before the kernel is interrupted (0 disables)",
+        )
+        EXECUTION_IDLE_TIMEOUT: int = Field(
+            default=60,
+            description="Seconds without any kernel output before the kernel is interrupted (0 disables)",
+        )
+        INTERRUPT_GRACE_PERIOD: int = Field(
+            default=5,
+            description="Seconds to wait for an interrupted kernel to go idle before restarting it",
+        )
+        EXECUTION_MAX_MEMORY_MB: int = Field(
+            default=2048,
+            description="Address space a document may map on top of the kernel baseline, beyond it allocations fail and the kernel is recycled (0 disables)",
+        )
+        EXECUTION_MAX_CPU_SECONDS: int = Field(
+            default=120,
+            description="CPU seconds a document may use before it is stopped and the kernel recycled (0 disables)",
+        )
+        MAX_OUTPUT_FILE_MB: int = Field(
+            default=256,
+            description="Largest file a document may write (0 disables)",
+        )
+        MAX_STDOUT_KB: int = Field(
+            default=1024,
+            description="Most output the generated code may print (0 disables)",
+        )
+        KERNEL_HEALTH_CHECK_INTERVAL: int = Field(
+            default=30,
+            description="Seconds a kernel may sit idle before it is health checked on checkout",
+        )
+
+    async def create_document(
+        self,
+        document_extension: str,
+        document_name: str,
+        code: str = """""",
+        template: str = "",
+        # contains chat context metadata (critical: includes chat_id, message_id)
+        __metadata__: dict = None,
+        # open WebUI injects a callback function to send real-time updates to the UI
+        # when available, use this to emit status, message, or citation events
+        # when None, the tool should work without UI updates (safe fallback)
+        __event_emitter__=None,
+    ) -> str:
+        """
+        :param code: The Python code to execute for document generation.
+        :param document_extension: Type of document being generated (e.g., "docx", "pdf", "excel", etc.)
+        :param document_name: Meaningful name for the document
+        :param template: Optional name of a house-style template from list_templates. The code then gets `template`, a ready copy of it (python-docx Document, python-pptx Presentation, openpyxl Workbook, or the styles of a .py template), adds its content and saves it.
+        """
+        
+        logging.basicConfig(level=logging.INFO)
+        logger = logging.getLogger(__name__)
+        # per-stage latency, reported in debug mode and exported as metrics
+        trace = RequestTrace()
+
+        # emit status that when starting document generation
+        if __event_emitter__:
+            await __event_emitter__(
+                {
+                    "type": "status",
+                    "data": {
+                        "description": f"Generating {document_extension} document...",
+                        "done": False,
+                    },
+                }
+            )
+
+        # UUIDs from metadata
+        chat_id = None
+        user_id = None
+        extension = "unknown"
+        
+        try:
+            if (
+                __metadata__
+                and ("user_id" in __metadata__)
+                and ("chat_id" in __metadata__)
+            ):
+                user_id = __metadata__["user_id"]
+                chat_id = __metadata__["chat_id"]
 
-            # ======================
-            #  Send code to Jupyter
-            # ======================
+            else:
+                if __event_emitter__:
+                    await __event_emitter__(
+                        {
+                            "type": "status",
+                            "data": {
+                                "description": "Something went wrong! Please contact the administrator and provide them with the error code 18854",
+                                "done": True,
+                                "hidden": False if self.valves.ENABLE_DEBUG else True,
+                            },
+                        }
+                    )
+                raise ValueError("User ID or Chat ID is not available.")
 
-            ws.send(json.dumps(msg))
-            logger.info("Execution started. Waiting for output...")
+            # get the appropriate extension
+            extension = EXTENSION_MAP.get(document_extension.lower(), "txt")
+            
+            # ========================================================
+            # ================== 🙉 MONKEY WRAPPERS 🐒 ==============
+            # ========================================================
+            
+            # de-indent the model-generated code
+            normalized_code = textwrap.dedent(code)
+            profile_top_functions = self.valves.PROFILE_TOP_FUNCTIONS if self.valves.PROFILE_EXECUTIONS else 0
 
-            # initialize result variable to capture Jupyter response
-            jupyter_result = None
+            # broken code fails here in milliseconds instead of after a kernel round-trip
+            if self.valves.PREFLIGHT_CHECKS:
+                with trace.stage("preflight"):
+                    preflight(normalized_code, {"": extension}, bool(template))
 
-            while True:
-                try:
-                    raw_msg = ws.recv()
-                    if not raw_msg:
-                        continue
+            # the kernel already holds the patched libraries (KERNEL_BOOTSTRAP_MODULE),
+            # so each request only allocates its target file and runs the model code
+            WRAPPER_CODE = f"""
+# ================== WRAPPER ==================
+import cdproject_bootstrap
 
-                    response_msg = json.loads(raw_msg)
-                    msg_type = response_msg.get("msg_type")
-                    parent_msg_id = response_msg.get("parent_header", {}).get("msg_id")
+# pooled kernels are reused, so start from an empty user namespace
+# (imported modules stay warm in sys.modules, the reset drops this name too)
+cdproject_bootstrap.reset_namespace()
+import cdproject_bootstrap
+cdproject_bootstrap.begin({user_id!r}, {chat_id!r}, {extension!r}, {profile_top_functions!r})
+{limits_call(self.valves)}
+{template_call(template)}
 
-                    # only process messages related to request sent with msg_id (line: 396)
-                    if parent_msg_id != msg_id:
-                        continue
+# ================== MODEL GENERATED CODE ==================
+{normalized_code}
+# ================== END MODEL GENERATED CODE ==================
 
-                    # capture stream output (stdout from print, etc.)
-                    if msg_type == "stream":
-                        content = response_msg.get("content", {})
-                        text = content.get("text", "")
-                        for line in text.strip().split('\n'):
-                            if line:
-                                try:
-                                    jupyter_result = json.loads(line)
-                                except Exception as e:
-                                    jupyter_result = line
-                                logger.info(f"OUTPUT: {jupyter_result} | type: {type(jupyter_result)}")
-                        break
-
-                    # capture errors
-                    elif msg_type == "error":
-                        content = response_msg.get("content", {})
-                        logger.info(f"ERROR: {content.get('ename')} - {content.get('evalue')}")
-                        traceback = content.get("traceback", [])
-                        for line in traceback:
-                            logger.info(f"TRACEBACK: {line}")
-                        break
-
-                    # detect when execution is complete (this is a part of jupyter, not open webui)
-                    elif msg_type == "status":
-                        if (response_msg.get("content", {}).get("execution_state") == "idle"):
-                            logger.info("Execution completed.")
-                            break
-
-                except Exception as e:
-                    logger.info(f"Error while receiving from WebSocket: {e}", file=sys.stderr)
-                    break
+cdproject_bootstrap.finish()
+# ================== END WRAPPER ==================
+"""
 
-            # =========================
-            #  Shutdown Jupyter Kernel
-            # =========================
-            logger.info(f"Shutting down kernel with ID: {kernel_id}")
-            shutdown_url = f"http://localhost:8888/api/kernels/{kernel_id}"
-            try:
-                response = requests.delete(shutdown_url, headers=headers)
-                response.raise_for_status()
-                logger.info("Kernel shut down successfully.")
-            except requests.exceptions.RequestException as e:
-                logger.info(f"Failed to shut down kernel: {e}", file=sys.stderr)
+            # =========================================
+            #  Serve identical requests from the cache
+            # =========================================
+            jupyter_result = None
+            kernel_error = None
+            cache_key = None
+            # a template only takes part in caching when its file is visible in DATA_DIR
+            template_key = template_fingerprint(self.valves.DATA_DIR, template) if template else ""
+            if self.valves.RESULT_CACHE_ENABLED and self.valves.DATA_DIR and template_key is not None:
+                if self.result_cache is None or self.result_cache.data_dir != self.valves.DATA_DIR:
+                    self.result_cache = ResultCache(self.valves.DATA_DIR)
+
+                # the key needs the library versions reported by a bootstrapped kernel
+                if self.kernel_pool is not None and self.kernel_pool.library_versions:
+                    cache_key = ResultCache.key(
+                        normalized_code, extension, self.kernel_pool.library_versions, template_key
+                    )
+                    with trace.stage("cache"):
+                        jupyter_result = await self.result_cache.fetch(
+                            cache_key, user_id, chat_id, extension, self.valves
+                        )
+                    METRICS.inc("cdproject_cache_requests_total", result="hit" if jupyter_result else "miss")
+                    if jupyter_result:
+                        logger.info(f"Result cache hit for {cache_key}")
+
+            if jupyter_result is None:
+                # =====================================
+                #  Run the code on a warm pooled kernel
+                # =====================================
+                jupyter_result, kernel_error = await execute_on_pool(
+                    self, WRAPPER_CODE, user_id, chat_id, [extension], __event_emitter__, trace
+                )
+
+                # remember the document for identical requests
+                kernel_pool = self.kernel_pool
+                if (
+                    self.valves.RESULT_CACHE_ENABLED
+                    and self.result_cache is not None
+                    and template_key is not None
+                    and kernel_pool.library_versions
+                    and jupyter_result
+                    and jupyter_result["status"] == "ok"
+                ):
+                    cache_key = cache_key or ResultCache.key(
+                        normalized_code, extension, kernel_pool.library_versions, template_key
+                    )
+                    with trace.stage("cache"):
+                        await self.result_cache.store(
+                            cache_key, user_id, chat_id, jupyter_result["file_name"], self.valves
+                        )
 
-            ws.close()
-            logger.info("WebSocket connection closed.")
+            # latency budget, proves where the time went
+            if self.valves.ENABLE_DEBUG:
+                logger.info(f"Latency budget [{trace.trace_id}]: {trace.summary()}")
+                if __event_emitter__:
+                    await __event_emitter__(
+                        {
+                            "type": "status",
+                            "data": {
+                                "description": f"Latency budget: {trace.summary()}",
+                                "done": False,
+                            },
+                        }
+                    )
 
             # ============================
             #  Construct the download URL
@@ -493,7 +3724,18 @@ else:
             # check if we got a valid result from Jupyter
             if jupyter_result and jupyter_result["status"] == "ok":
                 file_name = jupyter_result["file_name"]
-                download_url = f"{self.valves.BASE_DOWNLOAD_URL}?user_id={user_id}&chat_id={chat_id}&file_name={file_name}"
+                if jupyter_result.get("cached"):
+                    logger.info(f"Document {file_name}: {jupyter_result['size']} bytes, served from the result cache")
+                else:
+                    logger.info(
+                        f"Document {file_name}: {jupyter_result['size']} bytes, "
+                        f"sha256 {jupyter_result['sha256']}, rendered in {jupyter_result['elapsed_seconds']:.3f}s"
+                        + (f", trace {jupyter_result['trace_id']}" if jupyter_result.get("trace_id") else "")
+                    )
+                download_url = build_download_url(self.valves, user_id, chat_id, file_name)
+
+                # track the document for retention and quotas
+                await record_artifacts(self, user_id, chat_id, [(file_name, jupyter_result["size"])])
 
                 # emit success status
                 if __event_emitter__:
@@ -530,10 +3772,18 @@ else:
                         }
                     )
                 
+                trace.succeeded = True
                 return f"Provide this URL to the user to download the document: [{document_name}]({download_url})"
             
             else:
-                error_msg = f"Document generation failed: {jupyter_result.get('message', 'Unknown error') if jupyter_result else 'No valid response from Jupyter'}"
+                trace.error_class = trace.error_class or (jupyter_result or {}).get("error_class", "NoResult")
+                if kernel_error:
+                    reason = kernel_error
+                elif jupyter_result:
+                    reason = jupyter_result.get("message", "Unknown error")
+                else:
+                    reason = "No valid response from Jupyter"
+                error_msg = f"Document generation failed: {reason}"
                 if __event_emitter__:
                     await __event_emitter__(
                         {
@@ -547,12 +3797,13 @@ else:
                     )
                 return f"Error: {error_msg}"
 
-        except json.JSONDecodeError:
-            error_msg = "Invalid response from Jupyter backend"
+        except Exception as e:
+            trace.error_class = trace.error_class or getattr(e, "error_class", type(e).__name__)
+            error_msg = f"Error in document generation: {str(e)}"
             if __event_emitter__:
                 await __event_emitter__(
                     {
-                        "type": "status",
+                        "type": "status", 
                         "data": {
                             "description": error_msg, 
                             "done": True,
@@ -560,16 +3811,374 @@ else:
                         },
                     }
                 )
+
             return f"Error: {error_msg}"
 
+        finally:
+            await record_request(trace, [extension], self.valves)
+
+    async def create_documents(
+        self,
+        documents: list[dict],
+        code: str = """""",
+        archive_format: str = "",
+        template: str = "",
+        # contains chat context metadata (critical: includes chat_id, message_id)
+        __metadata__: dict = None,
+        # open WebUI injects a callback function to send real-time updates to the UI
+        __event_emitter__=None,
+    ) -> str:
+        """
+        Generate several documents from one piece of code, e.g. an xlsx with the data, a pdf summary and a pptx deck.
+        :param documents: The documents to generate, e.g. [{"name": "sales", "extension": "xlsx"}, {"name": "summary", "extension": "pdf"}]. The code saves each one under its name, e.g. wb.save("sales.xlsx").
+        :param code: The Python code to execute for generating all documents.
+        :param archive_format: Optional, "zip" or "tar.zst" to deliver all documents as one archive with a single download link.
+        :param template: Optional name of a house-style template from list_templates, available to the code as `template` (a fresh copy).
+        """
+
+        logging.basicConfig(level=logging.INFO)
+        logger = logging.getLogger(__name__)
+        # per-stage latency, reported in debug mode and exported as metrics
+        trace = RequestTrace()
+
+        # emit status that when starting document generation
+        if __event_emitter__:
+            await __event_emitter__(
+                {
+                    "type": "status",
+                    "data": {
+                        "description": f"Generating {len(documents or [])} documents...",
+                        "done": False,
+                    },
+                }
+            )
+
+        outputs = {}
+        try:
+            if not (__metadata__ and "user_id" in __metadata__ and "chat_id" in __metadata__):
+                if __event_emitter__:
+                    await __event_emitter__(
+                        {
+                            "type": "status",
+                            "data": {
+                                "description": "Something went wrong! Please contact the administrator and provide them with the error code 18854",
+                                "done": True,
+                                "hidden": False if self.valves.ENABLE_DEBUG else True,
+                            },
+                        }
+                    )
+                raise ValueError("User ID or Chat ID is not available.")
+            user_id = __metadata__["user_id"]
+            chat_id = __metadata__["chat_id"]
+
+            # {name: extension}, names route each save to its own file
+            for document in documents or []:
+                name = str(document.get("name", "")).strip()
+                if not name:
+                    raise ValueError("Every document needs a name.")
+                if name in outputs:
+                    raise ValueError(f"Document name {name!r} is used twice.")
+                outputs[name] = EXTENSION_MAP.get(str(document.get("extension", "")).lower(), "txt")
+            if not outputs:
+                raise ValueError("No documents requested.")
+            archive = None
+            if archive_format:
+                archive = ARCHIVE_FORMATS.get(archive_format.lower().lstrip("."))
+                if archive is None:
+                    raise ValueError(f"Unknown archive format {archive_format!r}, use zip or tar.zst.")
+
+            profile_top_functions = self.valves.PROFILE_TOP_FUNCTIONS if self.valves.PROFILE_EXECUTIONS else 0
+            if self.valves.PREFLIGHT_CHECKS:
+                with trace.stage("preflight"):
+                    preflight(textwrap.dedent(code), outputs, bool(template))
+
+            # same wrapper as create_document, with one target per document
+            WRAPPER_CODE = f"""
+# ================== WRAPPER ==================
+import cdproject_bootstrap
+
+# pooled kernels are reused, so start from an empty user namespace
+# (imported modules stay warm in sys.modules, the reset drops this name too)
+cdproject_bootstrap.reset_namespace()
+import cdproject_bootstrap
+cdproject_bootstrap.begin_batch({user_id!r}, {chat_id!r}, {outputs!r}, {archive!r}, {profile_top_functions!r})
+{limits_call(self.valves)}
+{template_call(template)}
+
+# ================== MODEL GENERATED CODE ==================
+{textwrap.dedent(code)}
+# ================== END MODEL GENERATED CODE ==================
+
+cdproject_bootstrap.finish()
+# ================== END WRAPPER ==================
+"""
+
+            # one kernel round-trip for the whole batch
+            jupyter_result, kernel_error = await execute_on_pool(
+                self, WRAPPER_CODE, user_id, chat_id, list(outputs.values()), __event_emitter__, trace
+            )
+
+            # latency budget, proves where the time went
+            if self.valves.ENABLE_DEBUG:
+                logger.info(f"Latency budget [{trace.trace_id}]: {trace.summary()}")
+
+            if not (jupyter_result and jupyter_result["status"] == "ok"):
+                trace.error_class = trace.error_class or (jupyter_result or {}).get("error_class", "NoResult")
+                if kernel_error:
+                    reason = kernel_error
+                elif jupyter_result:
+                    reason = jupyter_result.get("message", "Unknown error")
+                else:
+                    reason = "No valid response from Jupyter"
+                error_msg = f"Document generation failed: {reason}"
+                if __event_emitter__:
+                    await __event_emitter__(
+                        {
+                            "type": "status",
+                            "data": {
+                                "description": error_msg,
+                                "done": True,
+                                "hidden": False if self.valves.ENABLE_DEBUG else True,
+                            },
+                        }
+                    )
+                return f"Error: {error_msg}"
+
+            # one link for the archive, else one per document
+            if archive:
+                deliveries = {f"documents.{archive}": jupyter_result}
+            else:
+                deliveries = jupyter_result["outputs"]
+
+            links = []
+            for name, output in deliveries.items():
+                file_name = output["file_name"]
+                logger.info(f"Document {file_name}: {output['size']} bytes, sha256 {output['sha256']}")
+                download_url = build_download_url(self.valves, user_id, chat_id, file_name)
+                links.append(f"- [{name}]({download_url})")
+
+                # emit citation to download the document
+                if __event_emitter__:
+                    await __event_emitter__(
+                        {
+                            "type": "citation",
+                            "data": {
+                                "document": [
+                                    "Download the document from the above url."
+                                ],
+                                "metadata": [
+                                    {
+                                        "date_accessed": datetime.now().isoformat(),
+                                        "source": f"{name}",
+                                    }
+                                ],
+                                "source": {
+                                    "name": f"Download '{name}' here",
+                                    "url": f"{download_url}",
+                                },
+                            },
+                        }
+                    )
+            logger.info(
+                f"Batch of {len(jupyter_result['outputs'])} documents rendered in {jupyter_result['elapsed_seconds']:.3f}s"
+            )
+
+            # track the documents for retention and quotas
+            await record_artifacts(
+                self, user_id, chat_id, [(output["file_name"], output["size"]) for output in deliveries.values()]
+            )
+
+            # emit success status
+            if __event_emitter__:
+                await __event_emitter__(
+                    {
+                        "type": "status",
+                        "data": {
+                            "description": f"{len(jupyter_result['outputs'])} documents generated successfully!",
+                            "done": True
+                        },
+                    }
+                )
+
+            trace.succeeded = True
+            if archive:
+                return f"Provide this URL to the user to download the documents:{links[0][1:]}"
+            return "Provide these URLs to the user to download the documents:\n" + "\n".join(links)
+
         except Exception as e:
+            trace.error_class = trace.error_class or getattr(e, "error_class", type(e).__name__)
             error_msg = f"Error in document generation: {str(e)}"
             if __event_emitter__:
                 await __event_emitter__(
                     {
-                        "type": "status", 
+                        "type": "status",
                         "data": {
-                            "description": error_msg, 
+                            "description": error_msg,
+                            "done": True,
+                            "hidden": False if self.valves.ENABLE_DEBUG else True,
+                        },
+                    }
+                )
+
+            return f"Error: {error_msg}"
+
+        finally:
+            await record_request(trace, list(outputs.values()) or ["unknown"], self.valves)
+
+    async def archive_documents(
+        self,
+        file_names: list[str],
+        archive_format: str = "zip",
+        # contains chat context metadata (critical: includes chat_id, message_id)
+        __metadata__: dict = None,
+        # open WebUI injects a callback function to send real-time updates to the UI
+        __event_emitter__=None,
+    ) -> str:
+        """
+        Package documents generated earlier in this chat into one archive with a single download link.
+        :param file_names: The file_name values from the download URLs of the documents to package.
+        :param archive_format: "zip" or "tar.zst".
+        """
+
+        logging.basicConfig(level=logging.INFO)
+        logger = logging.getLogger(__name__)
+        trace = RequestTrace()
+
+        archive = None
+        try:
+            if not (__metadata__ and "user_id" in __metadata__ and "chat_id" in __metadata__):
+                raise ValueError("User ID or Chat ID is not available.")
+            user_id = __metadata__["user_id"]
+            chat_id = __metadata__["chat_id"]
+
+            archive = ARCHIVE_FORMATS.get(archive_format.lower().lstrip("."))
+            if archive is None:
+                raise ValueError(f"Unknown archive format {archive_format!r}, use zip or tar.zst.")
+            if not file_names:
+                raise ValueError("No documents to archive.")
+
+            # the files live on the Jupyter volume, so the kernel writes the archive
+            ARCHIVE_CODE = f"""
+import cdproject_bootstrap
+cdproject_bootstrap.publish_archive({user_id!r}, {chat_id!r}, {list(file_names)!r}, {archive!r})
+"""
+            jupyter_result, kernel_error = await execute_on_pool(
+                self, ARCHIVE_CODE, user_id, chat_id, [archive], __event_emitter__, trace
+            )
+
+            if not (jupyter_result and jupyter_result["status"] == "ok"):
+                trace.error_class = trace.error_class or (jupyter_result or {}).get("error_class", "NoResult")
+                if kernel_error:
+                    reason = kernel_error
+                elif jupyter_result:
+                    reason = jupyter_result.get("message", "Unknown error")
+                else:
+                    reason = "No valid response from Jupyter"
+                raise Exception(reason)
+
+            file_name = jupyter_result["file_name"]
+            logger.info(
+                f"Archive {file_name}: {len(file_names)} documents, {jupyter_result['size']} bytes, "
+                f"written in {jupyter_result['elapsed_seconds']:.3f}s"
+            )
+            download_url = build_download_url(self.valves, user_id, chat_id, file_name)
+
+            # track the archive for retention and quotas
+            await record_artifacts(self, user_id, chat_id, [(file_name, jupyter_result["size"])])
+
+            # emit success status
+            if __event_emitter__:
+                await __event_emitter__(
+                    {
+                        "type": "status",
+                        "data": {
+                            "description": f"{len(file_names)} documents archived successfully!",
+                            "done": True
+                        },
+                    }
+                )
+
+            trace.succeeded = True
+            return f"Provide this URL to the user to download the archive: [documents.{archive}]({download_url})"
+
+        except Exception as e:
+            trace.error_class = trace.error_class or getattr(e, "error_class", type(e).__name__)
+            error_msg = f"Error in document archiving: {str(e)}"
+            if __event_emitter__:
+                await __event_emitter__(
+                    {
+                        "type": "status",
+                        "data": {
+                            "description": error_msg,
+                            "done": True,
+                            "hidden": False if self.valves.ENABLE_DEBUG else True,
+                        },
+                    }
+                )
+
+            return f"Error: {error_msg}"
+
+        finally:
+            await record_request(trace, [archive or "unknown"], self.valves)
+
+    async def list_templates(
+        self,
+        # contains chat context metadata (critical: includes chat_id, message_id)
+        __metadata__: dict = None,
+        # open WebUI injects a callback function to send real-time updates to the UI
+        __event_emitter__=None,
+    ) -> str:
+        """
+        List the house-style templates that create_document and create_documents can start from (template parameter).
+        """
+
+        logging.basicConfig(level=logging.INFO)
+        trace = RequestTrace()
+
+        try:
+            if not (__metadata__ and "user_id" in __metadata__ and "chat_id" in __metadata__):
+                raise ValueError("User ID or Chat ID is not available.")
+            user_id = __metadata__["user_id"]
+            chat_id = __metadata__["chat_id"]
+
+            # the templates live on the Jupyter volume, so a kernel lists the ones it has loaded
+            TEMPLATES_CODE = """
+import cdproject_bootstrap
+cdproject_bootstrap.publish_templates()
+"""
+            jupyter_result, kernel_error = await execute_on_pool(
+                self, TEMPLATES_CODE, user_id, chat_id, [], __event_emitter__, trace
+            )
+            if not (jupyter_result and jupyter_result["status"] == "ok"):
+                raise Exception(kernel_error or "No valid response from Jupyter")
+
+            templates = jupyter_result["templates"]
+            if __event_emitter__:
+                await __event_emitter__(
+                    {
+                        "type": "status",
+                        "data": {
+                            "description": f"{len(templates)} templates available",
+                            "done": True,
+                        },
+                    }
+                )
+            if not templates:
+                return "No templates are installed, write the whole document in the code."
+            lines = [
+                f"- {t['name']} ({t['type']})" + (f": {t['description']}" if t["description"] else "")
+                for t in templates
+            ]
+            return "Available templates:\n" + "\n".join(lines)
+
+        except Exception as e:
+            error_msg = f"Error in listing templates: {str(e)}"
+            if __event_emitter__:
+                await __event_emitter__(
+                    {
+                        "type": "status",
+                        "data": {
+                            "description": error_msg,
                             "done": True,
                             "hidden": False if self.valves.ENABLE_DEBUG else True,
                         },
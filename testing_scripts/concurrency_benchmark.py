@@ -0,0 +1,88 @@
+"""
+Fire N simultaneous create_document calls at the stub Jupyter server and
+check that they interleave on one event loop instead of serializing.
+
+Also samples event loop lag while the calls run: a blocking transport shows
+lag close to the execution delay, a non-blocking one stays near zero.
+
+Usage:  python concurrency_benchmark.py --calls 16 --pool-size 8 --exec-delay 0.5
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CD_ProJect import Tools  # noqa: E402
+import stub_jupyter_server  # noqa: E402
+
+
+async def measure_loop_lag(stop: asyncio.Event, lags: list):
+    while not stop.is_set():
+        before = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append(time.perf_counter() - before - 0.01)
+
+
+async def main(args):
+    runner, base_url, stats = await stub_jupyter_server.start(exec_delay=args.exec_delay)
+
+    tools = Tools()
+    tools.valves = tools.Valves(
+        JUPYTER_URL=base_url,
+        JUPYTER_TOKEN="stub",
+        KERNEL_POOL_MIN_SIZE=args.pool_size,
+        KERNEL_POOL_MAX_SIZE=args.pool_size,
+        MAX_CONCURRENT_EXECUTIONS=args.pool_size,
+    )
+
+    async def one_call(i: int) -> float:
+        started = time.perf_counter()
+        result = await tools.create_document(
+            document_extension="docx",
+            document_name=f"bench-{i}",
+            # the stub never runs it, but it has to pass the pre-flight checks
+            code='import docx\ndocx.Document().save("bench.docx")',
+            __metadata__={"user_id": f"user-{i}", "chat_id": f"chat-{i}"},
+        )
+        if not result.startswith("Provide this URL"):
+            raise RuntimeError(result)
+        return time.perf_counter() - started
+
+    # warm the pool first so the numbers show steady-state behaviour
+    await one_call(-1)
+    await tools.kernel_pool.fill(tools.valves)
+
+    stop = asyncio.Event()
+    lags = []
+    lag_task = asyncio.create_task(measure_loop_lag(stop, lags))
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(one_call(i) for i in range(args.calls)))
+    wall = time.perf_counter() - started
+
+    stop.set()
+    await lag_task
+    await tools.kernel_pool.close()
+    await runner.cleanup()
+
+    latencies.sort()
+    print(f"calls:                {args.calls}")
+    print(f"pool size:            {args.pool_size}")
+    print(f"exec delay per call:  {args.exec_delay:.3f}s")
+    print(f"wall time:            {wall:.3f}s")
+    print(f"serialized estimate:  {args.calls * latencies[0]:.3f}s")
+    print(f"latency min/p50/max:  {latencies[0]:.3f}s / {latencies[len(latencies) // 2]:.3f}s / {latencies[-1]:.3f}s")
+    print(f"max event loop lag:   {max(lags) * 1000:.1f}ms")
+    print(f"stub kernel stats:    {stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="create_document concurrency benchmark")
+    parser.add_argument("--calls", type=int, default=16)
+    parser.add_argument("--pool-size", type=int, default=8)
+    parser.add_argument("--exec-delay", type=float, default=0.5)
+    asyncio.run(main(parser.parse_args()))
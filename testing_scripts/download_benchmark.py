@@ -0,0 +1,139 @@
+"""
+Load test for user_files_webserver.py with a local aiohttp client.
+
+Creates a few documents in a temporary folder, serves them from the download
+server in the same process and hammers it with concurrent keep-alive clients
+doing full downloads, range requests and conditional (304) requests.
+With --secret every link is signed like the tool does with DOWNLOAD_URL_SECRET.
+
+Usage:  python download_benchmark.py --clients 32 --requests 2000 --file-mb 4
+"""
+
+import argparse
+import asyncio
+import os
+import secrets
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from user_files_webserver import DOWNLOAD_PATH, DownloadServer, sign_download  # noqa: E402
+
+
+def make_documents(directory: str, count: int, size: int) -> list:
+    folder = os.path.join(directory, "bench-user", "bench-chat")
+    os.makedirs(folder)
+    names = []
+    for i in range(count):
+        name = secrets.token_urlsafe(16) + (".pdf" if i % 2 else ".xlsx")
+        with open(os.path.join(folder, name), "wb") as f:
+            f.write(os.urandom(size))
+        names.append(name)
+    return names
+
+
+def percentile(values: list, p: float) -> float:
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        size = int(args.file_mb * 1024 * 1024)
+        names = make_documents(directory, args.files, size)
+
+        server = await DownloadServer(directory, secret=args.secret).start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        base_url = f"http://127.0.0.1:{port}{DOWNLOAD_PATH}"
+
+        def url(name: str) -> str:
+            unsigned = f"{base_url}?user_id=bench-user&chat_id=bench-chat&file_name={name}"
+            if not args.secret:
+                return unsigned
+            expires = str(int(time.time()) + 3600)
+            signature = sign_download(args.secret, "bench-user", "bench-chat", name, expires)
+            return f"{unsigned}&expires={expires}&signature={signature}"
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.clients)) as session:
+            # sanity checks before measuring
+            async with session.get(url(names[0])) as response:
+                assert response.status == 200 and len(await response.read()) == size
+                etag = response.headers["ETag"]
+            async with session.get(url(names[0]), headers={"Range": "bytes=10-19"}) as response:
+                assert response.status == 206 and len(await response.read()) == 10
+            async with session.get(url(names[0]), headers={"If-None-Match": etag}) as response:
+                assert response.status == 304
+            async with session.get(url(names[0]), headers={"Range": f"bytes={size}-"}) as response:
+                assert response.status == 416
+            async with session.get(f"{base_url}?user_id=..&chat_id=bench-chat&file_name={names[0]}") as response:
+                assert response.status in (403, 404)
+            if args.secret:
+                async with session.get(url(names[0]).replace("&expires=", "&expires=1")) as response:
+                    assert response.status == 403
+
+            etags = {}
+            for name in names:
+                async with session.head(url(name)) as response:
+                    etags[name] = response.headers["ETag"]
+
+            kinds = ("full", "range", "conditional")
+            latencies = {kind: [] for kind in kinds}
+            transferred = 0
+            queue = asyncio.Queue()
+            for i in range(args.requests):
+                queue.put_nowait((kinds[i % len(kinds)] if args.mixed else "full", names[i % len(names)]))
+
+            async def client():
+                nonlocal transferred
+                while not queue.empty():
+                    kind, name = queue.get_nowait()
+                    headers = {}
+                    if kind == "range":
+                        start = secrets.randbelow(size - 65536)
+                        headers["Range"] = f"bytes={start}-{start + 65535}"
+                    elif kind == "conditional":
+                        headers["If-None-Match"] = etags[name]
+                    started = time.perf_counter()
+                    async with session.get(url(name), headers=headers) as response:
+                        async for chunk in response.content.iter_chunked(1 << 20):
+                            transferred += len(chunk)
+                        if response.status not in (200, 206, 304):
+                            raise RuntimeError(f"{kind} request returned {response.status}")
+                    latencies[kind].append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(client() for _ in range(args.clients)))
+            wall = time.perf_counter() - started
+
+        server.close()
+        await server.wait_closed()
+
+    print(f"clients:              {args.clients}")
+    print(f"requests:             {args.requests}")
+    print(f"file size:            {args.file_mb} MB x {args.files}")
+    print(f"signed links:         {bool(args.secret)}")
+    print(f"wall time:            {wall:.3f}s")
+    print(f"throughput:           {args.requests / wall:.0f} req/s, {transferred / wall / 1024 / 1024:.0f} MB/s")
+    for kind in kinds:
+        values = sorted(latencies[kind])
+        if values:
+            print(
+                f"{kind + ' p50/p95/p99:':<26}"
+                f"{percentile(values, 0.5) * 1000:.1f}ms / "
+                f"{percentile(values, 0.95) * 1000:.1f}ms / "
+                f"{percentile(values, 0.99) * 1000:.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="download server load test")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--file-mb", type=float, default=4)
+    parser.add_argument("--secret", default="", help="serve and request signed links")
+    parser.add_argument("--full-only", dest="mixed", action="store_false", help="only full downloads")
+    asyncio.run(main(parser.parse_args()))
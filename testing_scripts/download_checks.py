@@ -0,0 +1,131 @@
+"""
+Behaviour checks for the security-relevant paths of user_files_webserver.py:
+signed link verification, Range parsing and symlink refusal. Runs without
+starting the server.
+
+Usage:  python download_checks.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import CD_ProJect  # noqa: E402
+from user_files_webserver import DownloadServer, HttpError, open_document, parse_range, sign_download  # noqa: E402
+
+SECRET = "check-secret"
+
+
+def status(function, *args) -> int:
+    """
+    HTTP status function raised, 200 when it returned
+    """
+    try:
+        function(*args)
+    except HttpError as e:
+        return e.status
+    return 200
+
+
+def query(user_id="u1", chat_id="c1", file_name="doc.docx", expires=None, signature=None, sign_as=None) -> str:
+    """
+    query string of a link, signed for sign_as (user_id, chat_id, file_name) unless a signature is given
+    """
+    expires = str(int(time.time()) + 60) if expires is None else expires
+    if signature is None:
+        signature = sign_download(SECRET, *(sign_as or (user_id, chat_id, file_name)), expires)
+    params = {"user_id": user_id, "chat_id": chat_id, "file_name": file_name}
+    if expires != "-":
+        params["expires"] = expires
+    if signature != "-":
+        params["signature"] = signature
+    return urlencode(params)
+
+
+def check_signed_links(server: DownloadServer):
+    path, file_name, max_age = server._resolve(query())
+    assert path == os.path.join(server.directory, "u1", "c1", "doc.docx") and file_name == "doc.docx"
+    # caches must not outlive the link
+    assert 0 < max_age <= 60
+
+    assert status(server._resolve, query(expires=str(int(time.time()) - 1))) == 403
+    assert status(server._resolve, query(user_id="u2", sign_as=("u1", "c1", "doc.docx"))) == 403
+    assert status(server._resolve, query(chat_id="c2", sign_as=("u1", "c1", "doc.docx"))) == 403
+    assert status(server._resolve, query(file_name="other.docx", sign_as=("u1", "c1", "doc.docx"))) == 403
+    assert status(server._resolve, query(signature="0" * 64)) == 403
+    assert status(server._resolve, query(signature="-")) == 403
+    assert status(server._resolve, query(expires="-", signature="")) == 403
+    assert status(server._resolve, query(expires="soon")) == 403
+    assert status(server._resolve, query(expires="-60")) == 403
+    # a valid signature does not let a bad name through
+    assert status(server._resolve, query(file_name="../../etc/passwd")) == 404
+
+    # links built by the tool are accepted
+    valves = CD_ProJect.Tools.Valves(DOWNLOAD_URL_SECRET=SECRET, BASE_DOWNLOAD_URL="http://files/backend-api/files/download")
+    url = CD_ProJect.build_download_url(valves, "u1", "c1", "doc.docx")
+    assert server._resolve(urlsplit(url).query)[1] == "doc.docx"
+
+
+def check_ranges():
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=-500", 100) == (0, 99)
+    assert parse_range("bytes=50-500", 100) == (50, 99)
+    # malformed and multi-range headers get the whole file
+    assert parse_range("bytes=a-b", 100) is None
+    assert parse_range("items=0-9", 100) is None
+    assert parse_range("bytes=0-9,20-29", 100) is None
+    assert parse_range("bytes=-", 100) is None
+    assert status(parse_range, "bytes=100-", 100) == 416
+    assert status(parse_range, "bytes=9-0", 100) == 416
+    assert status(parse_range, "bytes=-0", 100) == 416
+    assert status(parse_range, "bytes=0-", 0) == 416
+
+
+def check_symlinks(directory: str):
+    folder = os.path.join(directory, "u1", "c1")
+    os.makedirs(folder)
+    with open(os.path.join(folder, "doc.docx"), "wb") as f:
+        f.write(b"document")
+    outside = os.path.join(directory, "outside")
+    os.makedirs(outside)
+    with open(os.path.join(outside, "secret.txt"), "wb") as f:
+        f.write(b"host file")
+    os.symlink(os.path.join(outside, "secret.txt"), os.path.join(folder, "link.txt"))
+    os.symlink(outside, os.path.join(directory, "u1", "c2"))
+
+    with open_document(os.path.join(folder, "doc.docx")) as f:
+        assert f.read() == b"document"
+    for path in (os.path.join(folder, "link.txt"), os.path.join(directory, "u1", "c2", "secret.txt"), folder):
+        try:
+            open_document(path).close()
+        except FileNotFoundError:
+            continue
+        raise AssertionError(f"{path} was opened")
+
+    server = DownloadServer(directory)
+    metadata = server.metadata
+    assert asyncio.run(metadata.get(os.path.join(folder, "doc.docx"))).size == len(b"document")
+    try:
+        asyncio.run(metadata.get(os.path.join(folder, "link.txt")))
+    except FileNotFoundError:
+        pass
+    else:
+        raise AssertionError("symlink metadata was served")
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        check_signed_links(DownloadServer(directory, secret=SECRET))
+        print("check_signed_links: ok")
+        check_ranges()
+        print("check_ranges: ok")
+        check_symlinks(directory)
+        print("check_symlinks: ok")
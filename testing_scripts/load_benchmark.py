@@ -0,0 +1,290 @@
+"""
+Load test for create_document: drives Tools.create_document with a fixed
+number of concurrent clients across representative docx/xlsx/pdf/pptx/md
+workloads and reports latency percentiles, throughput and kernel counts.
+
+By default it runs against the stub Jupyter server (per-format delays with
+jitter, nothing is executed), with --jupyter-url against a real local Jupyter
+server that renders the documents for real (md needs pandoc installed), and
+with --local against the local fork-server backend (EXECUTION_BACKEND=local).
+--backends N starts N stub servers and spreads the load across them the way a
+comma separated JUPYTER_URL does (--routing picks the JUPYTER_ROUTING mode).
+
+Save a run with --save and compare later runs against it with --baseline:
+the script exits with status 1 when p95 latency or throughput regress by
+more than --max-regression.
+
+Usage:  python load_benchmark.py --concurrency 16 --requests 200
+        python load_benchmark.py --jupyter-url http://127.0.0.1:8888 --token TOKEN --concurrency 4 --requests 40
+        python load_benchmark.py --local --concurrency 4 --requests 40
+        python load_benchmark.py --backends 3 --pool-size 4 --concurrency 12 --requests 300
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CD_ProJect import Tools  # noqa: E402
+import stub_jupyter_server  # noqa: E402
+
+# (extension, code) of a typical small report per format
+WORKLOADS = {
+    "docx": (
+        "docx",
+        """
+import docx
+document = docx.Document()
+document.add_heading("Quarterly report", 0)
+for i in range(40):
+    document.add_paragraph(f"Paragraph {i}: " + "lorem ipsum dolor sit amet " * 8)
+table = document.add_table(rows=21, cols=4)
+for row in range(21):
+    for col in range(4):
+        table.cell(row, col).text = str(row * col)
+document.save("report.docx")
+""",
+    ),
+    "xlsx": (
+        "xlsx",
+        """
+import openpyxl
+workbook = openpyxl.Workbook()
+sheet = workbook.active
+sheet.append(["id", "name", "amount", "ratio"])
+for i in range(2000):
+    sheet.append([i, f"item {i}", i * 3.5, i / 2000])
+workbook.save("report.xlsx")
+""",
+    ),
+    "pdf": (
+        "pdf",
+        """
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+pdf = canvas.Canvas("report.pdf", pagesize=A4)
+for page in range(10):
+    for line in range(50):
+        pdf.drawString(40, 800 - line * 15, f"Page {page} line {line}: lorem ipsum dolor sit amet")
+    pdf.showPage()
+pdf.save()
+""",
+    ),
+    "pptx": (
+        "pptx",
+        """
+from pptx import Presentation
+presentation = Presentation()
+for i in range(10):
+    slide = presentation.slides.add_slide(presentation.slide_layouts[1])
+    slide.shapes.title.text = f"Slide {i}"
+    slide.placeholders[1].text = "\\n".join(f"Point {j}" for j in range(5))
+presentation.save("report.pptx")
+""",
+    ),
+    "md": (
+        "md",
+        """
+import pypandoc
+text = "\\n\\n".join(f"## Section {i}\\n\\n" + "lorem ipsum dolor sit amet " * 20 for i in range(30))
+pypandoc.convert_text(text, "markdown", format="md", outputfile="report.md")
+""",
+    ),
+}
+
+# stub execution delay per format, roughly what the workloads take in a warm kernel
+STUB_DELAYS = {"docx": 0.12, "xlsx": 0.25, "pdf": 0.15, "pptx": 0.2, "md": 0.1}
+
+
+def percentile(values: list, p: float) -> float:
+    return values[min(int(len(values) * p), len(values) - 1)] if values else 0.0
+
+
+def summarize(latencies: list) -> dict:
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+    }
+
+
+async def sample_kernels(tools: Tools, base_url: str, token: str, stop: asyncio.Event, kernels: dict):
+    """
+    highest pool occupancy and server-side kernel count seen during the run
+    """
+    headers = {"Authorization": f"token {token}"}
+    async with aiohttp.ClientSession(headers=headers) as session:
+        while not stop.is_set():
+            pool = tools.kernel_pool
+            if pool is not None:
+                kernels["max_pool_busy"] = max(kernels["max_pool_busy"], len(pool.busy))
+                kernels["max_pool_size"] = max(kernels["max_pool_size"], len(pool.busy) + len(pool.idle))
+            server_kernels = 0
+            for url in filter(None, base_url.split(",")):
+                async with session.get(f"{url}/api/kernels") as response:
+                    if response.status == 200:
+                        server_kernels += len(await response.json())
+            kernels["max_server_kernels"] = max(kernels["max_server_kernels"], server_kernels)
+            await asyncio.sleep(0.05)
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list:
+    """
+    human readable regressions of results against a saved baseline
+    """
+    regressions = []
+    if results["throughput"] < baseline["throughput"] * (1 - max_regression):
+        regressions.append(f"throughput {results['throughput']:.2f}/s < baseline {baseline['throughput']:.2f}/s")
+    for name, summary in results["workloads"].items():
+        previous = baseline["workloads"].get(name)
+        if previous and summary["p95"] > previous["p95"] * (1 + max_regression):
+            regressions.append(f"{name} p95 {summary['p95']:.3f}s > baseline {previous['p95']:.3f}s")
+    return regressions
+
+
+async def main(args) -> int:
+    names = args.workloads.split(",")
+    runners = []
+    data_dir = None
+    if args.local:
+        data_dir = tempfile.TemporaryDirectory()
+        base_url, token = "", ""
+    elif args.jupyter_url:
+        base_url, token = args.jupyter_url.rstrip("/"), args.token
+    else:
+        delays = {extension: STUB_DELAYS[name] for name, (extension, _) in WORKLOADS.items()}
+        urls = []
+        for _ in range(args.backends):
+            runner, url, stats = await stub_jupyter_server.start(delays=delays, jitter=args.jitter)
+            runners.append((runner, stats))
+            urls.append(url)
+        base_url, token = ",".join(urls), "stub"
+
+    tools = Tools()
+    tools.valves = tools.Valves(
+        EXECUTION_BACKEND="local" if args.local else "jupyter",
+        DATA_DIR=data_dir.name if data_dir else "/mnt/data",
+        JUPYTER_URL=base_url,
+        JUPYTER_TOKEN=token,
+        JUPYTER_ROUTING=args.routing,
+        KERNEL_POOL_MIN_SIZE=args.pool_size,
+        KERNEL_POOL_MAX_SIZE=args.pool_size,
+        MAX_CONCURRENT_EXECUTIONS=args.pool_size,
+        RESULT_CACHE_ENABLED=False,
+    )
+
+    failures = []
+
+    async def one_call(name: str, i: int) -> float:
+        extension, code = WORKLOADS[name]
+        started = time.perf_counter()
+        result = await tools.create_document(
+            document_extension=extension,
+            document_name=f"bench-{name}-{i}",
+            code=code,
+            __metadata__={"user_id": f"bench-user-{i % 16}", "chat_id": f"bench-chat-{i % 8}"},
+        )
+        if not result.startswith("Provide this URL"):
+            failures.append(f"{name}: {result[:200]}")
+        return time.perf_counter() - started
+
+    # warm the pool and every workload first so the numbers show steady-state behaviour
+    for name in names:
+        await one_call(name, -1)
+    await tools.kernel_pool.fill(tools.valves)
+    failures.clear()
+
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait((names[i % len(names)], i))
+    latencies = {name: [] for name in names}
+
+    async def client():
+        while not queue.empty():
+            name, i = queue.get_nowait()
+            latencies[name].append(await one_call(name, i))
+
+    stop = asyncio.Event()
+    kernels = {"max_pool_busy": 0, "max_pool_size": 0, "max_server_kernels": 0}
+    sampler = asyncio.create_task(sample_kernels(tools, base_url, token, stop, kernels))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    wall = time.perf_counter() - started
+
+    stop.set()
+    await sampler
+    await tools.kernel_pool.close()
+    for i, (runner, stats) in enumerate(runners):
+        kernels[f"stub{i}" if len(runners) > 1 else "stub"] = dict(stats)
+        await runner.cleanup()
+    if data_dir is not None:
+        data_dir.cleanup()
+
+    results = {
+        "backend": "local" if args.local else "jupyter" if args.jupyter_url else "stub",
+        "concurrency": args.concurrency,
+        "pool_size": args.pool_size,
+        "backends": len(runners) or len(base_url.split(",")),
+        "requests": args.requests,
+        "failures": len(failures),
+        "wall_seconds": wall,
+        "throughput": args.requests / wall,
+        "workloads": {name: summarize(values) for name, values in latencies.items()},
+        "overall": summarize([value for values in latencies.values() for value in values]),
+        "kernels": kernels,
+    }
+
+    print(f"backend:              {results['backend']} ({base_url or data_dir.name})")
+    print(f"concurrency / pool:   {args.concurrency} / {args.pool_size} x {results['backends']} server(s)")
+    print(f"requests:             {args.requests} ({len(failures)} failed)")
+    print(f"wall time:            {wall:.3f}s")
+    print(f"throughput:           {results['throughput']:.2f} documents/s")
+    for name, summary in [*results["workloads"].items(), ("overall", results["overall"])]:
+        print(
+            f"{name + ' p50/p95/p99:':<22}"
+            f"{summary['p50']:.3f}s / {summary['p95']:.3f}s / {summary['p99']:.3f}s"
+        )
+    print(f"kernels:              {kernels}")
+    for failure in failures[:5]:
+        print(f"failure:              {failure}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION:           {regression}")
+        if regressions:
+            return 1
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="create_document load test")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--pool-size", type=int, default=8)
+    parser.add_argument("--workloads", default="docx,xlsx,pdf,pptx,md")
+    parser.add_argument("--jitter", type=float, default=0.5, help="stub only: random extra delay fraction")
+    parser.add_argument("--backends", type=int, default=1, help="stub only: number of stub servers to shard across")
+    parser.add_argument("--routing", default="least_loaded", help="JUPYTER_ROUTING when several servers are used")
+    parser.add_argument("--jupyter-url", default="", help="benchmark a real Jupyter server instead of the stub")
+    parser.add_argument("--token", default="")
+    parser.add_argument("--local", action="store_true", help="benchmark the local fork-server backend")
+    parser.add_argument("--save", default="", help="write the results to this JSON file")
+    parser.add_argument("--baseline", default="", help="compare against results saved with --save")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed p95/throughput regression")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,97 @@
+"""
+Behaviour checks for the pre-flight helpers in CD_ProJect.py: preflight,
+_dotted_name and _saved_path. Pure functions, no Jupyter server needed.
+
+Usage:  python preflight_checks.py
+"""
+
+import ast
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CD_ProJect import PreflightError, _dotted_name, _saved_path, preflight  # noqa: E402
+
+
+def call(source: str) -> ast.Call:
+    return ast.parse(source).body[0].value
+
+
+def rejected(code: str, outputs: dict, template: bool = False) -> str:
+    """
+    error_class preflight raised, None when the code passed
+    """
+    try:
+        preflight(code, outputs, template)
+    except PreflightError as e:
+        return e.error_class
+    return None
+
+
+def check_dotted_name():
+    assert _dotted_name(call("os._exit(1)").func, {}) == "os._exit"
+    assert _dotted_name(call("o._exit(1)").func, {"o": "os"}) == "os._exit"
+    assert _dotted_name(call("_exit(1)").func, {"_exit": "os._exit"}) == "os._exit"
+    assert _dotted_name(call("a.b.c()").func, {}) == "a.b.c"
+    # calls on an expression have no name
+    assert _dotted_name(call("make().save('x.docx')").func, {}) is None
+
+
+def check_saved_path():
+    assert _saved_path(call("doc.save('report.docx')"), "save") == "report.docx"
+    assert _saved_path(call("doc.save(filename='report.docx')"), "save") == "report.docx"
+    assert _saved_path(call("df.to_csv(path_or_buf='raw.csv')"), "to_csv") == "raw.csv"
+    # computed names can't be checked
+    assert _saved_path(call("doc.save(name)"), "save") is None
+    assert _saved_path(call("doc.save(f'{name}.docx')"), "save") is None
+    # pypandoc's first argument is the source text, not the file
+    assert _saved_path(call("pypandoc.convert_text('# hi', 'docx', outputfile='out.docx')"), "convert_text") == "out.docx"
+    assert _saved_path(call("pypandoc.convert_text('out.md', 'docx')"), "convert_text") is None
+
+
+def check_preflight():
+    docx = "import docx\ndocx.Document().save('report.docx')"
+    assert rejected(docx, {"": "docx"}) is None
+    assert rejected("import docx\nd = docx.Document(", {"": "docx"}) == "SyntaxError"
+    assert rejected("pass", {"": "docx"}) == "MissingWriter"
+    # a template brings its own document
+    assert rejected("pass", {"": "docx"}, template=True) is None
+    # formats without a native writer go through pypandoc
+    assert rejected("import pypandoc\npypandoc.convert_text('# hi', 'rtf', format='md', outputfile='a.rtf')", {"": "rtf"}) is None
+    assert rejected("import pandas as pd\npd.DataFrame().to_excel('out.xlsx')", {"": "xlsx"}) is None
+    # text formats can be written with a plain open()
+    assert rejected("with open('notes.txt', 'w') as f:\n    f.write('hi')", {"": "txt"}) is None
+    assert rejected("import csv\ncsv.writer(open('rows.csv', 'w')).writerow([1])", {"": "csv"}) is None
+
+    # IPython syntax the kernel accepts
+    assert rejected("!pip install python-docx\n%matplotlib inline\n" + docx, {"": "docx"}) is None
+    assert rejected("import asyncio, docx\nawait asyncio.sleep(0)\ndocx.Document().save('a.docx')", {"": "docx"}) is None
+    assert rejected("%matplotlib inline\n" + docx + "\nget_ipython().kernel", {"": "docx"}) == "ForbiddenCall"
+
+    assert rejected(docx + "\nimport sys\nsys.exit(0)", {"": "docx"}) == "ForbiddenCall"
+    assert rejected(docx + "\nfrom os import _exit as bye\nbye(0)", {"": "docx"}) == "ForbiddenCall"
+    assert rejected(docx + "\nimport cdproject_bootstrap", {"": "docx"}) == "ForbiddenCall"
+
+    # a single document may be saved under any name with its extension
+    assert rejected("import docx\ndocx.Document().save('anything.docx')", {"": "docx"}) is None
+    assert rejected("import docx\ndocx.Document().save('report.pdf')", {"": "docx"}) == "ExtensionMismatch"
+    # other files, like a chart image, are not documents
+    assert rejected(docx + "\nimport matplotlib.pyplot as plt\nplt.savefig('chart.png')", {"": "docx"}) is None
+
+    batch = {"summary": "pdf", "deck": "pptx", "notes": "docx", "appendix": "docx"}
+    code = (
+        "import docx, pptx\nfrom reportlab.pdfgen import canvas\n"
+        "canvas.Canvas('summary.pdf').save()\npptx.Presentation().save('slides.pptx')\n"
+        "docx.Document().save('notes.docx')\n"
+    )
+    assert rejected(code, batch) is None
+    # two docx outputs, so the name has to pick one
+    assert rejected(code + "docx.Document().save('other.docx')", batch) == "ExtensionMismatch"
+    assert rejected("import docx\ndocx.Document().save('x.docx')", {"a": "docx", "b": "xlsx"}) == "MissingWriter"
+
+
+if __name__ == "__main__":
+    for check in (check_dotted_name, check_saved_path, check_preflight):
+        check()
+        print(f"{check.__name__}: ok")
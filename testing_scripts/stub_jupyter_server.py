@@ -0,0 +1,197 @@
+"""
+Minimal stand-in for the Jupyter kernel REST API and channels websocket.
+
+It does not run any code: every execute_request is answered after a delay
+with the messages a real kernel would send for the wrapper
+(busy -> display_data with the result -> execute_reply -> idle).
+Executions on the same kernel are serialized, like a real kernel.
+
+The delay can differ per document format (read from the wrapper's begin()
+call) and get random jitter, so benchmarks see a realistic latency spread.
+
+Run standalone:  python stub_jupyter_server.py --port 8899 --exec-delay 0.5 --delay docx=0.3 --delay pdf=0.8
+"""
+
+from aiohttp import web
+import argparse
+import asyncio
+import hashlib
+import secrets
+import random
+import uuid
+import json
+import time
+import re
+
+# must match RESULT_MIME_TYPE in CD_ProJect.py
+RESULT_MIME_TYPE = "application/vnd.cdproject.result+json"
+
+# the extension argument of cdproject_bootstrap.begin() in the wrapper
+BEGIN_PATTERN = re.compile(r"cdproject_bootstrap\.begin\([^,]+, [^,]+, '(\w+)'")
+
+
+def reply(parent: dict, msg_type: str, content: dict, channel: str = "iopub") -> str:
+    return json.dumps(
+        {
+            "header": {
+                "msg_id": uuid.uuid4().hex,
+                "msg_type": msg_type,
+                "session": parent["header"]["session"],
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "version": "5.3",
+            },
+            "msg_type": msg_type,
+            "parent_header": parent["header"],
+            "metadata": {},
+            "content": content,
+            "channel": channel,
+            "buffers": [],
+        }
+    )
+
+
+def create_app(exec_delay: float = 0.5, delays: dict = None, jitter: float = 0.0) -> web.Application:
+    """
+    delays maps a document extension to its execution delay (exec_delay for
+    the rest), jitter adds up to that fraction of the delay at random
+    """
+    kernels = {}
+    locks = {}
+    delays = delays or {}
+    stats = {"created": 0, "deleted": 0, "executions": 0, "interrupts": 0, "max_kernels": 0, "max_busy": 0}
+
+    async def list_kernels(request):
+        return web.json_response(list(kernels.values()))
+
+    async def start_kernel(request):
+        kernel_id = str(uuid.uuid4())
+        kernels[kernel_id] = {"id": kernel_id, "name": "python3", "execution_state": "idle"}
+        locks[kernel_id] = asyncio.Lock()
+        stats["created"] += 1
+        stats["max_kernels"] = max(stats["max_kernels"], len(kernels))
+        return web.json_response(kernels[kernel_id], status=201)
+
+    async def get_kernel(request):
+        kernel = kernels.get(request.match_info["kernel_id"])
+        if kernel is None:
+            raise web.HTTPNotFound()
+        return web.json_response(kernel)
+
+    async def delete_kernel(request):
+        kernel_id = request.match_info["kernel_id"]
+        if kernels.pop(kernel_id, None) is None:
+            raise web.HTTPNotFound()
+        locks.pop(kernel_id, None)
+        stats["deleted"] += 1
+        return web.Response(status=204)
+
+    async def interrupt_kernel(request):
+        if request.match_info["kernel_id"] not in kernels:
+            raise web.HTTPNotFound()
+        stats["interrupts"] += 1
+        return web.Response(status=204)
+
+    async def restart_kernel(request):
+        kernel = kernels.get(request.match_info["kernel_id"])
+        if kernel is None:
+            raise web.HTTPNotFound()
+        return web.json_response(kernel)
+
+    async def get_status(request):
+        return web.json_response({"kernels": len(kernels), "connections": 0})
+
+    async def get_stats(request):
+        return web.json_response({**stats, "kernels": len(kernels)})
+
+    async def channels(request):
+        kernel_id = request.match_info["kernel_id"]
+        if kernel_id not in kernels:
+            raise web.HTTPNotFound()
+
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+
+        async def run(msg):
+            code = msg["content"].get("code", "")
+            match = BEGIN_PATTERN.search(code)
+            extension = match.group(1) if match else "stub"
+            delay = delays.get(extension, exec_delay) * (1 + random.uniform(0, jitter))
+
+            async with locks[kernel_id]:
+                stats["executions"] += 1
+                kernels[kernel_id]["execution_state"] = "busy"
+                stats["max_busy"] = max(
+                    stats["max_busy"], sum(k["execution_state"] == "busy" for k in kernels.values())
+                )
+                await ws.send_str(reply(msg, "status", {"execution_state": "busy"}))
+                await asyncio.sleep(delay)
+                if "publish_library_versions" in code:
+                    # the pool's bootstrap, lets the result cache work against the stub
+                    result = {"status": "ok", "versions": {"stub": "1"}}
+                else:
+                    result = {
+                        "status": "ok",
+                        "file_name": secrets.token_urlsafe(16) + "." + extension,
+                        "size": 0,
+                        "sha256": hashlib.sha256(b"").hexdigest(),
+                        "elapsed_seconds": delay,
+                        "stages": {"reset": 0.0, "user_code": delay, "finalize": 0.0},
+                        "max_rss_mb": 128.0,
+                    }
+                await ws.send_str(reply(msg, "display_data", {"data": {RESULT_MIME_TYPE: result}, "metadata": {}}))
+                await ws.send_str(
+                    reply(msg, "execute_reply", {"status": "ok", "execution_count": 1}, channel="shell")
+                )
+                await ws.send_str(reply(msg, "status", {"execution_state": "idle"}))
+                if kernel_id in kernels:
+                    kernels[kernel_id]["execution_state"] = "idle"
+
+        tasks = set()
+        async for raw_msg in ws:
+            msg = json.loads(raw_msg.data)
+            if msg["header"]["msg_type"] == "execute_request":
+                task = asyncio.create_task(run(msg))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        for task in tasks:
+            task.cancel()
+        return ws
+
+    app = web.Application()
+    app.router.add_get("/api/status", get_status)
+    app.router.add_get("/api/kernels", list_kernels)
+    app.router.add_post("/api/kernels", start_kernel)
+    app.router.add_get("/api/kernels/{kernel_id}", get_kernel)
+    app.router.add_delete("/api/kernels/{kernel_id}", delete_kernel)
+    app.router.add_post("/api/kernels/{kernel_id}/interrupt", interrupt_kernel)
+    app.router.add_post("/api/kernels/{kernel_id}/restart", restart_kernel)
+    app.router.add_get("/api/kernels/{kernel_id}/channels", channels)
+    app.router.add_get("/stub/stats", get_stats)
+    app["stats"] = stats
+    return app
+
+
+async def start(port: int = 0, exec_delay: float = 0.5, delays: dict = None, jitter: float = 0.0):
+    """
+    start the stub in the running loop, returns (runner, base_url, stats)
+    """
+    app = create_app(exec_delay, delays, jitter)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}", app["stats"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub Jupyter kernel server")
+    parser.add_argument("--port", type=int, default=8899)
+    parser.add_argument("--exec-delay", type=float, default=0.5)
+    parser.add_argument("--delay", action="append", default=[], help="per-format delay, e.g. pdf=0.8")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra delay, as a fraction of the delay")
+    args = parser.parse_args()
+
+    delays = {extension: float(seconds) for extension, seconds in (item.split("=") for item in args.delay)}
+    web.run_app(create_app(args.exec_delay, delays, args.jitter), host="127.0.0.1", port=args.port)
@@ -0,0 +1,413 @@
+"""
+Download server for the documents created by the CD ProJect tool.
+
+Serves DIRECTORY/{user_id}/{chat_id}/{file_name} at /backend-api/files/download,
+the URL the tool builds from BASE_DOWNLOAD_URL. Standard library only:
+
+- files are streamed with loop.sendfile (zero-copy where the OS supports it)
+- single byte ranges (Range / If-Range) for resumable and partial downloads
+- strong ETags and long-lived immutable caching, document names are random
+  tokens and never rewritten
+- an in-memory metadata cache, so repeated downloads do not stat the file again
+- ids and file names are validated before anything touches the disk, and
+  symlinks anywhere below DIRECTORY are refused (the kernel can create them)
+- with a secret (--secret or CDPROJECT_DOWNLOAD_SECRET, the tool's DOWNLOAD_URL_SECRET)
+  only signed, unexpired links are served; the HMAC is checked first, so guessed
+  and scraped URLs are rejected without any filesystem lookup
+
+Usage:  python user_files_webserver.py --directory /opt/openwebui/jupyter_data/user_files --port 8081
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from email.utils import formatdate
+from urllib.parse import parse_qs, urlsplit
+import mimetypes
+import argparse
+import asyncio
+import logging
+import hashlib
+import errno
+import hmac
+import json
+import stat
+import time
+import os
+import re
+
+DOWNLOAD_PATH = "/backend-api/files/download"
+
+# Open WebUI ids are UUIDs, document names are token_urlsafe(16) + extension(s)
+ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,128}")
+FILE_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,128}(\.[A-Za-z0-9]{1,16}){1,2}")
+
+MAX_HEADER_BYTES = 16 * 1024
+KEEP_ALIVE_TIMEOUT = 15
+MAX_AGE = 31536000
+
+REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    304: "Not Modified",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+    500: "Internal Server Error",
+}
+
+
+def open_document(path: str):
+    """
+    open a document for reading, FileNotFoundError when it or any folder
+    above it is a symlink (e.g. code in the kernel linking x.txt to /etc/passwd)
+    or it is not a regular file; path must not contain symlinks itself
+    """
+    if os.path.realpath(path) != path:
+        raise FileNotFoundError(path)
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError as e:
+        if e.errno == errno.ELOOP:
+            raise FileNotFoundError(path) from e
+        raise
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        raise FileNotFoundError(path)
+    return os.fdopen(fd, "rb")
+
+
+@dataclass
+class FileMeta:
+    """
+    what a response needs to know about a document, cached per path
+    """
+    size: int
+    etag: str
+    last_modified: str
+    content_type: str
+
+
+class MetadataCache:
+    """
+    least recently used cache of FileMeta; documents are immutable, so an entry
+    only goes stale when the file is deleted, which the open() then reports or,
+    for answers that never open the file, exists() checks
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, FileMeta] = OrderedDict()
+
+    @staticmethod
+    def _stat(path: str) -> FileMeta:
+        with open_document(path) as file:
+            result = os.fstat(file.fileno())
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        return FileMeta(
+            size=result.st_size,
+            # strong validator: the same name never gets different bytes
+            etag=f'"{result.st_ino:x}-{result.st_size:x}-{result.st_mtime_ns:x}"',
+            last_modified=formatdate(result.st_mtime, usegmt=True),
+            content_type=content_type,
+        )
+
+    async def get(self, path: str) -> FileMeta:
+        meta = self.entries.get(path)
+        if meta is not None:
+            self.entries.move_to_end(path)
+            return meta
+        meta = await asyncio.to_thread(self._stat, path)
+        self.entries[path] = meta
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return meta
+
+    def discard(self, path: str):
+        self.entries.pop(path, None)
+
+    async def exists(self, path: str) -> bool:
+        """
+        cheap re-check for a cached file, dropping the entry when it is gone
+        """
+        try:
+            await asyncio.to_thread(os.stat, path, follow_symlinks=False)
+        except (FileNotFoundError, NotADirectoryError):
+            self.discard(path)
+            return False
+        return True
+
+
+def sign_download(secret: str, user_id: str, chat_id: str, file_name: str, expires: str) -> str:
+    """
+    HMAC of a download link, must match sign_download in CD_ProJect.py
+    """
+    message = f"{user_id}\n{chat_id}\n{file_name}\n{expires}".encode("utf-8")
+    return hmac.new(secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+def parse_range(header: str, size: int) -> tuple:
+    """
+    (start, end) inclusive for a single "bytes=" range, None to send the whole
+    file (absent, malformed or multi-range), raises 416 when unsatisfiable
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if not first:
+            # suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise HttpError(416, "Range not satisfiable.")
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise HttpError(416, "Range not satisfiable.")
+    return start, min(end, size - 1)
+
+
+class DownloadServer:
+    """
+    minimal HTTP/1.1 server with keep-alive, only answering GET/HEAD for documents
+    """
+
+    def __init__(self, directory: str, cache_entries: int = 4096, secret: str = ""):
+        # resolved, so that a symlink below it is the only way the realpath of a document can differ
+        self.directory = os.path.realpath(directory)
+        self.secret = secret
+        self.metadata = MetadataCache(cache_entries)
+        self.logger = logging.getLogger(__name__)
+
+    # ---------------- connection handling ----------------
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEP_ALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self._send_error(writer, HttpError(400, "Request headers too large."), False)
+                    return
+
+                try:
+                    method, target, version, headers = self._parse_head(head)
+                except HttpError as e:
+                    await self._send_error(writer, e, False)
+                    return
+
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+                try:
+                    await self._respond(writer, method, target, headers, keep_alive)
+                except HttpError as e:
+                    await self._send_error(writer, e, keep_alive)
+                except ConnectionError:
+                    return
+                except Exception as e:
+                    self.logger.exception(f"Failed to serve {target}")
+                    await self._send_error(writer, HttpError(500, str(e)), False)
+                    return
+
+                if not keep_alive:
+                    return
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_head(head: bytes) -> tuple:
+        if len(head) > MAX_HEADER_BYTES:
+            raise HttpError(400, "Request headers too large.")
+        try:
+            lines = head.decode("latin-1").split("\r\n")
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            raise HttpError(400, "Malformed request line.")
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+        return method, target, version, headers
+
+    # ---------------- responses ----------------
+
+    def _verify(self, user_id: str, chat_id: str, file_name: str, expires: str, signature: str) -> int:
+        """
+        seconds the signed link stays valid, raises 403 for a bad or expired one
+        """
+        if not expires or not signature or not expires.isdigit():
+            raise HttpError(403, "Invalid or expired link.")
+        remaining = int(expires) - int(time.time())
+        expected = sign_download(self.secret, user_id, chat_id, file_name, expires)
+        if not hmac.compare_digest(expected, signature) or remaining <= 0:
+            raise HttpError(403, "Invalid or expired link.")
+        return remaining
+
+    def _resolve(self, query: str) -> tuple:
+        params = parse_qs(query)
+        user_id = params.get("user_id", [None])[0]
+        chat_id = params.get("chat_id", [None])[0]
+        file_name = params.get("file_name", [None])[0]
+        if not user_id or not chat_id or not file_name:
+            raise HttpError(400, "Missing user_id, chat_id, or file_name parameter.")
+        max_age = MAX_AGE
+        if self.secret:
+            # caches must not keep serving a link after it expires
+            expires = params.get("expires", [""])[0]
+            signature = params.get("signature", [""])[0]
+            max_age = min(max_age, self._verify(user_id, chat_id, file_name, expires, signature))
+        # no separators or dot segments can get through, so the path stays inside DIRECTORY
+        if not (
+            ID_PATTERN.fullmatch(user_id)
+            and ID_PATTERN.fullmatch(chat_id)
+            and FILE_NAME_PATTERN.fullmatch(file_name)
+        ):
+            raise HttpError(404, "File not found.")
+        return os.path.join(self.directory, user_id, chat_id, file_name), file_name, max_age
+
+    async def _respond(self, writer, method: str, target: str, headers: dict, keep_alive: bool):
+        url = urlsplit(target)
+        if url.path == "/":
+            await self._send_json(writer, 200, {"message": "Welcome to the Files API."}, keep_alive)
+            return
+        if url.path != DOWNLOAD_PATH:
+            raise HttpError(404, "Not found.")
+        if method not in ("GET", "HEAD"):
+            raise HttpError(405, "Method not allowed.")
+
+        path, file_name, max_age = self._resolve(url.query)
+        try:
+            meta = await self.metadata.get(path)
+        except (FileNotFoundError, NotADirectoryError):
+            raise HttpError(404, "File not found.")
+
+        response_headers = {
+            "ETag": meta.etag,
+            "Last-Modified": meta.last_modified,
+            "Cache-Control": f"public, max-age={max_age}, immutable",
+            "Accept-Ranges": "bytes",
+        }
+
+        if meta.etag in (tag.strip() for tag in headers.get("if-none-match", "").split(",")):
+            # deleted (e.g. by the artifact sweeper) since it was cached
+            if not await self.metadata.exists(path):
+                raise HttpError(404, "File not found.")
+            await self._send_head(writer, 304, response_headers, keep_alive)
+            return
+
+        # If-Range with another validator means the client's partial copy is stale
+        byte_range = None
+        if headers.get("if-range", meta.etag) == meta.etag:
+            try:
+                byte_range = parse_range(headers.get("range"), meta.size)
+            except HttpError:
+                response_headers["Content-Range"] = f"bytes */{meta.size}"
+                await self._send_head(writer, 416, {**response_headers, "Content-Length": "0"}, keep_alive)
+                return
+
+        if byte_range is None:
+            status, offset, count = 200, 0, meta.size
+        else:
+            status, offset, count = 206, byte_range[0], byte_range[1] - byte_range[0] + 1
+            response_headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{meta.size}"
+
+        response_headers.update(
+            {
+                "Content-Type": meta.content_type,
+                "Content-Length": str(count),
+                "Content-Disposition": f'attachment; filename="{file_name}"',
+            }
+        )
+
+        if method == "HEAD":
+            if not await self.metadata.exists(path):
+                raise HttpError(404, "File not found.")
+            await self._send_head(writer, status, response_headers, keep_alive)
+            return
+
+        try:
+            file = await asyncio.to_thread(open_document, path)
+        except FileNotFoundError:
+            # deleted (e.g. by the artifact sweeper) since it was cached
+            self.metadata.discard(path)
+            raise HttpError(404, "File not found.")
+        try:
+            await self._send_head(writer, status, response_headers, keep_alive)
+            if count:
+                await asyncio.get_running_loop().sendfile(writer.transport, file, offset, count)
+        finally:
+            file.close()
+
+    async def _send_head(self, writer, status: int, headers: dict, keep_alive: bool):
+        lines = [f"HTTP/1.1 {status} {REASONS[status]}"]
+        headers = {
+            "Date": formatdate(usegmt=True),
+            "Server": "cdproject-files",
+            "Connection": "keep-alive" if keep_alive else "close",
+            **headers,
+        }
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def _send_json(self, writer, status: int, payload: dict, keep_alive: bool):
+        body = json.dumps(payload).encode("utf-8")
+        await self._send_head(
+            writer,
+            status,
+            {"Content-Type": "application/json", "Content-Length": str(len(body))},
+            keep_alive,
+        )
+        writer.write(body)
+        await writer.drain()
+
+    async def _send_error(self, writer, error: HttpError, keep_alive: bool):
+        try:
+            await self._send_json(writer, error.status, {"detail": error.detail}, keep_alive)
+        except ConnectionError:
+            pass
+
+    # ---------------- startup ----------------
+
+    async def start(self, host: str = "0.0.0.0", port: int = 8081) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_BYTES, backlog=1024)
+
+
+async def main(args):
+    os.makedirs(args.directory, exist_ok=True)
+    server = await DownloadServer(args.directory, args.cache_entries, args.secret).start(args.host, args.port)
+    logging.getLogger(__name__).info(f"Serving files from {os.path.abspath(args.directory)} on {args.host}:{args.port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CD ProJect download server")
+    parser.add_argument("--directory", required=True, help="the user_files folder inside the Jupyter data folder")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--cache-entries", type=int, default=4096, help="file metadata kept in memory")
+    parser.add_argument(
+        "--secret",
+        default=os.environ.get("CDPROJECT_DOWNLOAD_SECRET", ""),
+        help="DOWNLOAD_URL_SECRET of the tool, only signed links are served when set",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args))